@@ -5,6 +5,10 @@ It exposes the ASGI callable as a module-level variable named ``application``.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/5.1/howto/deployment/asgi/
+
+Serve the realtime ``/events/`` stream through this entry point with a single
+worker, e.g. ``uvicorn Book_Friend.asgi:application``; the in-process broker in
+``Core.events`` does not share events between worker processes.
 """
 
 import os
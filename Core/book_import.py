@@ -0,0 +1,127 @@
+"""
+Bulk book import from CSV or JSON Lines.
+
+Rows are read lazily from a text stream, validated with ``BookForm``'s rules
+and inserted with ``bulk_create`` in batches inside one transaction, so
+memory stays bounded by the batch size however long the file is. Invalid rows
+are skipped and reported by line number. ``bulk_create`` sends no post_save
+signals, so friends' feeds are backfilled once at the end instead of per book.
+"""
+import csv
+import json
+import os
+
+from django.core.exceptions import ValidationError
+from django.db import transaction
+
+from .forms import BookForm
+from .models import Book, FeedItem, FriendEdge
+
+FORMATS = {
+    '.csv': 'csv',
+    '.jsonl': 'jsonl',
+    '.ndjson': 'jsonl',
+}
+
+# Errors kept for the report; rows past this are still counted
+MAX_REPORTED_ERRORS = 1000
+
+TRUE_VALUES = {'1', 'true', 'yes', 'y'}
+
+CONDITIONS = {
+    key.lower(): value
+    for value, label in Book.CONDITION_CHOICES
+    for key in (value, label)
+}
+
+
+def detect_format(filename):
+    """The import format for a file name, or None if its extension is not supported"""
+    return FORMATS.get(os.path.splitext(filename)[1].lower())
+
+
+def read_rows(lines, format):
+    """Yield (line number, row dict) for each record; the row is None if it cannot be parsed"""
+    if format == 'csv':
+        reader = csv.DictReader(lines)
+        if reader.fieldnames:
+            reader.fieldnames = [name.strip().lower() for name in reader.fieldnames]
+        for row in reader:
+            yield reader.line_num, row
+        return
+
+    for line_number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            row = None
+        yield line_number, row if isinstance(row, dict) else None
+
+
+def _form_data(row):
+    """Map a parsed row onto BookForm data, with import-friendly condition and availability values"""
+    data = {field: row.get(field) for field in ('title', 'author', 'genre', 'condition', 'description')}
+    data = {field: '' if value is None else str(value).strip() for field, value in data.items()}
+    data['condition'] = CONDITIONS.get(data['condition'].lower(), data['condition'])
+
+    # Unlike the form's checkbox, a missing value means the book is available
+    available = row.get('available')
+    if isinstance(available, bool):
+        data['available'] = available
+    elif available is None or not str(available).strip():
+        data['available'] = True
+    else:
+        data['available'] = str(available).strip().lower() in TRUE_VALUES
+    return data
+
+
+def import_books(owner, rows, batch_size=1000):
+    """Validate and insert rows from read_rows as books of the owner.
+
+    Rows are cleaned with the fields of one BookForm, as binding a new form
+    per row would copy every field each time. Returns (created, errors,
+    error_count), where errors lists up to MAX_REPORTED_ERRORS
+    (line number, message) pairs.
+    """
+    fields = {name: field for name, field in BookForm().fields.items() if name != 'cover_image'}
+    created = 0
+    errors = []
+    error_count = 0
+    batch = []
+    with transaction.atomic():
+        for line_number, row in rows:
+            if row is None:
+                message = 'Not a valid record.'
+            else:
+                data = _form_data(row)
+                cleaned = {}
+                row_errors = []
+                for name, field in fields.items():
+                    try:
+                        cleaned[name] = field.clean(field.widget.value_from_datadict(data, {}, name))
+                    except ValidationError as error:
+                        row_errors.append(f'{name}: {" ".join(error.messages)}')
+                if not row_errors:
+                    batch.append(Book(owner=owner, **cleaned))
+                    if len(batch) >= batch_size:
+                        Book.objects.bulk_create(batch)
+                        created += len(batch)
+                        batch = []
+                    continue
+                message = '; '.join(row_errors)
+            error_count += 1
+            if len(errors) < MAX_REPORTED_ERRORS:
+                errors.append((line_number, message))
+
+        if batch:
+            Book.objects.bulk_create(batch)
+            created += len(batch)
+        if created:
+            # Friends see the latest of the imported books, as after a new friendship
+            FeedItem.follow(
+                (friend_id, owner.pk)
+                for friend_id in FriendEdge.objects.filter(user=owner).values_list('friend_id', flat=True)
+            )
+    return created, errors, error_count
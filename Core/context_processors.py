@@ -1,7 +1,11 @@
-from .models import Notification
+from .user_state import get_user_state
 
-def notification_count(request):
-    if request.user.is_authenticated:
-        unread_count = Notification.get_user_notifications(request.user).filter(read=False).count()
-        return {'unread_notifications': unread_count}
-    return {'unread_notifications': 0} 
\ No newline at end of file
+
+def user_state(request):
+    """Expose the lazy per-request user state; nothing is queried unless a template reads it"""
+    state = get_user_state(request)
+    return {
+        'user_state': state,
+        # Templates call callables, so the count is only fetched when rendered
+        'unread_notifications': lambda: state.unread_notifications,
+    }
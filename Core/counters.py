@@ -0,0 +1,91 @@
+"""
+Per-user badge counters and the version token used as their ETag.
+
+The version is a column of the user's ``NotificationCounter`` row, bumped in the
+same transaction as every change to one of the counted states, so an unchanged
+ETag can be answered with 304 Not Modified after one primary key lookup and no
+counting query. Living in the database, it is the same in every worker process.
+"""
+from django.contrib.auth.models import User
+from django.db.models import Case, F, Func, IntegerField, OuterRef, Q, Subquery, When
+from django.db.models.functions import Coalesce
+
+from .events import publish_counters
+
+
+def get_counters_version(user_id):
+    """Return the user's counters version, seeding their counter row if it is missing"""
+    from .models import NotificationCounter
+
+    version = NotificationCounter.objects.filter(user_id=user_id).values_list('version', flat=True).first()
+    if version is None:
+        NotificationCounter.get_unread(user_id)
+        version = 0
+    # The user id keeps two accounts on one browser from sharing an ETag
+    return f'{user_id}-{version}'
+
+
+def counters_changed(*user_ids):
+    """Invalidate the counters of the given users and push them to open streams.
+
+    The version bump commits or rolls back with the change itself, so a new
+    version is never paired with counts read before the change became visible.
+    """
+    from .models import NotificationCounter
+
+    user_ids = {user_id for user_id in user_ids if user_id is not None}
+    if not user_ids:
+        return
+
+    NotificationCounter.objects.filter(user_id__in=user_ids).update(version=F('version') + 1)
+    for user_id in user_ids:
+        publish_counters(user_id)
+
+
+def _count(queryset):
+    return Coalesce(
+        Subquery(
+            queryset.order_by().annotate(total=Func(F('pk'), function='COUNT')).values('total'),
+            output_field=IntegerField()
+        ),
+        0
+    )
+
+
+def get_counters(user):
+    """Fetch every badge counter of the user in a single query"""
+    from Message_Chat.models import Conversation
+    from .models import BookRequest, Friendship, Notification, NotificationCounter
+
+    user_id = getattr(user, 'pk', user)
+    unread_messages = (
+        Conversation.objects.filter(Q(user_a=OuterRef('pk')) | Q(user_b=OuterRef('pk')))
+        .order_by()
+        .annotate(total=Func(
+            Case(When(user_a=OuterRef('pk'), then='unread_a'), default='unread_b'),
+            function='SUM'
+        ))
+        .values('total')
+    )
+    return (
+        User.objects.filter(pk=user_id)
+        .annotate(
+            # COALESCE only falls back to counting for users without a counter row yet
+            unread_notifications=Coalesce(
+                Subquery(
+                    NotificationCounter.objects.filter(user=OuterRef('pk')).values('unread'),
+                    output_field=IntegerField()
+                ),
+                _count(Notification.get_user_notifications(OuterRef('pk')).filter(read=False))
+            ),
+            unread_messages=Coalesce(Subquery(unread_messages, output_field=IntegerField()), 0),
+            friend_requests=_count(
+                Friendship.objects.filter(receiver=OuterRef('pk'), status='pending')
+            ),
+            book_requests=_count(
+                BookRequest.objects.filter(book__owner=OuterRef('pk'), status='pending')
+            ),
+        )
+        .values('unread_notifications', 'unread_messages', 'friend_requests', 'book_requests')
+        .get()
+    )
@@ -0,0 +1,92 @@
+"""
+In-process publish/subscribe broker feeding the server-sent events stream.
+
+Subscribers are asyncio queues owned by the event-stream responses running on the
+ASGI event loop. Publishers are ordinary (usually synchronous) view code, so events
+are handed over with ``call_soon_threadsafe``. The broker lives in a single process:
+run one ASGI worker, or clients connected to other workers fall back to polling.
+"""
+import asyncio
+import json
+import threading
+
+from django.db import transaction
+
+# Events buffered per connection before the oldest ones are dropped
+SUBSCRIBER_QUEUE_SIZE = 100
+
+# Seconds between keep-alive comments on an idle stream
+KEEPALIVE_INTERVAL = 15
+
+
+class EventBroker:
+    def __init__(self):
+        self._subscribers = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, user_id):
+        """Register a queue for the user; must be called from the event loop"""
+        queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        with self._lock:
+            self._subscribers.setdefault(user_id, {})[queue] = asyncio.get_running_loop()
+        return queue
+
+    def unsubscribe(self, user_id, queue):
+        with self._lock:
+            subscribers = self._subscribers.get(user_id)
+            if subscribers is not None:
+                subscribers.pop(queue, None)
+                if not subscribers:
+                    del self._subscribers[user_id]
+
+    def has_subscribers(self, user_id):
+        return user_id in self._subscribers
+
+    def subscriber_count(self):
+        with self._lock:
+            return sum(len(subscribers) for subscribers in self._subscribers.values())
+
+    def publish(self, user_id, event_type, data):
+        """Send an event to every open stream of the user"""
+        with self._lock:
+            subscribers = list(self._subscribers.get(user_id, {}).items())
+        event = {'type': event_type, 'data': data}
+        for queue, loop in subscribers:
+            try:
+                loop.call_soon_threadsafe(self._deliver, queue, event)
+            except RuntimeError:
+                # The loop has shut down; the stream's cleanup will unsubscribe it
+                pass
+
+    @staticmethod
+    def _deliver(queue, event):
+        if queue.full():
+            queue.get_nowait()
+        queue.put_nowait(event)
+
+
+broker = EventBroker()
+
+
+def format_event(event):
+    """Encode an event in the text/event-stream wire format"""
+    return f"event: {event['type']}\ndata: {json.dumps(event['data'])}\n\n"
+
+
+def publish_on_commit(user_id, event_type, data):
+    """Publish once the current transaction commits, so clients never see rolled back rows"""
+    if broker.has_subscribers(user_id):
+        transaction.on_commit(lambda: broker.publish(user_id, event_type, data))
+
+
+def publish_counters(user_id):
+    """Push the user's current badge counters after the transaction commits"""
+    if not broker.has_subscribers(user_id):
+        return
+
+    def send():
+        from .counters import get_counters
+
+        broker.publish(user_id, 'counters', get_counters(user_id))
+
+    transaction.on_commit(send)
@@ -2,6 +2,9 @@ from django import forms
 from django.contrib.auth.forms import UserCreationForm
 from django.contrib.auth.models import User
 from .models import UserProfile, Book, BookReview
+import csv
+import io
+import re
 
 class SignUpForm(UserCreationForm):
     first_name = forms.CharField(max_length=100, label="First Name", required=True)
@@ -27,4 +30,56 @@ class BookReviewForm(forms.Form):
         label="Review",
         widget=forms.Textarea(attrs={'class': 'form-control', 'rows': 3}),
         required=True
-    )
\ No newline at end of file
+    )
+
+
+class FriendImportForm(forms.Form):
+    MAX_CONTACTS = 1000
+
+    contacts = forms.CharField(
+        label="Usernames or emails",
+        widget=forms.Textarea(attrs={'class': 'form-control', 'rows': 6}),
+        help_text="Separate entries with commas, spaces or new lines.",
+        required=False
+    )
+    contacts_file = forms.FileField(
+        label="Or upload a CSV file",
+        required=False
+    )
+
+    def clean(self):
+        cleaned_data = super().clean()
+        text = cleaned_data.get('contacts') or ''
+        upload = cleaned_data.get('contacts_file')
+        if upload:
+            try:
+                rows = csv.reader(io.TextIOWrapper(upload, encoding='utf-8-sig'))
+                text += '\n' + '\n'.join(','.join(row) for row in rows)
+            except UnicodeDecodeError:
+                raise forms.ValidationError("The CSV file must be UTF-8 encoded.")
+
+        identifiers = list(dict.fromkeys(
+            entry.strip() for entry in re.split(r'[\s,;]+', text) if entry.strip()
+        ))
+        if not identifiers:
+            raise forms.ValidationError("Enter at least one username or email.")
+        if len(identifiers) > self.MAX_CONTACTS:
+            raise forms.ValidationError(f"You can import at most {self.MAX_CONTACTS} contacts at a time.")
+        cleaned_data['identifiers'] = identifiers
+        return cleaned_data
+
+
+class BookImportForm(forms.Form):
+    books_file = forms.FileField(
+        label="CSV or JSON Lines file",
+        help_text="Columns: title, author, genre, condition, description and available. "
+                  "One JSON object per line for .jsonl files."
+    )
+
+    def clean_books_file(self):
+        from .book_import import detect_format
+
+        upload = self.cleaned_data['books_file']
+        if detect_format(upload.name) is None:
+            raise forms.ValidationError("Upload a .csv, .jsonl or .ndjson file.")
+        return upload
@@ -0,0 +1,52 @@
+"""
+Cached friend graph.
+
+Each user's set of accepted friend ids, read from the ``FriendEdge`` table,
+lives briefly in Django's cache framework, so the repeated permission checks
+and friend-scoped queries of a burst of requests share one query. The
+``Friendship`` post_save and post_delete signals sync the edges and drop the
+cached sets of both users; code that changes friendships with
+``QuerySet.update()`` skips those signals and must call ``FriendEdge.sync``
+and ``invalidate`` itself. Invalidation only reaches the process's own cache
+with the default LocMemCache, so sets expire after a few seconds and another
+worker can trust a removed friendship for at most that long.
+"""
+from django.core.cache import cache
+from django.db import transaction
+
+from .models import FriendEdge
+
+# Bounds how long a set can outlive a missed invalidation, such as an
+# unfriend handled by another worker process; permission checks rely on it
+FRIEND_IDS_TIMEOUT = 5
+
+
+def _key(user_id):
+    return f'friend-ids:{user_id}'
+
+
+def friend_ids(user):
+    """Ids of the user's accepted friends, as a frozenset"""
+    user_id = getattr(user, 'pk', user)
+    ids = cache.get(_key(user_id))
+    if ids is None:
+        ids = frozenset(FriendEdge.objects.filter(user_id=user_id).values_list('friend_id', flat=True))
+        cache.set(_key(user_id), ids, FRIEND_IDS_TIMEOUT)
+    return ids
+
+
+def are_friends(user, other):
+    return getattr(other, 'pk', other) in friend_ids(user)
+
+
+def invalidate(*user_ids):
+    """Forget the cached friend sets of the given users.
+
+    Deleted right away for the rest of this transaction, and again once it
+    commits so a concurrent request cannot re-cache the state from before it.
+    """
+    keys = [_key(user_id) for user_id in user_ids if user_id is not None]
+    if not keys:
+        return
+    cache.delete_many(keys)
+    transaction.on_commit(lambda: cache.delete_many(keys))
@@ -0,0 +1,131 @@
+import heapq
+import time
+from collections import Counter, defaultdict
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+from Core.models import Book, BookRating, FriendEdge, Friendship, FriendSuggestion
+
+
+class Command(BaseCommand):
+    help = 'Precompute "people you may know" suggestions from friends of friends'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--per-user',
+            type=int,
+            default=10,
+            help='Suggestions stored per user (default: 10)'
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Users whose suggestions are replaced per transaction (default: 1000)'
+        )
+        parser.add_argument(
+            '--max-fanout',
+            type=int,
+            default=1000,
+            help='Friends with more friends than this are not used as introducers (default: 1000)'
+        )
+
+    def handle(self, *args, **options):
+        started = timezone.now()
+        clock = time.monotonic()
+
+        friends = self.load_sets(FriendEdge.objects.values_list('user_id', 'friend_id'))
+        # Pending and declined requests already connect the pair one way or another
+        contacted = defaultdict(set)
+        for sender_id, receiver_id in Friendship.objects.exclude(status='accepted').values_list('sender_id', 'receiver_id').iterator(chunk_size=10000):
+            contacted[sender_id].add(receiver_id)
+            contacted[receiver_id].add(sender_id)
+        genres = self.load_sets(
+            (owner_id, genre.strip().lower())
+            for owner_id, genre in Book.objects.values_list('owner_id', 'genre').distinct().iterator(chunk_size=10000)
+        )
+        likes = self.load_sets(BookRating.objects.filter(rating='like').values_list('user_id', 'book_id'))
+        loaded = time.monotonic() - clock
+
+        # Introducers with huge friend lists add little signal for a quadratic cost
+        introducers = {
+            user_id: user_friends for user_id, user_friends in friends.items()
+            if len(user_friends) <= options['max_fanout']
+        }
+
+        user_ids = sorted(friends)
+        stored = 0
+        for start in range(0, len(user_ids), options['batch_size']):
+            batch = user_ids[start:start + options['batch_size']]
+            rows = []
+            for user_id in batch:
+                rows += self.suggest(
+                    user_id, friends, introducers, contacted, genres, likes, options['per_user'], started
+                )
+            with transaction.atomic():
+                FriendSuggestion.objects.filter(user_id__in=batch).delete()
+                self.insert(rows)
+            stored += len(rows)
+
+        # Users who lost all their friends since the last run
+        FriendSuggestion.objects.filter(computed_at__lt=started).delete()
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Stored {stored} suggestions for {len(user_ids)} users in {time.monotonic() - clock:.1f}s '
+            f'({loaded:.1f}s loading).'
+        ))
+
+    @staticmethod
+    def load_sets(pairs):
+        sets = defaultdict(set)
+        if hasattr(pairs, 'iterator'):
+            pairs = pairs.iterator(chunk_size=10000)
+        for key, value in pairs:
+            sets[key].add(value)
+        return sets
+
+    @staticmethod
+    def suggest(user_id, friends, introducers, contacted, genres, likes, per_user, computed_at):
+        """Rank the user's friends of friends and return their rows for insert"""
+        own_friends = friends[user_id]
+        mutual = Counter()
+        for friend_id in own_friends:
+            if friend_id in introducers:
+                mutual.update(introducers[friend_id])
+        mutual.pop(user_id, None)
+        for excluded_id in own_friends | contacted.get(user_id, set()):
+            mutual.pop(excluded_id, None)
+        if not mutual:
+            return []
+
+        # Library overlap only re-ranks, so score a shortlist picked by mutual friends
+        own_genres = genres.get(user_id, set())
+        own_likes = likes.get(user_id, set())
+        scored = []
+        for candidate_id, mutual_friends in mutual.most_common(per_user * 5):
+            shared_genres = len(own_genres & genres.get(candidate_id, set()))
+            shared_likes = len(own_likes & likes.get(candidate_id, set()))
+            score = FriendSuggestion.score_for(mutual_friends, shared_genres, shared_likes)
+            scored.append((score, -candidate_id, mutual_friends, shared_genres, shared_likes))
+        return [
+            (user_id, -negative_id, score, mutual_friends, shared_genres, shared_likes, computed_at)
+            for score, negative_id, mutual_friends, shared_genres, shared_likes in heapq.nlargest(per_user, scored)
+        ]
+
+    @staticmethod
+    def insert(rows):
+        """Insert suggestion rows with one executemany, skipping model instantiation"""
+        if not rows:
+            return
+        meta = FriendSuggestion._meta
+        columns = ['user', 'suggested', 'score', 'mutual_friends', 'shared_genres', 'shared_likes', 'computed_at']
+        quote = connection.ops.quote_name
+        sql = 'INSERT INTO {} ({}) VALUES ({})'.format(
+            quote(meta.db_table),
+            ', '.join(quote(meta.get_field(name).column) for name in columns),
+            ', '.join(['%s'] * len(columns))
+        )
+        computed_at = connection.ops.adapt_datetimefield_value(rows[0][-1])
+        with connection.cursor() as cursor:
+            cursor.executemany(sql, [row[:-1] + (computed_at,) for row in rows])
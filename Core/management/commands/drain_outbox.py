@@ -0,0 +1,96 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from Core.models import Notification, NotificationOutbox
+
+
+class Command(BaseCommand):
+    help = 'Deliver the notifications queued in the outbox, in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='Outbox entries delivered per transaction (default: 500)'
+        )
+        parser.add_argument(
+            '--forever',
+            action='store_true',
+            help='Keep polling the outbox instead of exiting once it is empty'
+        )
+        parser.add_argument(
+            '--interval',
+            type=float,
+            default=1.0,
+            help='Seconds to wait between polls of an empty outbox with --forever (default: 1)'
+        )
+
+    def handle(self, *args, **options):
+        delivered = failed = 0
+        while True:
+            batch_delivered, batch_failed, has_more = self.drain_batch(options['batch_size'])
+            delivered += batch_delivered
+            failed += batch_failed
+            if has_more:
+                continue
+            if not options['forever']:
+                break
+            time.sleep(options['interval'])
+        self.stdout.write(self.style.SUCCESS(f'Delivered {delivered} notifications, {failed} failed.'))
+
+    def drain_batch(self, batch_size):
+        """Deliver one batch of the oldest pending entries; returns (delivered, failed, has_more)"""
+        with transaction.atomic():
+            entries = list(
+                NotificationOutbox.objects.select_for_update(skip_locked=True, of=('self',))
+                .filter(attempts__lt=NotificationOutbox.MAX_ATTEMPTS)
+                .select_related(
+                    'user',
+                    'related_user',
+                    'related_book__owner',
+                    'related_book_request',
+                    'related_friendship',
+                    'related_book_review',
+                )
+                .order_by('id')[:batch_size]
+            )
+            if not entries:
+                return 0, 0, False
+
+            plain = [entry for entry in entries if not entry.coalesce]
+            delivered, failures = [], []
+            try:
+                with transaction.atomic():
+                    Notification.bulk_deliver([entry.to_notification() for entry in plain])
+                delivered += plain
+            except Exception:
+                # Find the entries at fault by delivering the batch one by one
+                for entry in plain:
+                    self.deliver_one(entry, delivered, failures)
+            for entry in entries:
+                if entry.coalesce:
+                    self.deliver_one(entry, delivered, failures)
+
+            NotificationOutbox.objects.filter(id__in=[entry.id for entry in delivered]).delete()
+            for entry, error in failures:
+                entry.attempts += 1
+                entry.last_error = error
+                entry.save(update_fields=['attempts', 'last_error'])
+        return len(delivered), len(failures), len(entries) == batch_size
+
+    @staticmethod
+    def deliver_one(entry, delivered, failures):
+        try:
+            with transaction.atomic():
+                if entry.coalesce:
+                    Notification.create_or_coalesce(
+                        entry.user, entry.notification_type, entry.message, **entry.related_fields()
+                    )
+                else:
+                    Notification.bulk_deliver([entry.to_notification()])
+        except Exception as error:
+            failures.append((entry, repr(error)))
+        else:
+            delivered.append(entry)
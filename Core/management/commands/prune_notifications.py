@@ -0,0 +1,116 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count
+from django.utils import timezone
+from Core.counters import counters_changed
+from Core.models import Notification, NotificationCounter
+
+
+class Command(BaseCommand):
+    help = (
+        'Keep the notification table bounded: collapse repeated book ratings into digests, '
+        'cap each user\'s unread backlog and delete read notifications past their TTL'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--read-ttl-days', type=int, default=30, help='Delete read notifications older than this (default: 30)')
+        parser.add_argument('--max-unread', type=int, default=200, help='Unread notifications kept per user (default: 200)')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Rows deleted per transaction (default: 1000)')
+        parser.add_argument('--sleep', type=float, default=0, help='Seconds to pause between delete batches')
+
+    def handle(self, *args, **options):
+        digested = self.collapse_ratings()
+        capped = self.cap_unread(options['max_unread'])
+        deleted = self.delete_expired(options['read_ttl_days'], options['batch_size'], options['sleep'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Collapsed {digested} rating notifications into digests, marked {capped} over the unread cap '
+            f'as read, deleted {deleted} expired notifications.'
+        ))
+
+    def collapse_ratings(self):
+        """Fold the unread book_rating notifications of each book into one digest row"""
+        groups = (
+            Notification.objects.filter(notification_type='book_rating', read=False, related_book__isnull=False)
+            .order_by()
+            .values('user_id', 'related_book_id')
+            .annotate(rows=Count('id'))
+            .filter(rows__gt=1)
+        )
+        collapsed = 0
+        for group in list(groups):
+            with transaction.atomic():
+                rows = list(
+                    Notification.objects.select_for_update()
+                    .filter(
+                        user_id=group['user_id'],
+                        notification_type='book_rating',
+                        read=False,
+                        related_book_id=group['related_book_id']
+                    )
+                    .select_related('related_book')
+                )
+                if len(rows) < 2:
+                    continue
+                latest = max(rows, key=lambda notification: notification.id)
+                if all(' liked your book' in notification.message for notification in rows):
+                    verb = 'liked'
+                elif all(' disliked your book' in notification.message for notification in rows):
+                    verb = 'disliked'
+                else:
+                    verb = 'rated'
+                friends = sum(notification.count for notification in rows)
+                # A digest speaks for several raters, so none of them may coalesce into it later
+                Notification.objects.filter(pk=latest.pk).update(
+                    count=friends,
+                    related_user=None,
+                    message=f"{friends} friends {verb} your book '{latest.related_book.title}'"
+                )
+                # Deleting unread rows keeps the user's counter in step through the signal
+                Notification.objects.filter(
+                    pk__in=[notification.pk for notification in rows if notification.pk != latest.pk]
+                ).delete()
+            collapsed += len(rows) - 1
+        return collapsed
+
+    def cap_unread(self, max_unread):
+        """Mark the oldest unread notifications beyond the per-user cap as read"""
+        over_cap = list(
+            NotificationCounter.objects.filter(unread__gt=max_unread)
+            .values_list('user_id', flat=True)
+        )
+        capped = 0
+        for user_id in over_cap:
+            with transaction.atomic():
+                stale_ids = list(
+                    Notification.get_user_notifications(user_id)
+                    .filter(read=False)
+                    .order_by('-created_at', '-id')
+                    .values_list('id', flat=True)[max_unread:]
+                )
+                updated = Notification.objects.filter(id__in=stale_ids, read=False).update(read=True)
+                if updated:
+                    NotificationCounter.adjust(user_id, -updated)
+                    counters_changed(user_id)
+            capped += updated
+        return capped
+
+    def delete_expired(self, ttl_days, batch_size, pause):
+        """Delete read notifications past the TTL in short transactions"""
+        cutoff = timezone.now() - timedelta(days=ttl_days)
+        deleted = 0
+        while True:
+            with transaction.atomic():
+                ids = list(
+                    Notification.objects.filter(read=True, created_at__lt=cutoff)
+                    .order_by('id')
+                    .values_list('id', flat=True)[:batch_size]
+                )
+                if not ids:
+                    break
+                deleted += Notification.objects.filter(id__in=ids).delete()[0]
+            if pause:
+                time.sleep(pause)
+        return deleted
@@ -0,0 +1,51 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Q
+from Core.counters import counters_changed
+from Core.models import Notification, NotificationCounter
+
+
+class Command(BaseCommand):
+    help = 'Recount unread notifications and repair NotificationCounter rows that drifted'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Number of users recounted per query (default: 1000)'
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        user_ids = list(User.objects.order_by('pk').values_list('pk', flat=True))
+        repaired = 0
+
+        for start in range(0, len(user_ids), batch_size):
+            batch = user_ids[start:start + batch_size]
+            with transaction.atomic():
+                actual = dict(
+                    User.objects.filter(pk__in=batch)
+                    .annotate(unread=Count('notification', filter=Q(
+                        notification__read=False,
+                        notification__notification_type__in=Notification.LISTED_TYPES
+                    )))
+                    .values_list('pk', 'unread')
+                )
+                stored = dict(
+                    NotificationCounter.objects.select_for_update()
+                    .filter(user_id__in=batch)
+                    .values_list('user_id', 'unread')
+                )
+                drifted = [user_id for user_id, unread in actual.items() if stored.get(user_id) != unread]
+                NotificationCounter.objects.bulk_create(
+                    [NotificationCounter(user_id=user_id, unread=actual[user_id]) for user_id in drifted],
+                    update_conflicts=True,
+                    unique_fields=['user'],
+                    update_fields=['unread']
+                )
+                counters_changed(*drifted)
+            repaired += len(drifted)
+
+        self.stdout.write(self.style.SUCCESS(f'Repaired {repaired} of {len(user_ids)} notification counters.'))
@@ -0,0 +1,63 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count, F, IntegerField, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
+from Core.models import Book, BookRating, BookReview
+
+
+def _count(queryset):
+    return Coalesce(
+        Subquery(
+            queryset.order_by().values('book').annotate(total=Count('pk')).values('total'),
+            output_field=IntegerField()
+        ),
+        0
+    )
+
+
+def _actual_counts():
+    return {
+        'likes': _count(BookRating.objects.filter(book=OuterRef('pk'), rating='like')),
+        'dislikes': _count(BookRating.objects.filter(book=OuterRef('pk'), rating='dislike')),
+        'review_count': _count(BookReview.objects.filter(book=OuterRef('pk'))),
+    }
+
+
+class Command(BaseCommand):
+    help = 'Recount the like, dislike and review counters of every book and fix any drift'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Books checked per query (default: 1000)'
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        repaired = 0
+        last_id = 0
+        while True:
+            ids = list(
+                Book.objects.filter(id__gt=last_id).order_by('id').values_list('id', flat=True)[:batch_size]
+            )
+            if not ids:
+                break
+            last_id = ids[-1]
+
+            drifted = list(
+                Book.objects.filter(id__in=ids)
+                .annotate(**{f'actual_{field}': count for field, count in _actual_counts().items()})
+                .filter(
+                    ~Q(likes=F('actual_likes'))
+                    | ~Q(dislikes=F('actual_dislikes'))
+                    | ~Q(review_count=F('actual_review_count'))
+                )
+                .values_list('id', flat=True)
+            )
+            if drifted:
+                # Recount inside the UPDATE itself so concurrent F() updates are not lost
+                Book.objects.filter(id__in=drifted).update(**_actual_counts())
+                repaired += len(drifted)
+
+        self.stdout.write(self.style.SUCCESS(f'Repaired the counters of {repaired} books.'))
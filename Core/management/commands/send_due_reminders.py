@@ -0,0 +1,89 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q
+from django.urls import reverse
+from django.utils import timezone
+from Core.models import BookRequest, Notification
+
+
+class Command(BaseCommand):
+    help = 'Send due_reminder notifications for accepted loans that are due soon or overdue'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days-before',
+            type=int,
+            default=2,
+            help='Remind borrowers this many days before the return date (default: 2)'
+        )
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=1000,
+            help='Loans handled per transaction (default: 1000)'
+        )
+
+    def handle(self, *args, **options):
+        today = timezone.localdate()
+        due_soon = self.send_stage(
+            BookRequest.REMINDER_DUE_SOON,
+            Q(return_date__gte=today, return_date__lte=today + timedelta(days=options['days_before'])),
+            options['chunk_size']
+        )
+        overdue = self.send_stage(
+            BookRequest.REMINDER_OVERDUE,
+            Q(return_date__lt=today),
+            options['chunk_size']
+        )
+        self.stdout.write(self.style.SUCCESS(f'Sent {due_soon} due soon and {overdue} overdue reminders.'))
+
+    def send_stage(self, stage, due, chunk_size):
+        """Remind every accepted loan in the due range that has not reached this stage yet.
+
+        Loans are read in (return_date, id) order from the (status, return_date)
+        index and the stage is advanced in the same transaction as the
+        notifications are written, so re-runs never send a reminder twice.
+        """
+        loans = (
+            BookRequest.objects.filter(due, status='accepted', reminder_stage__lt=stage)
+            .order_by('return_date', 'id')
+            .values('id', 'borrower_id', 'book_id', 'book__title', 'book__owner__username', 'return_date')
+        )
+        target_url = reverse('core:book_requests')
+        sent = 0
+        after = None
+        while True:
+            with transaction.atomic():
+                chunk = loans.select_for_update(of=('self',))
+                if after is not None:
+                    chunk = chunk.filter(Q(return_date__gt=after[0]) | Q(return_date=after[0], id__gt=after[1]))
+                chunk = list(chunk[:chunk_size])
+                if not chunk:
+                    break
+                after = (chunk[-1]['return_date'], chunk[-1]['id'])
+
+                Notification.bulk_deliver([
+                    Notification(
+                        user_id=loan['borrower_id'],
+                        notification_type='due_reminder',
+                        message=self.reminder_message(stage, loan),
+                        related_book_id=loan['book_id'],
+                        related_book_request_id=loan['id'],
+                        target_url=target_url
+                    )
+                    for loan in chunk
+                ])
+                BookRequest.objects.filter(id__in=[loan['id'] for loan in chunk]).update(reminder_stage=stage)
+            sent += len(chunk)
+        return sent
+
+    @staticmethod
+    def reminder_message(stage, loan):
+        title = loan['book__title']
+        owner = loan['book__owner__username']
+        return_date = loan['return_date'].strftime('%B %d, %Y')
+        if stage == BookRequest.REMINDER_OVERDUE:
+            return f'"{title}" was due back on {return_date}. Please return it to {owner}.'
+        return f'"{title}" is due back to {owner} on {return_date}.'
@@ -0,0 +1,85 @@
+import asyncio
+import time
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+from django.contrib.auth.models import User
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = (
+        'Open many idle connections to the /events/ stream of a running ASGI server '
+        '(e.g. `uvicorn Book_Friend.asgi:application`) and report how many stay open'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='http://127.0.0.1:8000/events/', help='Event stream URL')
+        parser.add_argument('--clients', type=int, default=1000, help='Number of concurrent clients')
+        parser.add_argument('--hold', type=float, default=30, help='Seconds to keep the clients connected')
+        parser.add_argument('--username', default='loadtest', help='User to authenticate as (created if missing)')
+        parser.add_argument('--ramp', type=float, default=5, help='Seconds over which clients connect')
+
+    def handle(self, *args, **options):
+        url = urlsplit(options['url'])
+        if url.scheme != 'http':
+            raise CommandError('Only plain http:// URLs are supported.')
+
+        user, created = User.objects.get_or_create(username=options['username'])
+        if created:
+            user.set_unusable_password()
+            user.save()
+        session = SessionStore()
+        session[SESSION_KEY] = str(user.pk)
+        session[BACKEND_SESSION_KEY] = 'django.contrib.auth.backends.ModelBackend'
+        session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+        session.create()
+
+        results = asyncio.run(self.run_clients(url, session.session_key, options))
+        connected, failed, dropped = results
+        self.stdout.write(
+            f"{options['clients']} clients: {connected} connected, {failed} failed to connect, "
+            f"{dropped} dropped during the {options['hold']:.0f}s hold."
+        )
+        session.delete()
+
+    async def run_clients(self, url, session_key, options):
+        request = (
+            f'GET {url.path or "/"} HTTP/1.1\r\n'
+            f'Host: {url.netloc}\r\n'
+            f'Accept: text/event-stream\r\n'
+            f'Cookie: {settings.SESSION_COOKIE_NAME}={session_key}\r\n'
+            f'\r\n'
+        ).encode()
+        deadline = time.monotonic() + options['ramp'] + options['hold']
+        delay = options['ramp'] / max(options['clients'], 1)
+
+        async def client(index):
+            await asyncio.sleep(index * delay)
+            try:
+                reader, writer = await asyncio.open_connection(url.hostname, url.port or 80)
+                writer.write(request)
+                await writer.drain()
+                status_line = await reader.readline()
+                if b' 200 ' not in status_line:
+                    writer.close()
+                    return 'failed'
+            except OSError:
+                return 'failed'
+            try:
+                while time.monotonic() < deadline:
+                    chunk = await asyncio.wait_for(reader.read(1024), timeout=deadline - time.monotonic())
+                    if not chunk:
+                        return 'dropped'
+            except asyncio.TimeoutError:
+                pass
+            except OSError:
+                return 'dropped'
+            finally:
+                writer.close()
+            return 'connected'
+
+        outcomes = await asyncio.gather(*(client(index) for index in range(options['clients'])))
+        return outcomes.count('connected'), outcomes.count('failed'), outcomes.count('dropped')
@@ -0,0 +1,51 @@
+# Generated by Django 5.1.6 on 2026-10-17 06:42
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Max
+
+
+def coalesce_message_notifications(apps, schema_editor):
+    """Fold duplicate unread message notifications into the latest one of each conversation"""
+    Notification = apps.get_model("Core", "Notification")
+    unread = Notification.objects.filter(notification_type="new_message", read=False)
+    duplicates = (
+        unread.exclude(related_user=None)
+        .order_by()
+        .values("user_id", "related_user_id")
+        .annotate(latest_id=Max("id"), total=Count("id"))
+        .filter(total__gt=1)
+    )
+    for group in duplicates.iterator():
+        unread.filter(
+            user_id=group["user_id"], related_user_id=group["related_user_id"]
+        ).exclude(id=group["latest_id"]).delete()
+        Notification.objects.filter(id=group["latest_id"]).update(count=group["total"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("Core", "0007_notification_related_message_and_more"),
+        ("Message_Chat", "0005_message_fts"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="notification",
+            name="count",
+            field=models.PositiveIntegerField(default=1),
+        ),
+        migrations.RunPython(coalesce_message_notifications, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name="notification",
+            constraint=models.UniqueConstraint(
+                condition=models.Q(
+                    ("notification_type", "new_message"), ("read", False)
+                ),
+                fields=("user", "related_user"),
+                name="unique_unread_message_notification",
+            ),
+        ),
+    ]
@@ -0,0 +1,64 @@
+# Generated by Django 5.1.6 on 2026-10-17 06:57
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Q
+
+LISTED_TYPES = [
+    "friend_request",
+    "book_request",
+    "request_update",
+    "due_reminder",
+    "book_rating",
+    "book_review",
+]
+
+
+def seed_counters(apps, schema_editor):
+    User = apps.get_model(*settings.AUTH_USER_MODEL.split("."))
+    NotificationCounter = apps.get_model("Core", "NotificationCounter")
+    counts = User.objects.annotate(
+        unread=Count(
+            "notification",
+            filter=Q(
+                notification__read=False,
+                notification__notification_type__in=LISTED_TYPES,
+            ),
+        )
+    ).values_list("pk", "unread")
+    NotificationCounter.objects.bulk_create(
+        (
+            NotificationCounter(user_id=pk, unread=unread)
+            for pk, unread in counts.iterator()
+        ),
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("Core", "0008_notification_count_coalescing"),
+        ("auth", "0012_alter_user_first_name_max_length"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="NotificationCounter",
+            fields=[
+                (
+                    "user",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        related_name="notification_counter",
+                        serialize=False,
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+                ("unread", models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(seed_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.1.6 on 2026-10-17 07:00
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("Core", "0009_notificationcounter"),
+        ("Message_Chat", "0007_archivedmessageblock"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="notification",
+            name="target_url",
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddIndex(
+            model_name="notification",
+            index=models.Index(
+                fields=["user", "-created_at", "-id"],
+                name="notification_user_created_idx",
+            ),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 5.1.6 on 2026-10-17 07:01
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("Core", "0010_notification_target_url"),
+        ("Message_Chat", "0007_archivedmessageblock"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="notification",
+            index=models.Index(
+                fields=["read", "created_at"], name="notification_read_created_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.1.6 on 2026-10-17 07:02
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("Core", "0011_notification_read_created_idx"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="bookrequest",
+            name="reminder_stage",
+            field=models.PositiveSmallIntegerField(
+                choices=[(0, "None"), (1, "Due soon"), (2, "Overdue")], default=0
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="bookrequest",
+            index=models.Index(
+                fields=["status", "return_date"], name="bookrequest_status_due_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,74 @@
+# Generated by Django 5.1.6 on 2026-10-17 07:10
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def build_edges(apps, schema_editor):
+    Friendship = apps.get_model("Core", "Friendship")
+    FriendEdge = apps.get_model("Core", "FriendEdge")
+    pairs = Friendship.objects.filter(status="accepted").values_list(
+        "sender_id", "receiver_id"
+    )
+    FriendEdge.objects.bulk_create(
+        (
+            FriendEdge(user_id=user_id, friend_id=friend_id)
+            for sender_id, receiver_id in pairs.iterator()
+            for user_id, friend_id in (
+                (sender_id, receiver_id),
+                (receiver_id, sender_id),
+            )
+        ),
+        batch_size=1000,
+        ignore_conflicts=True,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("Core", "0013_notificationoutbox"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="FriendEdge",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "friend",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="+",
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+                (
+                    "user",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="friend_edges",
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+            options={
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("user", "friend"), name="unique_friend_edge"
+                    )
+                ],
+            },
+        ),
+        migrations.RunPython(build_edges, migrations.RunPython.noop),
+    ]
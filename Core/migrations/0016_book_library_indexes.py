@@ -0,0 +1,48 @@
+# Generated by Django 5.1.6 on 2026-10-17 07:26
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("Core", "0015_friendsuggestion"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="book",
+            index=models.Index(
+                fields=["owner", "created_at", "id"], name="book_owner_created_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="book",
+            index=models.Index(
+                fields=["owner", "title", "id"], name="book_owner_title_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="book",
+            index=models.Index(
+                fields=["owner", "genre", "created_at", "id"],
+                name="book_owner_genre_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="book",
+            index=models.Index(
+                fields=["owner", "condition", "created_at", "id"],
+                name="book_owner_condition_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="book",
+            index=models.Index(
+                fields=["owner", "available", "created_at", "id"],
+                name="book_owner_available_idx",
+            ),
+        ),
+    ]
@@ -0,0 +1,57 @@
+# Generated by Django 5.1.6 on 2026-10-17 07:27
+
+from django.db import migrations, models
+from django.db.models import Count, IntegerField, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def count_ratings(apps, schema_editor):
+    Book = apps.get_model("Core", "Book")
+    BookRating = apps.get_model("Core", "BookRating")
+    BookReview = apps.get_model("Core", "BookReview")
+
+    def count(queryset):
+        return Coalesce(
+            Subquery(
+                queryset.order_by()
+                .values("book")
+                .annotate(total=Count("pk"))
+                .values("total"),
+                output_field=IntegerField(),
+            ),
+            0,
+        )
+
+    Book.objects.update(
+        likes=count(BookRating.objects.filter(book=OuterRef("pk"), rating="like")),
+        dislikes=count(
+            BookRating.objects.filter(book=OuterRef("pk"), rating="dislike")
+        ),
+        review_count=count(BookReview.objects.filter(book=OuterRef("pk"))),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("Core", "0016_book_library_indexes"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="book",
+            name="dislikes",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="book",
+            name="likes",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="book",
+            name="review_count",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(count_ratings, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,120 @@
+# Generated by Django 5.1.6 on 2026-10-17 07:36
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import F, Window
+from django.db.models.functions import RowNumber
+
+BACKFILL_PER_FRIEND = 20
+
+
+def build_feeds(apps, schema_editor):
+    """Give every user their friends' latest books, as FeedItem.follow does"""
+    Book = apps.get_model("Core", "Book")
+    FeedItem = apps.get_model("Core", "FeedItem")
+    FriendEdge = apps.get_model("Core", "FriendEdge")
+    owner_ids = list(
+        Book.objects.order_by("owner_id").values_list("owner_id", flat=True).distinct()
+    )
+    for start in range(0, len(owner_ids), 500):
+        owners = owner_ids[start : start + 500]
+        books_by_owner = {}
+        latest = (
+            Book.objects.filter(owner_id__in=owners)
+            .annotate(
+                rank=Window(
+                    RowNumber(),
+                    partition_by=F("owner_id"),
+                    order_by=(F("created_at").desc(), F("id").desc()),
+                )
+            )
+            .filter(rank__lte=BACKFILL_PER_FRIEND)
+            .values_list("id", "owner_id", "created_at")
+        )
+        for book_id, owner_id, created_at in latest:
+            books_by_owner.setdefault(owner_id, []).append((book_id, created_at))
+        edges = FriendEdge.objects.filter(friend_id__in=owners).values_list(
+            "user_id", "friend_id"
+        )
+        FeedItem.objects.bulk_create(
+            (
+                FeedItem(
+                    user_id=user_id,
+                    book_id=book_id,
+                    owner_id=owner_id,
+                    created_at=created_at,
+                )
+                for user_id, owner_id in edges.iterator()
+                for book_id, created_at in books_by_owner[owner_id]
+            ),
+            batch_size=1000,
+            ignore_conflicts=True,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("Core", "0017_book_rating_counters"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="FeedItem",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("created_at", models.DateTimeField()),
+                (
+                    "book",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="+",
+                        to="Core.book",
+                    ),
+                ),
+                (
+                    "owner",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="+",
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+                (
+                    "user",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="feed_items",
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        fields=["user", "created_at", "id"],
+                        name="feeditem_user_created_idx",
+                    ),
+                    models.Index(
+                        fields=["owner", "user"], name="feeditem_owner_user_idx"
+                    ),
+                ],
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("user", "book"), name="unique_feed_item"
+                    )
+                ],
+            },
+        ),
+        migrations.RunPython(build_feeds, migrations.RunPython.noop),
+    ]
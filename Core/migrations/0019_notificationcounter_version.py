@@ -0,0 +1,18 @@
+# Generated by Django 5.1.6 on 2026-10-17 08:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("Core", "0018_feed_items"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="notificationcounter",
+            name="version",
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+    ]
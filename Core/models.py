@@ -1,7 +1,14 @@
-from django.db import models
+from django.db import models, transaction, IntegrityError
+from django.db.models import Count, Exists, F, OuterRef, Q, Value, CharField, Window
+from django.db.models.functions import Cast, Concat, RowNumber
 from django.contrib.auth.models import User
 from django.urls import reverse
 from django.utils import timezone
+from django.utils.http import urlsafe_base64_decode, urlsafe_base64_encode
+from datetime import datetime, timedelta, timezone as dt_timezone
+from functools import reduce
+import json
+import operator
 
 class UserProfile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
@@ -33,14 +40,91 @@ class Book(models.Model):
     available = models.BooleanField(default=True)
     created_at = models.DateTimeField(auto_now_add=True)
     
+    # Denormalized from BookRating and BookReview with F() updates wherever
+    # those change; the repair_book_counters command fixes any drift
+    likes = models.PositiveIntegerField(default=0)
+    dislikes = models.PositiveIntegerField(default=0)
+    review_count = models.PositiveIntegerField(default=0)
+    
+    # Library sort options: name -> ordering, the last field always being the id tiebreaker
+    LIBRARY_SORTS = {
+        'newest': ('-created_at', '-id'),
+        'oldest': ('created_at', 'id'),
+        'title': ('title', 'id'),
+    }
+    
+    class Meta:
+        indexes = [
+            # Library pages by sort, and by each filter in date order, are single
+            # range scans; the database walks them backwards for newest first
+            models.Index(fields=['owner', 'created_at', 'id'], name='book_owner_created_idx'),
+            models.Index(fields=['owner', 'title', 'id'], name='book_owner_title_idx'),
+            models.Index(fields=['owner', 'genre', 'created_at', 'id'], name='book_owner_genre_idx'),
+            models.Index(fields=['owner', 'condition', 'created_at', 'id'], name='book_owner_condition_idx'),
+            models.Index(fields=['owner', 'available', 'created_at', 'id'], name='book_owner_available_idx'),
+        ]
+    
     def __str__(self):
         return self.title
 
+    @staticmethod
+    def encode_library_cursor(book, sort):
+        """Build the opaque keyset cursor pointing just after a book in the given sort"""
+        if sort == 'title':
+            key = book.title
+        else:
+            key = (book.created_at - datetime(1970, 1, 1, tzinfo=dt_timezone.utc)) // timedelta(microseconds=1)
+        return urlsafe_base64_encode(json.dumps([key, book.id]).encode())
+
+    @staticmethod
+    def decode_library_cursor(cursor, sort):
+        """Parse a cursor from encode_library_cursor into (sort key, id), or None if malformed"""
+        try:
+            key, book_id = json.loads(urlsafe_base64_decode(cursor))
+            if sort == 'title':
+                if not isinstance(key, str):
+                    return None
+            else:
+                key = datetime(1970, 1, 1, tzinfo=dt_timezone.utc) + timedelta(microseconds=int(key))
+            return key, int(book_id)
+        except (TypeError, ValueError, OverflowError):
+            return None
+
+    @staticmethod
+    def get_library_page(owner, sort='newest', after=None, limit=24, **filters):
+        """Get one page of the owner's books after a keyset cursor.
+
+        `filters` are exact matches on genre, condition or available. Returns
+        (books, has_more).
+        """
+        ordering = Book.LIBRARY_SORTS[sort]
+        books = Book.objects.filter(owner=owner, **filters).order_by(*ordering)
+        if after:
+            key, book_id = after
+            key_field = ordering[0].lstrip('-')
+            if ordering[0].startswith('-'):
+                books = books.filter(Q(**{f'{key_field}__lt': key}) | Q(**{key_field: key, 'id__lt': book_id}))
+            else:
+                books = books.filter(Q(**{f'{key_field}__gt': key}) | Q(**{key_field: key, 'id__gt': book_id}))
+        page = list(books[:limit + 1])
+        return page[:limit], len(page) > limit
+
     def like_count(self):
-        return self.bookrating_set.filter(rating='like').count()
+        return self.likes
 
     def dislike_count(self):
-        return self.bookrating_set.filter(rating='dislike').count()
+        return self.dislikes
+
+    @property
+    def total_ratings(self):
+        return self.likes + self.dislikes
+
+    @property
+    def average_rating(self):
+        """Share of likes scaled to five stars"""
+        if not self.total_ratings:
+            return 0
+        return round((self.likes / self.total_ratings) * 5, 1)
 
 class BookRating(models.Model):
     RATING_CHOICES = [
@@ -59,6 +143,37 @@ class BookRating(models.Model):
     def __str__(self):
         return f"{self.user.username} {self.rating}d {self.book.title}"
 
+    # Book counter column for each rating value
+    COUNTER_FIELDS = {'like': 'likes', 'dislike': 'dislikes'}
+
+    @staticmethod
+    def rate(user, book, rating):
+        """Set the user's rating of a book, keeping the book's counters in step.
+
+        Switching between like and dislike moves one count across in the same
+        UPDATE. Returns False when the user had already given this rating.
+        """
+        with transaction.atomic():
+            existing = BookRating.objects.select_for_update().filter(user=user, book=book).first()
+            if existing is None:
+                try:
+                    with transaction.atomic():
+                        BookRating.objects.create(user=user, book=book, rating=rating)
+                except IntegrityError:
+                    # Rated concurrently; treat it as a switch from that rating
+                    existing = BookRating.objects.select_for_update().get(user=user, book=book)
+                else:
+                    counter = BookRating.COUNTER_FIELDS[rating]
+                    Book.objects.filter(pk=book.pk).update(**{counter: F(counter) + 1})
+                    return True
+            if existing.rating == rating:
+                return False
+            BookRating.objects.filter(pk=existing.pk).update(rating=rating)
+            old_counter = BookRating.COUNTER_FIELDS[existing.rating]
+            new_counter = BookRating.COUNTER_FIELDS[rating]
+            Book.objects.filter(pk=book.pk).update(**{old_counter: F(old_counter) - 1, new_counter: F(new_counter) + 1})
+            return True
+
 class BookReview(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     book = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='reviews')
@@ -83,6 +198,304 @@ class Friendship(models.Model):
     class Meta:
         unique_together = ['sender', 'receiver']
 
+    @staticmethod
+    def send_bulk(sender, receivers):
+        """Send friend requests to many users at once, skipping anyone already connected.
+
+        Requests and their queued notifications are inserted with bulk_create,
+        so this does what the per-row signals would for pending requests.
+        Returns the created friendships.
+        """
+        from .counters import counters_changed
+
+        receiver_ids = {receiver.pk for receiver in receivers} - {sender.pk}
+        connected = set()
+        for sender_id, receiver_id in Friendship.objects.filter(
+            Q(sender=sender, receiver_id__in=receiver_ids) | Q(sender_id__in=receiver_ids, receiver=sender)
+        ).values_list('sender_id', 'receiver_id'):
+            connected.add(receiver_id if sender_id == sender.pk else sender_id)
+        receiver_ids -= connected
+        if not receiver_ids:
+            return []
+
+        with transaction.atomic():
+            friendships = Friendship.objects.bulk_create(
+                [Friendship(sender=sender, receiver_id=receiver_id) for receiver_id in sorted(receiver_ids)]
+            )
+            NotificationOutbox.objects.bulk_create([
+                NotificationOutbox(
+                    user_id=friendship.receiver_id,
+                    notification_type='friend_request',
+                    message=f"{sender.username} has sent you a friend request.",
+                    related_user=sender,
+                    related_friendship=friendship
+                )
+                for friendship in friendships
+            ])
+            FriendSuggestion.objects.filter(
+                Q(user=sender, suggested_id__in=receiver_ids) | Q(user_id__in=receiver_ids, suggested=sender)
+            ).delete()
+            counters_changed(*receiver_ids)
+        return friendships
+
+    @staticmethod
+    def respond_all(receiver, status):
+        """Accept or decline every pending request the user received with one UPDATE.
+
+        Returns the number of requests answered.
+        """
+        from . import friends
+        from .counters import counters_changed
+
+        with transaction.atomic():
+            pending = list(
+                Friendship.objects.select_for_update()
+                .filter(receiver=receiver, status='pending')
+                .values_list('id', 'sender_id')
+            )
+            if not pending:
+                return 0
+            Friendship.objects.filter(id__in=[friendship_id for friendship_id, sender_id in pending]).update(status=status)
+
+            sender_ids = [sender_id for friendship_id, sender_id in pending]
+            if status == 'accepted':
+                FriendEdge.objects.bulk_create(
+                    [FriendEdge(user=receiver, friend_id=sender_id) for sender_id in sender_ids]
+                    + [FriendEdge(user_id=sender_id, friend=receiver) for sender_id in sender_ids],
+                    ignore_conflicts=True
+                )
+                FeedItem.follow(
+                    [(receiver.pk, sender_id) for sender_id in sender_ids]
+                    + [(sender_id, receiver.pk) for sender_id in sender_ids]
+                )
+                friends.invalidate(receiver.pk, *sender_ids)
+            NotificationOutbox.objects.bulk_create([
+                NotificationOutbox(
+                    user_id=sender_id,
+                    notification_type='request_update',
+                    message=f"{receiver.username} {status} your friend request.",
+                    related_user=receiver,
+                    related_friendship_id=friendship_id
+                )
+                for friendship_id, sender_id in pending
+            ])
+            counters_changed(receiver.pk)
+        return len(pending)
+
+class FriendEdge(models.Model):
+    """One direction of an accepted friendship; each friendship has both rows.
+
+    Denormalized from Friendship by its signals so friend lookups are a range
+    scan of the (user, friend) index instead of an OR across sender and receiver.
+    """
+    user = models.ForeignKey(User, related_name='friend_edges', on_delete=models.CASCADE)
+    friend = models.ForeignKey(User, related_name='+', on_delete=models.CASCADE)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'friend'], name='unique_friend_edge')
+        ]
+
+    def __str__(self):
+        return f"{self.user_id} is friends with {self.friend_id}"
+
+    @staticmethod
+    def sync(user_a_id, user_b_id):
+        """Add or remove the pair's edges and feed items to match their Friendship rows"""
+        accepted = Friendship.objects.filter(
+            Q(sender_id=user_a_id, receiver_id=user_b_id) | Q(sender_id=user_b_id, receiver_id=user_a_id),
+            status='accepted'
+        ).exists()
+        if accepted:
+            FriendEdge.objects.bulk_create(
+                [FriendEdge(user_id=user_a_id, friend_id=user_b_id), FriendEdge(user_id=user_b_id, friend_id=user_a_id)],
+                ignore_conflicts=True
+            )
+            FeedItem.follow([(user_a_id, user_b_id), (user_b_id, user_a_id)])
+        else:
+            FriendEdge.objects.filter(
+                Q(user_id=user_a_id, friend_id=user_b_id) | Q(user_id=user_b_id, friend_id=user_a_id)
+            ).delete()
+            FeedItem.unfollow([(user_a_id, user_b_id), (user_b_id, user_a_id)])
+
+    @staticmethod
+    def mutual_counts(user, other_ids):
+        """Map each of other_ids to the number of friends it shares with the user"""
+        user_id = getattr(user, 'pk', user)
+        return dict(
+            FriendEdge.objects.filter(
+                user_id__in=other_ids,
+                friend_id__in=FriendEdge.objects.filter(user_id=user_id).values('friend_id')
+            )
+            .order_by()
+            .values('user_id')
+            .annotate(mutual=Count('friend_id'))
+            .values_list('user_id', 'mutual')
+        )
+
+class FriendSuggestion(models.Model):
+    """A precomputed "people you may know" entry, refreshed by compute_friend_suggestions"""
+    # Score = sum of weight * signal; mutual friends dominate, libraries break ties
+    MUTUAL_FRIEND_WEIGHT = 1.0
+    SHARED_LIKE_WEIGHT = 0.5
+    SHARED_GENRE_WEIGHT = 0.25
+
+    user = models.ForeignKey(User, related_name='friend_suggestions', on_delete=models.CASCADE)
+    suggested = models.ForeignKey(User, related_name='+', on_delete=models.CASCADE)
+    score = models.FloatField()
+    mutual_friends = models.PositiveIntegerField(default=0)
+    shared_genres = models.PositiveIntegerField(default=0)
+    shared_likes = models.PositiveIntegerField(default=0)
+    computed_at = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', '-score', 'suggested'], name='friendsuggestion_score_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'suggested'], name='unique_friend_suggestion')
+        ]
+
+    def __str__(self):
+        return f"Suggest {self.suggested_id} to {self.user_id}"
+
+    @staticmethod
+    def score_for(mutual_friends, shared_genres, shared_likes):
+        return (
+            FriendSuggestion.MUTUAL_FRIEND_WEIGHT * mutual_friends
+            + FriendSuggestion.SHARED_GENRE_WEIGHT * shared_genres
+            + FriendSuggestion.SHARED_LIKE_WEIGHT * shared_likes
+        )
+
+    @staticmethod
+    def get_for_user(user, limit=10):
+        """The user's best suggestions, read from the (user, -score) index"""
+        return list(
+            FriendSuggestion.objects.filter(user=user)
+            .select_related('suggested__userprofile')
+            .order_by('-score', 'suggested_id')[:limit]
+        )
+
+    @staticmethod
+    def forget_pair(user_a_id, user_b_id):
+        """Drop suggestions between two users once either has contacted the other"""
+        FriendSuggestion.objects.filter(
+            Q(user_id=user_a_id, suggested_id=user_b_id) | Q(user_id=user_b_id, suggested_id=user_a_id)
+        ).delete()
+
+class FeedItem(models.Model):
+    """A friend's book in a user's home feed.
+
+    Fanned out on write: rows are added when a friend shares a book or a
+    friendship is accepted and removed with the friendship, so the dashboard
+    reads one range of the (user, created_at) index however many friends the
+    user has.
+    """
+    # Latest books of each side copied into the other's feed when a friendship starts
+    BACKFILL_PER_FRIEND = 20
+
+    user = models.ForeignKey(User, related_name='feed_items', on_delete=models.CASCADE)
+    book = models.ForeignKey(Book, related_name='+', on_delete=models.CASCADE)
+    owner = models.ForeignKey(User, related_name='+', on_delete=models.CASCADE)
+    # The book's, so the feed lists books in the order they were shared
+    created_at = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'created_at', 'id'], name='feeditem_user_created_idx'),
+            models.Index(fields=['owner', 'user'], name='feeditem_owner_user_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'book'], name='unique_feed_item')
+        ]
+
+    def __str__(self):
+        return f"Book {self.book_id} in the feed of {self.user_id}"
+
+    @staticmethod
+    def fan_out(book):
+        """Add a new book to the feed of each of its owner's friends"""
+        FeedItem.objects.bulk_create(
+            [
+                FeedItem(user_id=friend_id, book=book, owner_id=book.owner_id, created_at=book.created_at)
+                for friend_id in FriendEdge.objects.filter(user_id=book.owner_id).values_list('friend_id', flat=True)
+            ],
+            batch_size=1000,
+            ignore_conflicts=True
+        )
+
+    @staticmethod
+    def follow(pairs):
+        """Backfill each (user id, owner id) pair's feed with the owner's latest books"""
+        pairs = list(pairs)
+        if not pairs:
+            return
+        latest = (
+            Book.objects.filter(owner_id__in={owner_id for user_id, owner_id in pairs})
+            .annotate(rank=Window(RowNumber(), partition_by=F('owner_id'), order_by=(F('created_at').desc(), F('id').desc())))
+            .filter(rank__lte=FeedItem.BACKFILL_PER_FRIEND)
+            .values_list('id', 'owner_id', 'created_at')
+        )
+        books_by_owner = {}
+        for book_id, owner_id, created_at in latest:
+            books_by_owner.setdefault(owner_id, []).append((book_id, created_at))
+        FeedItem.objects.bulk_create(
+            [
+                FeedItem(user_id=user_id, book_id=book_id, owner_id=owner_id, created_at=created_at)
+                for user_id, owner_id in pairs
+                for book_id, created_at in books_by_owner.get(owner_id, [])
+            ],
+            batch_size=1000,
+            ignore_conflicts=True
+        )
+
+    @staticmethod
+    def unfollow(pairs):
+        """Drop the owner's books from the feed of each (user id, owner id) pair"""
+        pairs = list(pairs)
+        if pairs:
+            FeedItem.objects.filter(
+                reduce(operator.or_, (Q(owner_id=owner_id, user_id=user_id) for user_id, owner_id in pairs))
+            ).delete()
+
+    @staticmethod
+    def encode_cursor(item):
+        """Build the opaque keyset cursor pointing just after a feed item"""
+        micros = (item.created_at - datetime(1970, 1, 1, tzinfo=dt_timezone.utc)) // timedelta(microseconds=1)
+        return f'{micros}-{item.id}'
+
+    @staticmethod
+    def decode_cursor(cursor):
+        """Parse a cursor from encode_cursor into (created_at, id), or None if malformed"""
+        try:
+            micros, item_id = cursor.split('-')
+            created_at = datetime(1970, 1, 1, tzinfo=dt_timezone.utc) + timedelta(microseconds=int(micros))
+            return created_at, int(item_id)
+        except (AttributeError, ValueError, OverflowError):
+            return None
+
+    @staticmethod
+    def get_page(user, after=None, limit=12):
+        """Get one page of the user's feed, newest first, after a keyset cursor.
+
+        Lent-out books are skipped. Returns (items, has_more), each item with
+        its book and the book's owner loaded and a has_pending_request flag
+        for the user's own requests, all from one query.
+        """
+        items = (
+            FeedItem.objects.filter(user=user, book__available=True)
+            .select_related('book__owner')
+            .annotate(has_pending_request=Exists(
+                BookRequest.objects.filter(book=OuterRef('book'), borrower=user, status='pending')
+            ))
+            .order_by('-created_at', '-id')
+        )
+        if after:
+            created_at, item_id = after
+            items = items.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=item_id))
+        page = list(items[:limit + 1])
+        return page[:limit], len(page) > limit
+
 class BookRequest(models.Model):
     STATUS_CHOICES = [
         ('pending', 'Pending'),
@@ -98,6 +511,23 @@ class BookRequest(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     returned_at = models.DateTimeField(null=True, blank=True)
     
+    # Latest due_reminder sent for the loan, so the scheduler never repeats one
+    REMINDER_NONE = 0
+    REMINDER_DUE_SOON = 1
+    REMINDER_OVERDUE = 2
+    REMINDER_CHOICES = [
+        (REMINDER_NONE, 'None'),
+        (REMINDER_DUE_SOON, 'Due soon'),
+        (REMINDER_OVERDUE, 'Overdue'),
+    ]
+    reminder_stage = models.PositiveSmallIntegerField(choices=REMINDER_CHOICES, default=REMINDER_NONE)
+    
+    class Meta:
+        indexes = [
+            # Range scan of accepted loans by due date for the reminder scheduler
+            models.Index(fields=['status', 'return_date'], name='bookrequest_status_due_idx'),
+        ]
+    
     def __str__(self):
         return f"{self.borrower.username} requests {self.book.title}"
 
@@ -116,6 +546,16 @@ class Notification(models.Model):
         ('new_message', 'New Message'),
     ]
     
+    # Types shown in the notification list and counted in its badge; messages have their own
+    LISTED_TYPES = [
+        'friend_request',
+        'book_request',
+        'request_update',
+        'due_reminder',
+        'book_rating',
+        'book_review',
+    ]
+    
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     notification_type = models.CharField(max_length=20, choices=TYPE_CHOICES)
     message = models.TextField()
@@ -129,47 +569,236 @@ class Notification(models.Model):
     related_friendship = models.ForeignKey(Friendship, on_delete=models.SET_NULL, null=True, blank=True)
     related_book_review = models.ForeignKey('BookReview', on_delete=models.SET_NULL, null=True, blank=True)
     related_message = models.ForeignKey('Message_Chat.Message', on_delete=models.SET_NULL, null=True, blank=True, related_name='notifications')
+    
+    # Number of events coalesced into this notification
+    count = models.PositiveIntegerField(default=1)
+    
+    # Link target resolved when the notification is written, so listing and
+    # following notifications never walks the reference fields
+    target_url = models.CharField(max_length=255, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', '-created_at', '-id'], name='notification_user_created_idx'),
+            # Serves the pruning job's scan for expired read notifications
+            models.Index(fields=['read', 'created_at'], name='notification_read_created_idx'),
+        ]
+        constraints = [
+            # At most one unread message notification per conversation, updated in place
+            models.UniqueConstraint(
+                fields=['user', 'related_user'],
+                condition=Q(notification_type='new_message', read=False),
+                name='unique_unread_message_notification'
+            )
+        ]
 
     def __str__(self):
         return f"{self.notification_type} for {self.user.username}"
 
+    def save(self, *args, **kwargs):
+        if not self.target_url:
+            self.target_url = self.get_notification_url()
+        super().save(*args, **kwargs)
+
+    @staticmethod
+    def create_or_coalesce(user, notification_type, message, **related):
+        """Create a notification, or refresh the user's unread one about the same objects.
+
+        Repeated events from one source, like toggling a rating back and forth,
+        keep updating a single row instead of adding one per click. Digests
+        folding several events are never overwritten.
+        """
+        existing = Notification.objects.filter(
+            user=user,
+            notification_type=notification_type,
+            read=False,
+            count=1,
+            **related
+        ).order_by('-id').first()
+        if existing is None:
+            return Notification.objects.create(
+                user=user,
+                notification_type=notification_type,
+                message=message,
+                **related
+            )
+        existing.message = message
+        existing.created_at = timezone.now()
+        Notification.objects.filter(pk=existing.pk).update(message=existing.message, created_at=existing.created_at)
+        return existing
+
+    @staticmethod
+    def bulk_deliver(notifications):
+        """Insert many new notifications at once with what post_save would have done.
+
+        Fills in target_url, moves the unread counters with one update per
+        distinct delta and pushes the notifications to open streams.
+        """
+        from collections import Counter
+        from .counters import counters_changed
+        from .signals import publish_notification
+
+        for notification in notifications:
+            if not notification.target_url:
+                notification.target_url = notification.get_notification_url()
+        notifications = Notification.objects.bulk_create(notifications)
+
+        unread = Counter(
+            notification.user_id for notification in notifications
+            if not notification.read and notification.notification_type in Notification.LISTED_TYPES
+        )
+        by_delta = {}
+        for user_id, delta in unread.items():
+            by_delta.setdefault(delta, []).append(user_id)
+        for delta, user_ids in by_delta.items():
+            NotificationCounter.objects.filter(user_id__in=user_ids).update(unread=F('unread') + delta)
+
+        for notification in notifications:
+            if notification.notification_type != 'new_message':
+                publish_notification(notification)
+        counters_changed(*{notification.user_id for notification in notifications})
+        return notifications
+
+    @staticmethod
+    def notify_new_message(message):
+        """Create the receiver's unread notification for the conversation, or bump its count"""
+        unread = Notification.objects.filter(
+            user_id=message.receiver_id,
+            related_user_id=message.sender_id,
+            notification_type='new_message',
+            read=False
+        )
+        bump = {
+            'count': F('count') + 1,
+            'message': Concat(
+                Cast(F('count') + 1, CharField()),
+                Value(f' new messages from {message.sender.username}')
+            ),
+            'related_message': message,
+            'created_at': message.timestamp,
+        }
+        if unread.update(**bump):
+            return
+        try:
+            with transaction.atomic():
+                Notification.objects.create(
+                    user_id=message.receiver_id,
+                    notification_type='new_message',
+                    message=f'New message from {message.sender.username}',
+                    related_user_id=message.sender_id,
+                    related_message=message
+                )
+        except IntegrityError:
+            # A concurrent message created the notification first
+            unread.update(**bump)
+
+    @staticmethod
+    def mark_messages_read(user, sender):
+        """Mark the user's unread notification for messages from sender as read"""
+        Notification.objects.filter(
+            user=user,
+            related_user=sender,
+            notification_type='new_message',
+            read=False
+        ).update(read=True)
+
     @staticmethod
     def get_user_notifications(user):
         """Get all notifications for a user except message notifications"""
         return Notification.objects.filter(
             user=user,
-            notification_type__in=[
-                'friend_request',
-                'book_request',
-                'request_update',
-                'due_reminder',
-                'book_rating',
-                'book_review'
-            ]
+            notification_type__in=Notification.LISTED_TYPES
         ).order_by('-created_at')
 
+    @staticmethod
+    def encode_cursor(notification):
+        """Build the opaque keyset cursor pointing just after a notification"""
+        micros = (notification.created_at - datetime(1970, 1, 1, tzinfo=dt_timezone.utc)) // timedelta(microseconds=1)
+        return f'{micros}-{notification.id}'
+
+    @staticmethod
+    def decode_cursor(cursor):
+        """Parse a cursor from encode_cursor into (created_at, id), or None if malformed"""
+        try:
+            micros, notification_id = cursor.split('-')
+            created_at = datetime(1970, 1, 1, tzinfo=dt_timezone.utc) + timedelta(microseconds=int(micros))
+            return created_at, int(notification_id)
+        except (AttributeError, ValueError, OverflowError):
+            return None
+
+    @staticmethod
+    def get_page(user, after=None, limit=20):
+        """Get one page of the user's notifications, newest first, after a keyset cursor.
+
+        Returns (notifications, has_more). Rows written before target_url existed
+        get it filled in one batched update.
+        """
+        notifications = Notification.get_user_notifications(user).select_related(
+            'related_user',
+            'related_book__owner',
+            'related_book_request',
+            'related_friendship',
+            'related_book_review',
+        ).order_by('-created_at', '-id')
+        if after:
+            created_at, notification_id = after
+            notifications = notifications.filter(
+                Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=notification_id)
+            )
+        page = list(notifications[:limit + 1])
+        has_more = len(page) > limit
+        page = page[:limit]
+
+        missing = [notification for notification in page if not notification.target_url]
+        for notification in missing:
+            notification.target_url = notification.get_notification_url()
+        Notification.objects.bulk_update(missing, ['target_url'])
+        return page, has_more
+
+    def mark_read(self):
+        """Mark the notification read, keeping the unread counter in step"""
+        from .counters import counters_changed
+
+        if not Notification.objects.filter(pk=self.pk, read=False).update(read=True):
+            return
+        self.read = True
+        if self.notification_type in Notification.LISTED_TYPES:
+            NotificationCounter.adjust(self.user_id, -1)
+        counters_changed(self.user_id)
+
+    @staticmethod
+    def mark_all_read(user):
+        """Mark every listed notification of the user read; returns how many changed"""
+        from .counters import counters_changed
+
+        updated = Notification.get_user_notifications(user).filter(read=False).update(read=True)
+        if updated:
+            NotificationCounter.adjust(user, -updated)
+            counters_changed(getattr(user, 'pk', user))
+        return updated
+
     def get_notification_url(self):
         if self.notification_type == 'friend_request':
-            if self.related_friendship:
+            if self.related_friendship_id:
                 return reverse('core:friend_requests')
             elif self.related_user:
                 return reverse('core:profile', kwargs={'username': self.related_user.username})
             return reverse('core:dashboard')
             
         elif self.notification_type == 'book_request':
-            if self.related_book_request:
+            if self.related_book_request_id:
                 return reverse('core:book_requests')
             elif self.related_book:
                 return reverse('core:library', kwargs={'username': self.related_book.owner.username})
             return reverse('core:dashboard')
             
         elif self.notification_type == 'request_update':
-            if self.related_book_request:
+            if self.related_book_request_id:
                 return reverse('core:book_requests')
             return reverse('core:dashboard')
             
         elif self.notification_type == 'due_reminder':
-            if self.related_book_request:
+            if self.related_book_request_id:
                 return reverse('core:book_requests')
             return reverse('core:dashboard')
             
@@ -180,12 +809,121 @@ class Notification(models.Model):
             
         elif self.notification_type == 'book_review':
             if self.related_book_review:
-                return reverse('core:book_detail', kwargs={'book_id': self.related_book_review.book.id})
+                return reverse('core:book_detail', kwargs={'book_id': self.related_book_review.book_id})
             return reverse('core:dashboard')
             
         elif self.notification_type == 'new_message':
-            if self.related_message:
+            if self.related_message_id and self.related_user:
                 return reverse('message_chat:chat_detail', kwargs={'username': self.related_user.username})
             return reverse('message_chat:chat_list')
             
         return reverse('core:dashboard')
+
+
+class NotificationOutbox(models.Model):
+    """A notification waiting to be delivered by the drain_outbox worker.
+
+    Views write it in the same transaction as the change it announces, so a
+    rolled back change never notifies and a committed one always does, while
+    creating the notification itself happens off the request path.
+    """
+    MAX_ATTEMPTS = 5
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    notification_type = models.CharField(max_length=20, choices=Notification.TYPE_CHOICES)
+    message = models.TextField()
+    related_user = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    related_book = models.ForeignKey(Book, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    related_book_request = models.ForeignKey(BookRequest, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    related_friendship = models.ForeignKey(Friendship, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    related_book_review = models.ForeignKey('BookReview', on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    # Refresh the user's unread notification about the same objects instead of adding one
+    coalesce = models.BooleanField(default=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    # Failed deliveries stay in the outbox and are retried up to MAX_ATTEMPTS times
+    attempts = models.PositiveSmallIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+
+    def __str__(self):
+        return f"Pending {self.notification_type} for {self.user_id}"
+
+    @staticmethod
+    def enqueue(user, notification_type, message, coalesce=False, **related):
+        """Queue a notification; call inside the transaction of the change it is about"""
+        return NotificationOutbox.objects.create(
+            user=user,
+            notification_type=notification_type,
+            message=message,
+            coalesce=coalesce,
+            **related
+        )
+
+    def related_fields(self):
+        return {
+            'related_user': self.related_user,
+            'related_book': self.related_book,
+            'related_book_request': self.related_book_request,
+            'related_friendship': self.related_friendship,
+            'related_book_review': self.related_book_review,
+        }
+
+    def to_notification(self):
+        return Notification(
+            user_id=self.user_id,
+            notification_type=self.notification_type,
+            message=self.message,
+            **self.related_fields()
+        )
+
+
+class NotificationCounter(models.Model):
+    """Denormalized number of unread listed notifications of a user.
+
+    Kept in step with F() updates wherever notifications are created, read or
+    deleted, so rendering the badge is a primary key lookup. The
+    reconcile_notification_counters command repairs any drift.
+    """
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name='notification_counter')
+    unread = models.IntegerField(default=0)
+    # Bumped by counters_changed whenever any badge counter changes; the /counters/ ETag
+    version = models.PositiveBigIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.unread} unread notifications for {self.user_id}"
+
+    @staticmethod
+    def count_unread(user):
+        return Notification.get_user_notifications(user).filter(read=False).count()
+
+    @staticmethod
+    def adjust(user, delta, seed=True):
+        """Add delta to the user's counter, seeding it from a full count if it has no row yet.
+
+        With seed=False a missing row is left alone, as when a deleted user's
+        counter cascades away before their notifications do.
+        """
+        user_id = getattr(user, 'pk', user)
+        if NotificationCounter.objects.filter(user_id=user_id).update(unread=F('unread') + delta) or not seed:
+            return
+        # The count already includes the change that triggered this call
+        counter, created = NotificationCounter.objects.get_or_create(
+            user_id=user_id,
+            defaults={'unread': NotificationCounter.count_unread(user_id)}
+        )
+        if not created:
+            # Seeded concurrently, possibly before our change was visible
+            NotificationCounter.objects.filter(user_id=user_id).update(unread=F('unread') + delta)
+
+    @staticmethod
+    def get_unread(user):
+        """Unread listed notifications of the user, read by primary key"""
+        user_id = getattr(user, 'pk', user)
+        unread = NotificationCounter.objects.filter(user_id=user_id).values_list('unread', flat=True).first()
+        if unread is None:
+            counter, created = NotificationCounter.objects.get_or_create(
+                user_id=user_id,
+                defaults={'unread': NotificationCounter.count_unread(user_id)}
+            )
+            unread = counter.unread
+        return max(unread, 0)
@@ -0,0 +1,68 @@
+from django.contrib.auth.models import User
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.urls import reverse
+from . import friends
+from .counters import counters_changed
+from .events import broker, publish_on_commit
+from .models import Book, BookRequest, FeedItem, FriendEdge, Friendship, FriendSuggestion, Notification, NotificationCounter
+
+
+def publish_notification(notification):
+    """Push a new notification to the user's open streams"""
+    if not broker.has_subscribers(notification.user_id):
+        return
+    publish_on_commit(notification.user_id, 'notification', {
+        'id': notification.id,
+        'type': notification.notification_type,
+        'type_display': notification.get_notification_type_display(),
+        'message': notification.message,
+        'url': reverse('core:notification_redirect', kwargs={'notification_id': notification.id}),
+    })
+
+
+@receiver(post_save, sender=Notification)
+def push_new_notification(sender, instance, created, **kwargs):
+    """Push new notifications and the updated badge counters to open streams"""
+    if created and instance.notification_type != 'new_message':
+        publish_notification(instance)
+    if created and not instance.read and instance.notification_type in Notification.LISTED_TYPES:
+        NotificationCounter.adjust(instance.user_id, 1)
+    counters_changed(instance.user_id)
+
+
+@receiver(post_delete, sender=Notification)
+def notification_deleted(sender, instance, **kwargs):
+    # Deleting read notifications, as pruning does in bulk, changes no counter.
+    # Never seed here: deleting a user removes their counter before their notifications
+    if not instance.read and instance.notification_type in Notification.LISTED_TYPES:
+        NotificationCounter.adjust(instance.user_id, -1, seed=False)
+        counters_changed(instance.user_id)
+
+
+@receiver(post_save, sender=Friendship)
+@receiver(post_delete, sender=Friendship)
+def friendship_changed(sender, instance, **kwargs):
+    if kwargs.get('created'):
+        FriendSuggestion.forget_pair(instance.sender_id, instance.receiver_id)
+    FriendEdge.sync(instance.sender_id, instance.receiver_id)
+    friends.invalidate(instance.sender_id, instance.receiver_id)
+    counters_changed(instance.receiver_id)
+
+
+@receiver(post_save, sender=Book)
+def book_shared(sender, instance, created, **kwargs):
+    if created:
+        FeedItem.fan_out(instance)
+
+
+@receiver(post_save, sender=BookRequest)
+@receiver(post_delete, sender=BookRequest)
+def book_request_changed(sender, instance, **kwargs):
+    counters_changed(instance.book.owner_id)
+
+
+@receiver(post_save, sender=User)
+def create_notification_counter(sender, instance, created, **kwargs):
+    if created:
+        NotificationCounter.objects.bulk_create([NotificationCounter(user=instance)], ignore_conflicts=True)
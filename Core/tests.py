@@ -1,9 +1,24 @@
-from django.test import TestCase, Client, override_settings
+from django.test import TestCase, TransactionTestCase, Client, override_settings
 from django.urls import reverse
 from django.contrib.auth.models import User
+from django.contrib.messages import get_messages
 from django.core.files.uploadedfile import SimpleUploadedFile
-from .models import UserProfile, Book, Friendship, Notification
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from . import friends
+from .counters import counters_changed, get_counters
+from .events import broker, format_event
+from .user_state import UserState
+from .models import UserProfile, Book, BookRating, BookReview, FeedItem, FriendEdge, Friendship, FriendSuggestion, Notification, NotificationCounter, NotificationOutbox, BookRequest
+from datetime import timedelta
+from io import StringIO
+from unittest.mock import patch
+import asyncio
 import tempfile
+import time
 import shutil
 import os
 from django.conf import settings
@@ -41,6 +56,8 @@ class BaseTestCase(TestCase):
 
     def setUp(self):
         self.client = Client()
+        # Cached friend sets are keyed by user id, which the test database reuses
+        cache.clear()
         # Create test image
         self.test_image = SimpleUploadedFile(
             name='test_image.jpg',
@@ -428,6 +445,7 @@ class NotificationTests(BaseTestCase):
     def test_notification_creation_on_friend_request(self):
         self.client.login(username='testuser', password='testpass123')
         self.client.post(reverse('core:friend_add', kwargs={'username': 'otheruser'}))
+        call_command('drain_outbox', stdout=StringIO())
         
         notification = Notification.objects.filter(
             user=self.other_user,
@@ -437,6 +455,856 @@ class NotificationTests(BaseTestCase):
         self.assertIsNotNone(notification)
         self.assertIn('friend request', notification.message.lower())
 
+    def test_unread_counter_follows_notifications(self):
+        self.assertEqual(NotificationCounter.objects.get(user=self.user).unread, 1)
+        second = Notification.objects.create(user=self.user, notification_type='book_request', message='Second')
+        Notification.objects.create(user=self.user, notification_type='new_message', message='Not listed')
+        self.assertEqual(NotificationCounter.get_unread(self.user), 2)
+
+        self.client.login(username='testuser', password='testpass123')
+        self.client.get(reverse('core:notification_redirect', kwargs={'notification_id': second.id}))
+        self.client.get(reverse('core:notification_redirect', kwargs={'notification_id': second.id}))
+        self.assertEqual(NotificationCounter.get_unread(self.user), 1)
+
+        self.client.post(reverse('core:notifications'))
+        self.assertEqual(NotificationCounter.get_unread(self.user), 0)
+
+    def test_deleting_unread_notification_decrements_counter(self):
+        self.notification.delete()
+        self.assertEqual(NotificationCounter.get_unread(self.user), 0)
+
+    def test_badge_is_a_primary_key_lookup(self):
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(NotificationCounter.get_unread(self.user), 1)
+        self.assertEqual(len(context.captured_queries), 1)
+        self.assertNotIn('COUNT(', context.captured_queries[0]['sql'].upper())
+
+    def test_target_url_is_resolved_on_write(self):
+        book = Book.objects.create(
+            owner=self.other_user, title='Dune', author='Frank Herbert', genre='Sci-Fi', condition='good'
+        )
+        notification = Notification.objects.create(
+            user=self.user, notification_type='book_rating', message='Rated', related_book=book
+        )
+        self.assertEqual(notification.target_url, reverse('core:library', kwargs={'username': 'otheruser'}))
+
+        self.client.login(username='testuser', password='testpass123')
+        response = self.client.get(reverse('core:notification_redirect', kwargs={'notification_id': notification.id}))
+        self.assertRedirects(response, notification.target_url, fetch_redirect_response=False)
+
+    def test_notifications_page_is_paginated_with_bounded_queries(self):
+        book = Book.objects.create(
+            owner=self.other_user, title='Dune', author='Frank Herbert', genre='Sci-Fi', condition='good'
+        )
+        for index in range(30):
+            Notification.objects.create(
+                user=self.user, notification_type='book_request', message=f'Request {index}', related_book=book
+            )
+        # Rows written before target_url existed are resolved in one batched pass
+        Notification.objects.update(target_url='')
+
+        self.client.login(username='testuser', password='testpass123')
+        with patch('Core.views.NOTIFICATIONS_PAGE_SIZE', 10):
+            with CaptureQueriesContext(connection) as first_page:
+                response = self.client.get(reverse('core:notifications'))
+            seen = [notification.id for notification in response.context['notifications']]
+            while response.context['next_cursor']:
+                response = self.client.get(reverse('core:notifications'), {'after': response.context['next_cursor']})
+                seen += [notification.id for notification in response.context['notifications']]
+
+            with CaptureQueriesContext(connection) as later_page:
+                self.client.get(reverse('core:notifications'))
+
+        self.assertEqual(len(seen), 31)
+        self.assertEqual(seen, list(
+            Notification.objects.filter(user=self.user).order_by('-created_at', '-id').values_list('id', flat=True)
+        ))
+        self.assertFalse(Notification.objects.filter(target_url='').exists())
+        # Resolving the missing URLs costs one bulk update, not a query per row
+        self.assertLessEqual(len(first_page.captured_queries), len(later_page.captured_queries) + 3)
+        self.assertLess(len(later_page.captured_queries), 10)
+
+    def test_notifications_page_rejects_bad_cursor(self):
+        self.client.login(username='testuser', password='testpass123')
+        response = self.client.get(reverse('core:notifications'), {'after': 'nope'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_reconcile_repairs_drift(self):
+        NotificationCounter.objects.filter(user=self.user).update(unread=7)
+        call_command('reconcile_notification_counters', stdout=StringIO())
+        self.assertEqual(NotificationCounter.get_unread(self.user), 1)
+        self.assertEqual(NotificationCounter.get_unread(self.other_user), 0)
+
+class NotificationCounterDeletionTests(TransactionTestCase):
+    # TestCase would defer the foreign key check past the end of the test
+    def setUp(self):
+        cache.clear()
+
+    def test_deleting_a_user_with_unread_notifications(self):
+        user = User.objects.create_user(username='testuser', password='testpass123')
+        sender = User.objects.create_user(username='sender', password='testpass123')
+        Notification.objects.create(user=user, notification_type='friend_request', message='Hi', related_user=sender)
+        self.assertEqual(NotificationCounter.get_unread(user), 1)
+
+        user_id = user.pk
+        user.delete()
+        self.assertFalse(NotificationCounter.objects.filter(user_id=user_id).exists())
+        self.assertFalse(Notification.objects.exists())
+
+        # Deleting a surviving user's notification still keeps the counter in step
+        notification = Notification.objects.create(user=sender, notification_type='friend_request', message='Hi')
+        self.assertEqual(NotificationCounter.get_unread(sender), 1)
+        notification.delete()
+        self.assertEqual(NotificationCounter.get_unread(sender), 0)
+
+
+class NotificationPruningTests(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.owner = User.objects.create_user(username='owner', password='testpass123')
+        self.book = Book.objects.create(
+            owner=self.owner, title='Nexus', author='Yuval Noah Harari', genre='History', condition='good'
+        )
+        self.friends = []
+        for index in range(3):
+            friend = User.objects.create_user(username=f'reader{index}', password='testpass123')
+            Friendship.objects.create(sender=friend, receiver=self.owner, status='accepted')
+            self.friends.append(friend)
+
+    def prune(self, **options):
+        call_command('prune_notifications', stdout=StringIO(), **options)
+
+    def test_rating_toggles_update_one_notification(self):
+        self.client.login(username='reader0', password='testpass123')
+        for view in ('core:book_like', 'core:book_dislike', 'core:book_like'):
+            self.client.get(reverse(view, kwargs={'book_id': self.book.id}))
+        call_command('drain_outbox', stdout=StringIO())
+
+        notification = Notification.objects.get(user=self.owner)
+        self.assertEqual(notification.message, "reader0 liked your book 'Nexus'")
+        self.assertEqual(NotificationCounter.get_unread(self.owner), 1)
+
+    def test_ratings_collapse_into_digest(self):
+        for friend in self.friends:
+            Notification.create_or_coalesce(
+                self.owner, 'book_rating', f"{friend.username} liked your book 'Nexus'",
+                related_user=friend, related_book=self.book
+            )
+        self.prune()
+
+        digest = Notification.objects.get(user=self.owner)
+        self.assertEqual(digest.message, "3 friends liked your book 'Nexus'")
+        self.assertEqual(digest.count, 3)
+        self.assertEqual(NotificationCounter.get_unread(self.owner), 1)
+
+    def test_rating_after_a_digest_keeps_the_digest(self):
+        for friend in self.friends[:2]:
+            Notification.create_or_coalesce(
+                self.owner, 'book_rating', f"{friend.username} liked your book 'Nexus'",
+                related_user=friend, related_book=self.book
+            )
+        self.prune()
+        digest = Notification.objects.get(user=self.owner)
+        self.assertIsNone(digest.related_user)
+
+        # The second friend changes their mind after the digest was written
+        Notification.create_or_coalesce(
+            self.owner, 'book_rating', f"{self.friends[1].username} disliked your book 'Nexus'",
+            related_user=self.friends[1], related_book=self.book
+        )
+        digest.refresh_from_db()
+        self.assertEqual(digest.message, "2 friends liked your book 'Nexus'")
+        self.assertEqual(digest.count, 2)
+        self.assertEqual(Notification.objects.filter(user=self.owner).count(), 2)
+        self.assertEqual(NotificationCounter.get_unread(self.owner), 2)
+
+        self.prune()
+        digest = Notification.objects.get(user=self.owner)
+        self.assertEqual(digest.message, "3 friends rated your book 'Nexus'")
+        self.assertEqual(NotificationCounter.get_unread(self.owner), 1)
+
+    def test_unread_backlog_is_capped(self):
+        for index in range(5):
+            Notification.objects.create(user=self.owner, notification_type='due_reminder', message=f'Due {index}')
+        self.prune(max_unread=2)
+
+        unread = Notification.objects.filter(user=self.owner, read=False)
+        self.assertEqual(sorted(unread.values_list('message', flat=True)), ['Due 3', 'Due 4'])
+        self.assertEqual(NotificationCounter.get_unread(self.owner), 2)
+
+    def test_expired_read_notifications_are_deleted_in_batches(self):
+        for index in range(5):
+            Notification.objects.create(user=self.owner, notification_type='due_reminder', message=f'Due {index}')
+        Notification.mark_all_read(self.owner)
+        Notification.objects.update(created_at=timezone.now() - timedelta(days=40))
+        Notification.objects.create(user=self.owner, notification_type='due_reminder', message='Unread')
+        self.prune(batch_size=2)
+
+        self.assertEqual(list(Notification.objects.values_list('message', flat=True)), ['Unread'])
+        self.assertEqual(NotificationCounter.get_unread(self.owner), 1)
+
+
+class DueReminderTests(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.owner = User.objects.create_user(username='lender', password='testpass123')
+        self.user = User.objects.create_user(username='borrower', password='testpass123')
+        self.today = timezone.localdate()
+
+    def lend(self, title, days):
+        book = Book.objects.create(owner=self.owner, title=title, author='Author', genre='Fiction', condition='good')
+        return BookRequest.objects.create(
+            book=book, borrower=self.user, status='accepted', return_date=self.today + timedelta(days=days)
+        )
+
+    def send(self):
+        call_command('send_due_reminders', stdout=StringIO(), chunk_size=2)
+
+    def test_reminders_for_due_soon_and_overdue_loans(self):
+        soon = self.lend('Soon', 1)
+        late = self.lend('Late', -3)
+        self.lend('Later', 10)
+        BookRequest.objects.create(
+            book=Book.objects.get(title='Later'), borrower=self.user, status='pending', return_date=self.today
+        )
+        self.send()
+
+        reminders = Notification.objects.filter(user=self.user, notification_type='due_reminder')
+        self.assertEqual(
+            {reminder.related_book_request_id: reminder.target_url for reminder in reminders},
+            {soon.id: reverse('core:book_requests'), late.id: reverse('core:book_requests')}
+        )
+        self.assertIn('Please return it to lender', reminders.get(related_book_request=late).message)
+        self.assertEqual(NotificationCounter.get_unread(self.user), 2)
+        self.assertEqual(NotificationCounter.get_unread(self.user), NotificationCounter.count_unread(self.user))
+
+    def test_reruns_do_not_duplicate_reminders(self):
+        for index in range(5):
+            self.lend(f'Book {index}', 0)
+        self.send()
+        self.send()
+
+        self.assertEqual(Notification.objects.filter(notification_type='due_reminder').count(), 5)
+        self.assertEqual(NotificationCounter.get_unread(self.user), 5)
+
+    def test_overdue_reminder_follows_due_soon_reminder(self):
+        loan = self.lend('Soon', 1)
+        self.send()
+        BookRequest.objects.filter(pk=loan.pk).update(return_date=self.today - timedelta(days=1))
+        self.send()
+
+        loan.refresh_from_db()
+        self.assertEqual(loan.reminder_stage, BookRequest.REMINDER_OVERDUE)
+        self.assertEqual(Notification.objects.filter(related_book_request=loan).count(), 2)
+
+
+class NotificationOutboxTests(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.owner = User.objects.create_user(username='owner', password='testpass123')
+        self.reader = User.objects.create_user(username='reader', password='testpass123')
+        self.book = Book.objects.create(
+            owner=self.owner, title='Nexus', author='Yuval Noah Harari', genre='History', condition='good'
+        )
+
+    def drain(self, **options):
+        out = StringIO()
+        call_command('drain_outbox', stdout=out, **options)
+        return out.getvalue()
+
+    def test_views_queue_notifications_until_drained(self):
+        self.client.login(username='reader', password='testpass123')
+        self.client.post(reverse('core:friend_add', kwargs={'username': 'owner'}))
+
+        self.assertFalse(Notification.objects.exists())
+        self.assertEqual(NotificationOutbox.objects.count(), 1)
+
+        self.drain()
+        notification = Notification.objects.get(user=self.owner)
+        self.assertEqual(notification.notification_type, 'friend_request')
+        self.assertEqual(notification.target_url, reverse('core:friend_requests'))
+        self.assertEqual(NotificationCounter.get_unread(self.owner), 1)
+        self.assertFalse(NotificationOutbox.objects.exists())
+
+    def test_rolled_back_change_queues_nothing(self):
+        with self.assertRaises(RuntimeError), transaction.atomic():
+            NotificationOutbox.enqueue(self.owner, 'book_request', 'Request')
+            raise RuntimeError
+        self.assertFalse(NotificationOutbox.objects.exists())
+
+    def test_batches_are_drained_in_order(self):
+        for index in range(5):
+            NotificationOutbox.enqueue(self.owner, 'book_request', f'Request {index}', related_book=self.book)
+        self.assertIn('Delivered 5 notifications', self.drain(batch_size=2))
+        self.assertEqual(
+            list(Notification.objects.order_by('id').values_list('message', flat=True)),
+            [f'Request {index}' for index in range(5)]
+        )
+        self.assertEqual(NotificationCounter.get_unread(self.owner), 5)
+
+    def test_failed_delivery_is_kept_for_retry(self):
+        NotificationOutbox.enqueue(self.owner, 'book_request', 'Fails')
+        NotificationOutbox.enqueue(self.owner, 'book_request', 'Works')
+        original = Notification.get_notification_url
+
+        def broken_url(notification):
+            if notification.message == 'Fails':
+                raise ValueError('broken')
+            return original(notification)
+
+        with patch.object(Notification, 'get_notification_url', broken_url):
+            self.drain()
+
+        self.assertEqual(list(Notification.objects.values_list('message', flat=True)), ['Works'])
+        entry = NotificationOutbox.objects.get()
+        self.assertEqual(entry.attempts, 1)
+        self.assertIn('broken', entry.last_error)
+
+        self.drain()
+        self.assertEqual(Notification.objects.count(), 2)
+        self.assertFalse(NotificationOutbox.objects.exists())
+
+
+class FriendGraphTests(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user(username='testuser', password='testpass123')
+        self.friend = User.objects.create_user(username='friend', password='testpass123')
+        self.stranger = User.objects.create_user(username='stranger', password='testpass123')
+        Friendship.objects.create(sender=self.friend, receiver=self.user, status='accepted')
+
+    def test_friend_ids_are_cached(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(friends.friend_ids(self.user), {self.friend.id})
+        with self.assertNumQueries(0):
+            self.assertTrue(friends.are_friends(self.user, self.friend))
+            self.assertFalse(friends.are_friends(self.user, self.stranger.id))
+
+    def test_friendship_changes_invalidate_both_users(self):
+        self.assertFalse(friends.are_friends(self.stranger, self.user))
+        friendship = Friendship.objects.create(sender=self.user, receiver=self.stranger)
+        friendship.status = 'accepted'
+        friendship.save()
+        self.assertTrue(friends.are_friends(self.stranger, self.user))
+        self.assertEqual(friends.friend_ids(self.user), {self.friend.id, self.stranger.id})
+
+        Friendship.objects.filter(sender=self.friend).delete()
+        self.assertFalse(friends.are_friends(self.user, self.friend))
+        self.assertEqual(friends.friend_ids(self.friend), frozenset())
+
+    def test_missed_invalidation_expires_within_seconds(self):
+        # An unfriend handled by another worker never reaches this process's cache
+        self.assertTrue(friends.are_friends(self.user, self.friend))
+        FriendEdge.objects.all().delete()
+        self.assertTrue(friends.are_friends(self.user, self.friend))
+
+        expired = time.time() + friends.FRIEND_IDS_TIMEOUT + 1
+        with patch('django.core.cache.backends.locmem.time.time', return_value=expired):
+            self.assertFalse(friends.are_friends(self.user, self.friend))
+
+    def test_edges_follow_friendships(self):
+        self.assertEqual(
+            set(FriendEdge.objects.values_list('user_id', 'friend_id')),
+            {(self.user.id, self.friend.id), (self.friend.id, self.user.id)}
+        )
+        reverse_request = Friendship.objects.create(sender=self.user, receiver=self.friend)
+        Friendship.objects.filter(sender=self.friend).delete()
+        self.assertFalse(FriendEdge.objects.exists())
+
+        reverse_request.status = 'accepted'
+        reverse_request.save()
+        self.assertEqual(FriendEdge.objects.count(), 2)
+        reverse_request.status = 'declined'
+        reverse_request.save()
+        self.assertFalse(FriendEdge.objects.exists())
+
+    def test_mutual_friend_counts(self):
+        for name in ('mutual1', 'mutual2'):
+            mutual = User.objects.create_user(username=name, password='testpass123')
+            Friendship.objects.create(sender=self.user, receiver=mutual, status='accepted')
+            Friendship.objects.create(sender=mutual, receiver=self.stranger, status='accepted')
+        Friendship.objects.create(sender=self.friend, receiver=self.stranger, status='accepted')
+
+        with self.assertNumQueries(1):
+            counts = FriendEdge.mutual_counts(self.user, [self.stranger.id, self.friend.id])
+        self.assertEqual(counts, {self.stranger.id: 3})
+
+    def test_unfriending_revokes_chat_access(self):
+        self.client.login(username='testuser', password='testpass123')
+        self.assertEqual(self.client.get(reverse('message_chat:chat_detail', kwargs={'username': 'friend'})).status_code, 200)
+        self.client.post(reverse('core:friend_remove', kwargs={'username': 'friend'}))
+        response = self.client.get(reverse('message_chat:chat_detail', kwargs={'username': 'friend'}))
+        self.assertRedirects(response, reverse('core:dashboard'), fetch_redirect_response=False)
+
+
+class FriendSuggestionTests(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user(username='testuser', password='testpass123')
+        self.friends = [User.objects.create_user(username=f'friend{index}', password='testpass123') for index in range(3)]
+        for friend in self.friends:
+            Friendship.objects.create(sender=self.user, receiver=friend, status='accepted')
+        self.close = User.objects.create_user(username='close', password='testpass123')
+        self.distant = User.objects.create_user(username='distant', password='testpass123')
+        self.pending = User.objects.create_user(username='pending', password='testpass123')
+        for friend in self.friends[:2]:
+            Friendship.objects.create(sender=friend, receiver=self.close, status='accepted')
+            Friendship.objects.create(sender=friend, receiver=self.pending, status='accepted')
+        Friendship.objects.create(sender=self.friends[2], receiver=self.distant, status='accepted')
+        Friendship.objects.create(sender=self.pending, receiver=self.user)
+
+    def compute(self):
+        call_command('compute_friend_suggestions', stdout=StringIO(), batch_size=2)
+
+    def test_friends_of_friends_ranked_by_mutual_friends(self):
+        self.compute()
+        suggestions = FriendSuggestion.get_for_user(self.user)
+        self.assertEqual(
+            [(suggestion.suggested, suggestion.mutual_friends) for suggestion in suggestions],
+            [(self.close, 2), (self.distant, 1)]
+        )
+
+    def test_shared_library_breaks_ties(self):
+        Friendship.objects.create(sender=self.friends[2], receiver=self.close, status='accepted')
+        Friendship.objects.create(sender=self.friends[0], receiver=self.distant, status='accepted')
+        Friendship.objects.create(sender=self.friends[1], receiver=self.distant, status='accepted')
+        for owner in (self.user, self.distant):
+            book = Book.objects.create(owner=owner, title='Dune', author='Frank Herbert', genre='Sci-Fi', condition='good')
+        BookRating.objects.create(user=self.user, book=book, rating='like')
+        BookRating.objects.create(user=self.distant, book=book, rating='like')
+        self.compute()
+
+        best = FriendSuggestion.get_for_user(self.user)[0]
+        self.assertEqual(best.suggested, self.distant)
+        self.assertEqual((best.mutual_friends, best.shared_genres, best.shared_likes), (3, 1, 1))
+
+    def test_suggestions_are_replaced_and_dropped_on_contact(self):
+        self.compute()
+        self.compute()
+        self.assertEqual(FriendSuggestion.objects.filter(user=self.user).count(), 2)
+
+        Friendship.objects.create(sender=self.user, receiver=self.close)
+        self.assertEqual([suggestion.suggested for suggestion in FriendSuggestion.get_for_user(self.user)], [self.distant])
+
+        Friendship.objects.all().delete()
+        self.compute()
+        self.assertFalse(FriendSuggestion.objects.exists())
+
+    def test_friends_page_shows_suggestions(self):
+        self.compute()
+        self.client.login(username='testuser', password='testpass123')
+        response = self.client.get(reverse('core:friends_list'))
+        self.assertContains(response, 'People You May Know')
+        self.assertContains(response, '@close')
+        self.assertContains(response, '2 mutual friends')
+
+
+class BulkFriendTests(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user(username='testuser', email='test@example.com', password='testpass123')
+        self.client.login(username='testuser', password='testpass123')
+
+    def test_import_sends_requests_with_few_queries(self):
+        User.objects.bulk_create([
+            User(username=f'contact{index}', email=f'contact{index}@example.com') for index in range(500)
+        ])
+        contacts = '\n'.join(
+            f'contact{index}' if index % 2 else f'Contact{index}@Example.com' for index in range(500)
+        )
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(reverse('core:friend_import'), {'contacts': contacts + '\nnobody'})
+        self.assertRedirects(response, reverse('core:friend_requests'), fetch_redirect_response=False)
+        self.assertLess(len(queries), 25)
+
+        self.assertEqual(Friendship.objects.filter(sender=self.user, status='pending').count(), 500)
+        self.assertEqual(NotificationOutbox.objects.filter(notification_type='friend_request').count(), 500)
+        self.assertIn('nobody', [str(message) for message in get_messages(response.wsgi_request)][-1])
+
+    def test_import_skips_existing_connections_and_reads_csv(self):
+        friend = User.objects.create_user(username='friend', password='testpass123')
+        requester = User.objects.create_user(username='requester', password='testpass123')
+        User.objects.create_user(username='newcomer', password='testpass123')
+        Friendship.objects.create(sender=friend, receiver=self.user, status='accepted')
+        Friendship.objects.create(sender=requester, receiver=self.user)
+
+        upload = SimpleUploadedFile('contacts.csv', b'name,notes\nfriend,old\nrequester,x\nnewcomer,new\ntestuser,me\n')
+        self.client.post(reverse('core:friend_import'), {'contacts_file': upload})
+
+        self.assertEqual(
+            list(Friendship.objects.filter(sender=self.user).values_list('receiver__username', flat=True)),
+            ['newcomer']
+        )
+
+    def test_accept_all_with_one_update(self):
+        senders = [User.objects.create_user(username=f'sender{index}', password='testpass123') for index in range(3)]
+        for sender in senders:
+            Friendship.objects.create(sender=sender, receiver=self.user)
+        friends.friend_ids(self.user)
+
+        self.client.post(reverse('core:friend_respond_all'), {'action': 'accept'})
+
+        self.assertEqual(Friendship.objects.filter(receiver=self.user, status='accepted').count(), 3)
+        self.assertEqual(friends.friend_ids(self.user), {sender.id for sender in senders})
+        self.assertTrue(friends.are_friends(senders[0], self.user))
+        self.assertEqual(FriendEdge.objects.count(), 6)
+        call_command('drain_outbox', stdout=StringIO())
+        self.assertEqual(
+            Notification.objects.filter(notification_type='request_update', message='testuser accepted your friend request.').count(),
+            3
+        )
+
+    def test_decline_all(self):
+        sender = User.objects.create_user(username='sender', password='testpass123')
+        Friendship.objects.create(sender=sender, receiver=self.user)
+        self.client.post(reverse('core:friend_respond_all'), {'action': 'decline'})
+
+        self.assertEqual(Friendship.objects.get(sender=sender).status, 'declined')
+        self.assertFalse(FriendEdge.objects.exists())
+        self.assertEqual(NotificationOutbox.objects.get().message, 'testuser declined your friend request.')
+
+
+class LibraryPageTests(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.owner = User.objects.create_user(username='collector', password='testpass123')
+        self.user = User.objects.create_user(username='testuser', password='testpass123')
+        Friendship.objects.create(sender=self.user, receiver=self.owner, status='accepted')
+        self.books = Book.objects.bulk_create([
+            Book(
+                owner=self.owner,
+                title=f'Book {index:03d}',
+                author='Author',
+                genre='History' if index % 3 == 0 else 'Fiction',
+                condition='good' if index % 2 else 'fair',
+                available=index % 5 != 0
+            )
+            for index in range(60)
+        ])
+        # bulk_create stamps one created_at on every row; the id breaks the ties
+        BookRequest.objects.create(book=self.books[59], borrower=self.user, return_date=timezone.localdate())
+        self.client.login(username='testuser', password='testpass123')
+
+    def walk(self, params, expected_queries=None):
+        url = reverse('core:library', kwargs={'username': 'collector'})
+        titles, query_counts = [], []
+        response = None
+        while response is None or response.context['next_cursor']:
+            page_params = dict(params)
+            if response is not None:
+                page_params['after'] = response.context['next_cursor']
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url, page_params)
+            query_counts.append(len(queries))
+            titles += [book.title for book in response.context['books']]
+        return titles, query_counts, response
+
+    def test_pages_cover_every_book_with_constant_queries(self):
+        titles, query_counts, response = self.walk({})
+        self.assertEqual(titles, [f'Book {index:03d}' for index in reversed(range(60))])
+        self.assertEqual(len(set(query_counts)), 1)
+
+        first_page = self.client.get(reverse('core:library', kwargs={'username': 'collector'}))
+        self.assertEqual(first_page.context['book_request_status'][self.books[59].id], 'pending')
+        self.assertContains(first_page, 'Request Pending')
+
+    def test_sorts_and_filters(self):
+        titles, query_counts, response = self.walk({'sort': 'title'})
+        self.assertEqual(titles, [f'Book {index:03d}' for index in range(60)])
+
+        titles, query_counts, response = self.walk({'genre': 'History', 'condition': 'fair', 'sort': 'oldest'})
+        self.assertEqual(titles, [f'Book {index:03d}' for index in range(0, 60, 6)])
+
+        titles, query_counts, response = self.walk({'available': 'no'})
+        self.assertEqual(titles, [f'Book {index:03d}' for index in reversed(range(0, 60, 5))])
+        self.assertEqual(response.context['selected']['available'], 'no')
+
+    def test_invalid_cursor_is_rejected(self):
+        response = self.client.get(reverse('core:library', kwargs={'username': 'collector'}), {'after': 'garbage'})
+        self.assertEqual(response.status_code, 400)
+
+
+class BookCounterTests(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.owner = User.objects.create_user(username='owner', password='testpass123')
+        self.user = User.objects.create_user(username='testuser', password='testpass123')
+        Friendship.objects.create(sender=self.user, receiver=self.owner, status='accepted')
+        self.book = Book.objects.create(owner=self.owner, title='Dune', author='Frank Herbert', genre='Sci-Fi', condition='good')
+        self.client.login(username='testuser', password='testpass123')
+
+    def counters(self):
+        self.book.refresh_from_db()
+        return self.book.likes, self.book.dislikes, self.book.review_count
+
+    def test_switching_rating_moves_the_count(self):
+        self.client.get(reverse('core:book_like', kwargs={'book_id': self.book.id}))
+        self.client.get(reverse('core:book_like', kwargs={'book_id': self.book.id}))
+        self.assertEqual(self.counters(), (1, 0, 0))
+        self.assertEqual(NotificationOutbox.objects.count(), 1)
+
+        self.client.get(reverse('core:book_dislike', kwargs={'book_id': self.book.id}))
+        self.assertEqual(self.counters(), (0, 1, 0))
+        self.assertEqual(self.book.average_rating, 0)
+        self.assertEqual(self.book.total_ratings, 1)
+
+    def test_reviews_are_counted(self):
+        self.client.post(reverse('core:submit_review', kwargs={'book_id': self.book.id}), {'review_text': 'Great'})
+        self.assertEqual(self.counters(), (0, 0, 1))
+        review = BookReview.objects.get()
+        self.client.get(reverse('core:delete_review', kwargs={'review_id': review.id}))
+        self.assertEqual(self.counters(), (0, 0, 0))
+
+    def test_repair_command_fixes_drift(self):
+        BookRating.objects.create(user=self.user, book=self.book, rating='like')
+        BookReview.objects.create(user=self.user, book=self.book, review_text='Great')
+        Book.objects.filter(pk=self.book.pk).update(dislikes=4)
+
+        out = StringIO()
+        call_command('repair_book_counters', stdout=out)
+        self.assertIn('Repaired the counters of 1 books', out.getvalue())
+        self.assertEqual(self.counters(), (1, 0, 1))
+
+    def test_dashboard_ratings_need_no_queries_per_book(self):
+        for index in range(5):
+            Book.objects.create(owner=self.owner, title=f'Book {index}', author='Author', genre='Fiction', condition='good', likes=index)
+        self.client.get(reverse('core:dashboard'))  # warm the friend id cache
+        with CaptureQueriesContext(connection) as few_books:
+            self.client.get(reverse('core:dashboard'))
+        for index in range(5):
+            Book.objects.create(owner=self.owner, title=f'More {index}', author='Author', genre='Fiction', condition='good', dislikes=index)
+        with CaptureQueriesContext(connection) as more_books:
+            response = self.client.get(reverse('core:dashboard'))
+        self.assertEqual(len(few_books), len(more_books))
+        self.assertEqual(response.context['friend_books'][0].dislikes, 4)
+
+
+class FeedTests(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user(username='testuser', password='testpass123')
+        self.friend = User.objects.create_user(username='friend', password='testpass123')
+        Friendship.objects.create(sender=self.user, receiver=self.friend, status='accepted')
+        self.client.login(username='testuser', password='testpass123')
+
+    def add_book(self, owner, title, **fields):
+        return Book.objects.create(owner=owner, title=title, author='Author', genre='Fiction', condition='good', **fields)
+
+    def feed_titles(self, user):
+        return list(FeedItem.objects.filter(user=user).order_by('-created_at', '-id').values_list('book__title', flat=True))
+
+    def test_new_books_fan_out_to_friends_only(self):
+        stranger = User.objects.create_user(username='stranger', password='testpass123')
+        self.add_book(self.friend, 'Dune')
+        self.add_book(stranger, 'Emma')
+
+        self.assertEqual(self.feed_titles(self.user), ['Dune'])
+        self.assertEqual(self.feed_titles(stranger), [])
+
+    def test_accepting_and_removing_a_friend_updates_the_feed(self):
+        owner = User.objects.create_user(username='owner', password='testpass123')
+        self.add_book(owner, 'Dune')
+        self.add_book(self.user, 'Emma')
+        friendship = Friendship.objects.create(sender=owner, receiver=self.user)
+        self.assertEqual(self.feed_titles(self.user), [])
+
+        self.client.post(reverse('core:friend_accept', kwargs={'request_id': friendship.id}))
+        self.assertEqual(self.feed_titles(self.user), ['Dune'])
+        self.assertEqual(self.feed_titles(owner), ['Emma'])
+
+        self.client.post(reverse('core:friend_remove', kwargs={'username': 'owner'}))
+        self.assertEqual(self.feed_titles(self.user), [])
+        self.assertEqual(self.feed_titles(owner), [])
+
+    def test_accept_all_backfills_feeds(self):
+        senders = [User.objects.create_user(username=f'sender{index}', password='testpass123') for index in range(3)]
+        for sender in senders:
+            self.add_book(sender, f'Book of {sender.username}')
+            Friendship.objects.create(sender=sender, receiver=self.user)
+
+        Friendship.respond_all(self.user, 'accepted')
+        self.assertEqual(len(self.feed_titles(self.user)), 3)
+
+    def test_feed_pages_with_cursor_and_scroll_fragments(self):
+        for index in range(15):
+            self.add_book(self.friend, f'Book {index}')
+        self.add_book(self.friend, 'Lent out', available=False)
+
+        response = self.client.get(reverse('core:dashboard'))
+        self.assertEqual(len(response.context['friend_books']), 12)
+        self.assertEqual(response.context['friend_books'][0].title, 'Book 14')
+        # Coverless books get a placeholder rather than a missing default image
+        self.assertNotContains(response, '<img src=""')
+        self.assertNotContains(response, 'default-book-cover')
+        self.assertIsNotNone(response.context['next_cursor'])
+
+        response = self.client.get(
+            reverse('core:dashboard'), {'after': response.context['next_cursor']},
+            HTTP_X_REQUESTED_WITH='XMLHttpRequest'
+        )
+        self.assertTemplateUsed(response, 'core/includes/_feed_books.html')
+        self.assertTemplateNotUsed(response, 'core/dashboard.html')
+        self.assertEqual([book.title for book in response.context['friend_books']], ['Book 2', 'Book 1', 'Book 0'])
+        self.assertIsNone(response.context['next_cursor'])
+        self.assertNotContains(response, 'Load More')
+
+        response = self.client.get(reverse('core:dashboard'), {'after': 'garbage'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_dashboard_queries_do_not_grow_with_friends(self):
+        self.add_book(self.friend, 'Dune')
+        self.client.get(reverse('core:dashboard'))
+        with CaptureQueriesContext(connection) as few_friends:
+            self.client.get(reverse('core:dashboard'))
+
+        for index in range(30):
+            other = User.objects.create_user(username=f'other{index}', password='testpass123')
+            Friendship.objects.create(sender=other, receiver=self.user, status='accepted')
+            self.add_book(other, f'Book {index}')
+        self.client.get(reverse('core:dashboard'))
+        with CaptureQueriesContext(connection) as many_friends:
+            response = self.client.get(reverse('core:dashboard'))
+
+        self.assertEqual(len(few_friends), len(many_friends))
+        self.assertEqual(len(response.context['friend_books']), 12)
+
+    def test_dashboard_runs_a_fixed_number_of_queries(self):
+        # Session, user, the feed page with its pending-request EXISTS, and the badge counters
+        for size in (3, 12):
+            for index in range(size):
+                book = self.add_book(self.friend, f'Book {size}-{index}')
+                if index % 2:
+                    BookRequest.objects.create(book=book, borrower=self.user, return_date=timezone.now().date())
+            with self.assertNumQueries(4):
+                response = self.client.get(reverse('core:dashboard'))
+            self.assertContains(response, 'Request Pending', count=size // 2)
+
+
+class BookImportTests(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user(username='testuser', password='testpass123')
+        self.friend = User.objects.create_user(username='friend', password='testpass123')
+        Friendship.objects.create(sender=self.user, receiver=self.friend, status='accepted')
+        self.client.login(username='testuser', password='testpass123')
+
+    def test_csv_upload_imports_valid_rows_and_reports_the_rest(self):
+        upload = SimpleUploadedFile('books.csv', (
+            'Title,Author,Genre,Condition,Available\n'
+            'Dune,Frank Herbert,Sci-Fi,Like New,\n'
+            ',Nobody,Fiction,good,yes\n'
+            'Emma,Jane Austen,Classic,mint,no\n'
+            'Beloved,Toni Morrison,Fiction,fair,no\n'
+        ).encode())
+        response = self.client.post(reverse('core:book_import'), {'books_file': upload})
+
+        self.assertEqual(response.context['created'], 2)
+        self.assertEqual(response.context['error_count'], 2)
+        self.assertEqual([line for line, message in response.context['errors']], [3, 4])
+        self.assertIn('title: This field is required.', response.context['errors'][0][1])
+        self.assertEqual(
+            list(Book.objects.filter(owner=self.user).order_by('title').values_list('title', 'condition', 'available')),
+            [('Beloved', 'fair', False), ('Dune', 'like_new', True)]
+        )
+        # bulk_create skips the post_save fan-out, so the import backfills feeds itself
+        self.assertEqual(FeedItem.objects.filter(user=self.friend).count(), 2)
+
+    def test_rejects_unknown_file_types(self):
+        upload = SimpleUploadedFile('books.xlsx', b'title')
+        response = self.client.post(reverse('core:book_import'), {'books_file': upload})
+        self.assertFormError(response.context['form'], 'books_file', 'Upload a .csv, .jsonl or .ndjson file.')
+        self.assertFalse(Book.objects.exists())
+
+    def test_command_imports_json_lines_in_batches(self):
+        path = os.path.join(TEMP_MEDIA_ROOT, 'books.jsonl')
+        with open(path, 'w') as books_file:
+            for index in range(25):
+                books_file.write(f'{{"title": "Book {index}", "author": "Author", "genre": "Fiction", "condition": "good"}}\n')
+            books_file.write('not json\n')
+
+        out, err = StringIO(), StringIO()
+        with CaptureQueriesContext(connection) as queries:
+            call_command('import_books', 'testuser', path, '--batch-size', '10', stdout=out, stderr=err)
+
+        self.assertIn('Imported 25 books for testuser, skipped 1 invalid rows', out.getvalue())
+        self.assertIn('line 26: Not a valid record.', err.getvalue())
+        self.assertEqual(Book.objects.filter(owner=self.user, available=True).count(), 25)
+        inserts = [query for query in queries if query['sql'].startswith('INSERT INTO "Core_book"')]
+        self.assertEqual(len(inserts), 3)
+
+
+class UserStateTests(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user(username='testuser', password='testpass123')
+        self.friend = User.objects.create_user(username='friend', password='testpass123')
+        self.requester = User.objects.create_user(username='requester', password='testpass123')
+        Friendship.objects.create(sender=self.user, receiver=self.friend, status='accepted')
+        Friendship.objects.create(sender=self.requester, receiver=self.user, status='pending')
+        self.book = Book.objects.create(
+            owner=self.friend, title='Dune', author='Frank Herbert', genre='Sci-Fi', condition='good'
+        )
+        BookRequest.objects.create(book=self.book, borrower=self.user, return_date='2030-01-01')
+
+    def test_middleware_runs_natively_in_both_modes(self):
+        from asgiref.sync import iscoroutinefunction
+        from .user_state import UserStateMiddleware
+
+        request = type('Request', (), {'user': self.user})()
+        middleware = UserStateMiddleware(lambda request: request.user_state)
+        self.assertFalse(iscoroutinefunction(middleware))
+        self.assertEqual(middleware(request).user, self.user)
+
+        async def get_response(request):
+            return request.user_state
+
+        middleware = UserStateMiddleware(get_response)
+        self.assertTrue(iscoroutinefunction(middleware))
+        with self.assertNumQueries(0):
+            self.assertEqual(asyncio.run(middleware(request)).user, self.user)
+
+    def test_context_processor_is_lazy(self):
+        from .context_processors import user_state
+
+        request = type('Request', (), {'user': self.user})()
+        with self.assertNumQueries(0):
+            context = user_state(request)
+        with self.assertNumQueries(1):
+            self.assertEqual(context['unread_notifications'](), 0)
+            self.assertEqual(context['user_state'].friend_requests, 1)
+            self.assertEqual(context['user_state'].book_requests, 0)
+
+    def test_facts_are_memoized(self):
+        # Friend ids come from the friend graph cache once it is warm
+        friends.friend_ids(self.user)
+        state = UserState(self.user)
+        with self.assertNumQueries(1):
+            self.assertTrue(state.is_friend(self.friend))
+            self.assertFalse(state.is_friend(self.requester))
+            self.assertEqual(state.friendship_status(self.requester), 'pending')
+            self.assertEqual(state.friend_ids, {self.friend.id})
+        with self.assertNumQueries(1):
+            self.assertTrue(state.has_pending_request(self.book))
+            self.assertEqual(state.book_request_status([self.book]), {self.book.id: 'pending'})
+
+    def test_anonymous_user_state_runs_no_queries(self):
+        from django.contrib.auth.models import AnonymousUser
+
+        state = UserState(AnonymousUser())
+        with self.assertNumQueries(0):
+            self.assertEqual(state.unread_notifications, 0)
+            self.assertFalse(state.is_friend(self.friend))
+            self.assertFalse(state.has_pending_request(self.book))
+
+    def test_views_use_request_state(self):
+        self.client.login(username='testuser', password='testpass123')
+        response = self.client.get(reverse('core:search'), {'q': 'e', 'type': 'users'})
+        self.assertEqual(
+            response.context['friendship_status'],
+            {self.friend.id: 'accepted', self.requester.id: 'pending'}
+        )
+        self.assertIs(response.context['user_state'], response.wsgi_request.user_state)
+
 class SearchTests(BaseTestCase):
     def setUp(self):
         super().setUp()
@@ -537,3 +1405,123 @@ class SearchTests(BaseTestCase):
         self.assertEqual(response.status_code, 200)
         self.assertContains(response, 'Test Book')
         self.assertNotContains(response, 'Another Test Book')
+
+class EventStreamTests(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user(
+            username='testuser',
+            email='test@example.com',
+            password='testpass123'
+        )
+
+    def test_broker_delivers_to_subscriber(self):
+        async def scenario():
+            queue = broker.subscribe(self.user.id)
+            try:
+                broker.publish(self.user.id, 'counters', {'unread_notifications': 3})
+                return await asyncio.wait_for(queue.get(), timeout=1)
+            finally:
+                broker.unsubscribe(self.user.id, queue)
+
+        event = asyncio.run(scenario())
+        self.assertEqual(event, {'type': 'counters', 'data': {'unread_notifications': 3}})
+        self.assertFalse(broker.has_subscribers(self.user.id))
+        self.assertEqual(format_event(event), 'event: counters\ndata: {"unread_notifications": 3}\n\n')
+
+    def test_new_notification_is_published_on_commit(self):
+        with patch.object(broker, 'has_subscribers', return_value=True), \
+                patch.object(broker, 'publish') as publish, \
+                self.captureOnCommitCallbacks(execute=True):
+            Notification.objects.create(
+                user=self.user,
+                notification_type='friend_request',
+                message='Test notification'
+            )
+
+        event_types = [call.args[1] for call in publish.call_args_list]
+        self.assertEqual(event_types, ['notification', 'counters'])
+        self.assertEqual(publish.call_args_list[1].args[2]['unread_notifications'], 1)
+
+    def test_event_stream_falls_back_under_wsgi(self):
+        self.client.login(username='testuser', password='testpass123')
+        response = self.client.get(reverse('core:event_stream'))
+        self.assertEqual(response.status_code, 204)
+
+class CountersTests(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user(
+            username='testuser',
+            email='test@example.com',
+            password='testpass123'
+        )
+        self.other_user = User.objects.create_user(
+            username='otheruser',
+            email='other@example.com',
+            password='testpass123'
+        )
+        self.book = Book.objects.create(
+            owner=self.user,
+            title='Test Book',
+            author='Test Author',
+            genre='Fiction',
+            condition='good'
+        )
+        Friendship.objects.create(sender=self.other_user, receiver=self.user)
+        BookRequest.objects.create(book=self.book, borrower=self.other_user, return_date='2030-01-01')
+        Notification.objects.create(
+            user=self.user,
+            notification_type='friend_request',
+            message='Test notification'
+        )
+        self.client.login(username='testuser', password='testpass123')
+
+    def test_counters_single_query(self):
+        with self.assertNumQueries(1):
+            counters = get_counters(self.user)
+        self.assertEqual(counters, {
+            'unread_notifications': 1,
+            'unread_messages': 0,
+            'friend_requests': 1,
+            'book_requests': 1,
+        })
+
+    def test_counters_endpoint_returns_etag(self):
+        response = self.client.get(reverse('core:counters'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['friend_requests'], 1)
+        self.assertTrue(response.has_header('ETag'))
+
+    def test_unchanged_counters_return_not_modified_without_counting(self):
+        etag = self.client.get(reverse('core:counters'))['ETag']
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('core:counters'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertFalse(any('COUNT' in query['sql'] for query in queries.captured_queries))
+
+    def test_counters_etag_changes_with_state(self):
+        etag = self.client.get(reverse('core:counters'))['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            Notification.objects.create(
+                user=self.user,
+                notification_type='book_request',
+                message='Another notification'
+            )
+        response = self.client.get(reverse('core:counters'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['unread_notifications'], 2)
+
+    def test_counters_etag_is_shared_between_processes(self):
+        # Another worker has its own cache, so the version must not live in one
+        etag = self.client.get(reverse('core:counters'))['ETag']
+        cache.clear()
+        response = self.client.get(reverse('core:counters'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        Friendship.objects.filter(receiver=self.user).update(status='accepted')
+        counters_changed(self.user.id)
+        cache.clear()
+        response = self.client.get(reverse('core:counters'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['friend_requests'], 0)
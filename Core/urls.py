@@ -20,6 +20,7 @@ urlpatterns = [
     # Library
     path("library/<str:username>/", views.library_view, name="library"),
     path("books/add/", views.book_add, name="book_add"),
+    path("books/import/", views.book_import, name="book_import"),
     path("books/<int:book_id>/edit/", views.book_edit, name="book_edit"),
     path("books/<int:book_id>/delete/", views.book_delete, name="book_delete"),
     # Search
@@ -27,6 +28,8 @@ urlpatterns = [
     # Friends
     path("friends/", views.friends_list, name="friends_list"),
     path("friends/requests/", views.friend_requests, name="friend_requests"),
+    path("friends/import/", views.friend_import, name="friend_import"),
+    path("friends/requests/respond-all/", views.friend_respond_all, name="friend_respond_all"),
     path("friends/add/<str:username>/", views.friend_add, name="friend_add"),
     path(
         "friends/accept/<int:request_id>/", views.friend_accept, name="friend_accept"
@@ -55,6 +58,9 @@ urlpatterns = [
     path("notifications/", views.notifications_view, name="notifications"),
     path("notifications/api/", views.notifications_api, name="notifications_api"),
     path("notifications/<int:notification_id>/redirect/", views.notification_redirect, name="notification_redirect"),
+    # Badge counters and realtime push
+    path("counters/", views.counters, name="counters"),
+    path("events/", views.event_stream, name="event_stream"),
     # Book Ratings
     path("books/<int:book_id>/like/", views.book_like, name="book_like"),
     path("books/<int:book_id>/dislike/", views.book_dislike, name="book_dislike"),
@@ -0,0 +1,124 @@
+"""
+Request-scoped bundle of facts about the current user.
+
+``UserStateMiddleware`` attaches a ``UserState`` to every request as
+``request.user_state`` and the ``user_state`` context processor exposes it to
+templates. Nothing is queried until a fact is first read; related facts are
+fetched together and memoized for the rest of the request.
+"""
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.db.models import Q
+from django.utils.functional import cached_property
+
+from . import friends
+from .counters import get_counters
+from .models import BookRequest, Friendship
+
+EMPTY_COUNTERS = {
+    'unread_notifications': 0,
+    'unread_messages': 0,
+    'friend_requests': 0,
+    'book_requests': 0,
+}
+
+# When a pair has friendships in both directions, the most advanced status wins
+STATUS_PRIORITY = {'declined': 0, 'pending': 1, 'accepted': 2}
+
+
+class UserState:
+    def __init__(self, user):
+        self.user = user
+
+    @cached_property
+    def counters(self):
+        """Every badge counter of the user, fetched with one grouped query"""
+        if not self.user.is_authenticated:
+            return dict(EMPTY_COUNTERS)
+        return get_counters(self.user)
+
+    @property
+    def unread_notifications(self):
+        return self.counters['unread_notifications']
+
+    @property
+    def unread_messages(self):
+        return self.counters['unread_messages']
+
+    @property
+    def friend_requests(self):
+        return self.counters['friend_requests']
+
+    @property
+    def book_requests(self):
+        return self.counters['book_requests']
+
+    @cached_property
+    def friendship_statuses(self):
+        """Map the id of every user the current user has a friendship with to its status"""
+        if not self.user.is_authenticated:
+            return {}
+        statuses = {}
+        for sender_id, receiver_id, status in Friendship.objects.filter(
+            Q(sender=self.user) | Q(receiver=self.user)
+        ).values_list('sender_id', 'receiver_id', 'status'):
+            other_id = receiver_id if sender_id == self.user.pk else sender_id
+            if STATUS_PRIORITY[status] >= STATUS_PRIORITY.get(statuses.get(other_id), -1):
+                statuses[other_id] = status
+        return statuses
+
+    @cached_property
+    def friend_ids(self):
+        if not self.user.is_authenticated:
+            return frozenset()
+        return friends.friend_ids(self.user)
+
+    def friendship_status(self, user):
+        return self.friendship_statuses.get(getattr(user, 'pk', user))
+
+    def is_friend(self, user):
+        return getattr(user, 'pk', user) in self.friend_ids
+
+    @cached_property
+    def pending_book_request_ids(self):
+        """Ids of the books the user is waiting to borrow"""
+        if not self.user.is_authenticated:
+            return frozenset()
+        return frozenset(
+            BookRequest.objects.filter(borrower=self.user, status='pending').values_list('book_id', flat=True)
+        )
+
+    def has_pending_request(self, book):
+        return getattr(book, 'pk', book) in self.pending_book_request_ids
+
+    def book_request_status(self, books):
+        """The {book id: 'pending' or None} mapping the book templates expect"""
+        return {book.id: 'pending' if self.has_pending_request(book) else None for book in books}
+
+
+def get_user_state(request):
+    """Return the request's UserState, creating it for requests that skipped the middleware"""
+    if not hasattr(request, 'user_state'):
+        request.user_state = UserState(request.user)
+    return request.user_state
+
+
+class UserStateMiddleware:
+    # Async-capable, so ASGI requests such as the event stream are not adapted to a thread
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        request.user_state = UserState(request.user)
+        return self.get_response(request)
+
+    async def __acall__(self, request):
+        # UserState is lazy, so building it touches neither the session nor the database
+        request.user_state = UserState(request.user)
+        return await self.get_response(request)
@@ -2,15 +2,25 @@ from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth import login, authenticate, logout, update_session_auth_hash
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
-from .forms import SignUpForm, UserProfileForm, BookForm, BookReviewForm
+from .forms import SignUpForm, UserProfileForm, BookForm, BookImportForm, BookReviewForm, FriendImportForm
 from .forms_auth import CustomPasswordChangeForm, PasswordResetRequestForm, PasswordResetVerificationForm
-from .models import UserProfile, Book, Friendship, Notification, BookRequest, BookRating, BookReview
+from .models import UserProfile, Book, FeedItem, FriendEdge, Friendship, FriendSuggestion, Notification, NotificationCounter, NotificationOutbox, BookRequest, BookRating, BookReview
 from django.contrib.auth.models import User
-from django.db.models import Q
+from django.db import transaction
+from django.db.models import F, Q
+from django.db.models.functions import Lower
 from django.utils import timezone
 from datetime import datetime, timedelta
-from django.http import JsonResponse, HttpResponseBadRequest
+from django.http import JsonResponse, HttpResponse, HttpResponseBadRequest, StreamingHttpResponse
+from django.core.handlers.asgi import ASGIRequest
+from django.views.decorators.http import condition
 from django.urls import reverse
+from .book_import import detect_format, import_books, read_rows
+from .counters import get_counters, get_counters_version
+from .friends import are_friends, friend_ids
+from .events import broker, format_event, KEEPALIVE_INTERVAL
+import asyncio
+import io
 import random
 import string
 
@@ -93,17 +103,9 @@ def profile_view(request, username):
     user = get_object_or_404(User, username=username)
     profile, created = UserProfile.objects.get_or_create(user=user)
 
-    # Check if they are friends
-    is_friend = Friendship.objects.filter(
-        (Q(sender=request.user, receiver=user) | Q(sender=user, receiver=request.user)),
-        status="accepted",
-    ).exists()
-
-    # Check if there's a pending friend request
-    pending_request = Friendship.objects.filter(
-        (Q(sender=request.user, receiver=user) | Q(sender=user, receiver=request.user)),
-        status="pending",
-    ).exists()
+    # Friendship state with the profile owner, from the request's user state
+    is_friend = request.user_state.is_friend(user)
+    pending_request = request.user_state.friendship_status(user) == "pending"
 
     context = {
         "profile_user": user,
@@ -111,21 +113,14 @@ def profile_view(request, username):
         "is_owner": request.user == user,
         "is_friend": is_friend,
         "pending_request": pending_request,
+        "mutual_friends": 0 if request.user == user else FriendEdge.mutual_counts(request.user, [user.id]).get(user.id, 0),
     }
     
     # Get recently added books by the user
     recent_books = Book.objects.filter(owner=user).order_by('-created_at')[:6]
     
-    # Get book request status for each book
-    book_request_status = {}
-    for book in recent_books:
-        if BookRequest.has_pending_request(book, request.user):
-            book_request_status[book.id] = 'pending'
-        else:
-            book_request_status[book.id] = None
-    
     context['recent_books'] = recent_books
-    context['book_request_status'] = book_request_status
+    context['book_request_status'] = request.user_state.book_request_status(recent_books)
 
     return render(request, "core/profile/view.html", context)
 
@@ -223,23 +218,55 @@ def password_reset_verify(request):
     return render(request, 'core/auth/password_reset_verify.html', {'form': form})
 
 
+LIBRARY_PAGE_SIZE = 24
+
+
 @login_required
 def library_view(request, username):
     user = get_object_or_404(User, username=username)
-    books = Book.objects.filter(owner=user).order_by("-created_at")
-    # Get book request status for each book
-    book_request_status = {}
-    for book in books:
-        if BookRequest.has_pending_request(book, request.user):
-            book_request_status[book.id] = 'pending'
-        else:
-            book_request_status[book.id] = None
+
+    # Only exact matches, each served by one of Book's owner indexes
+    filters = {}
+    if request.GET.get("genre"):
+        filters["genre"] = request.GET["genre"]
+    if request.GET.get("condition") in dict(Book.CONDITION_CHOICES):
+        filters["condition"] = request.GET["condition"]
+    if request.GET.get("available") in ("yes", "no"):
+        filters["available"] = request.GET["available"] == "yes"
+    sort = request.GET.get("sort")
+    if sort not in Book.LIBRARY_SORTS:
+        sort = "newest"
+
+    after = None
+    if request.GET.get("after"):
+        after = Book.decode_library_cursor(request.GET["after"], sort)
+        if after is None:
+            return HttpResponseBadRequest("Invalid cursor.")
+
+    books, has_more = Book.get_library_page(user, sort=sort, after=after, limit=LIBRARY_PAGE_SIZE, **filters)
+
+    # Filter and sort parameters, kept on the pagination links
+    query = request.GET.copy()
+    query.pop("after", None)
 
     context = {
         "library_owner": user,
         "books": books,
         "is_owner": request.user == user,
-        "book_request_status": book_request_status
+        # Pending requests of the visitor come from one query on the user state
+        "book_request_status": request.user_state.book_request_status(books),
+        "genres": Book.objects.filter(owner=user).order_by("genre").values_list("genre", flat=True).distinct(),
+        "condition_choices": Book.CONDITION_CHOICES,
+        "sort_choices": [("newest", "Newest first"), ("oldest", "Oldest first"), ("title", "Title")],
+        "selected": {
+            "genre": request.GET.get("genre", ""),
+            "condition": filters.get("condition", ""),
+            "available": request.GET.get("available", "") if "available" in filters else "",
+            "sort": sort,
+        },
+        "filter_query": query.urlencode(),
+        "is_first_page": after is None,
+        "next_cursor": Book.encode_library_cursor(books[-1], sort) if has_more else None,
     }
     return render(request, "core/library/view.html", context)
 
@@ -261,6 +288,31 @@ def book_add(request):
     )
 
 
+@login_required
+def book_import(request):
+    if request.method == "POST":
+        form = BookImportForm(request.POST, request.FILES)
+        if form.is_valid():
+            upload = form.cleaned_data["books_file"]
+            # Rows stream from the uploaded file, which Django spools to disk when large
+            lines = io.TextIOWrapper(upload, encoding="utf-8-sig", newline="")
+            try:
+                created, errors, error_count = import_books(
+                    request.user, read_rows(lines, detect_format(upload.name))
+                )
+            except UnicodeDecodeError:
+                form.add_error("books_file", "The file must be UTF-8 encoded.")
+            else:
+                if created:
+                    messages.success(request, f"Imported {created} book{'s' if created != 1 else ''}.")
+                context = {"form": BookImportForm(), "created": created, "errors": errors, "error_count": error_count}
+                return render(request, "core/library/book_import.html", context)
+    else:
+        form = BookImportForm()
+
+    return render(request, "core/library/book_import.html", {"form": form})
+
+
 @login_required
 def book_edit(request, book_id):
     book = get_object_or_404(Book, id=book_id, owner=request.user)
@@ -287,22 +339,19 @@ def book_delete(request, book_id):
     return render(request, "core/library/book_confirm_delete.html", {"book": book})
 
 
+FRIEND_SUGGESTIONS_SHOWN = 6
+
+
 @login_required
 def friends_list(request):
-    # Get all accepted friendships where the user is either sender or receiver
-    friendships = Friendship.objects.filter(
-        (Q(sender=request.user) | Q(receiver=request.user)) & Q(status="accepted")
-    )
-
-    # Create a list of friend users
-    friends = []
-    for friendship in friendships:
-        if friendship.sender == request.user:
-            friends.append(friendship.receiver)
-        else:
-            friends.append(friendship.sender)
+    # Friends come from the cached friend id set
+    friends = User.objects.filter(pk__in=friend_ids(request.user)).select_related("userprofile").order_by("username")
 
-    context = {"friends": friends}
+    context = {
+        "friends": friends,
+        # Precomputed by the compute_friend_suggestions command
+        "suggestions": FriendSuggestion.get_for_user(request.user, limit=FRIEND_SUGGESTIONS_SHOWN),
+    }
     return render(request, "core/friends/list.html", context)
 
 
@@ -334,17 +383,18 @@ def friend_add(request, username):
             messages.error(request, "Friendship request already exists.")
             return redirect("core:profile", username=username)
 
-        # Create friendship request
-        friendship = Friendship.objects.create(sender=request.user, receiver=receiver)
+        with transaction.atomic():
+            # Create friendship request
+            friendship = Friendship.objects.create(sender=request.user, receiver=receiver)
 
-        # Create notification
-        Notification.objects.create(
-            user=receiver,
-            notification_type="friend_request",
-            message=f"{request.user.username} has sent you a friend request.",
-            related_user=request.user,
-            related_friendship=friendship
-        )
+            # Queue notification
+            NotificationOutbox.enqueue(
+                receiver,
+                "friend_request",
+                f"{request.user.username} has sent you a friend request.",
+                related_user=request.user,
+                related_friendship=friendship
+            )
 
         messages.success(request, "Friend request sent successfully!")
         return redirect("core:profile", username=username)
@@ -352,6 +402,45 @@ def friend_add(request, username):
     return redirect("core:profile", username=username)
 
 
+@login_required
+def friend_import(request):
+    if request.method == "POST":
+        form = FriendImportForm(request.POST, request.FILES)
+        if form.is_valid():
+            identifiers = form.cleaned_data["identifiers"]
+            # Resolve every username and email with one IN query
+            emails = [entry.lower() for entry in identifiers if "@" in entry]
+            users = list(
+                User.objects.alias(email_lower=Lower("email"))
+                .filter(Q(username__in=identifiers) | Q(email_lower__in=emails))
+                .exclude(id=request.user.id)
+            )
+            friendships = Friendship.send_bulk(request.user, users)
+
+            found = {user.username for user in users} | {user.email.lower() for user in users if user.email}
+            found |= {request.user.username, request.user.email.lower()}
+            not_found = [entry for entry in identifiers if entry not in found and entry.lower() not in found]
+            messages.success(request, f"Sent {len(friendships)} friend request{'s' if len(friendships) != 1 else ''}.")
+            if not_found:
+                messages.warning(request, f"No users found for: {', '.join(not_found[:20])}{'...' if len(not_found) > 20 else ''}")
+            return redirect("core:friend_requests")
+    else:
+        form = FriendImportForm()
+
+    return render(request, "core/friends/import.html", {"form": form})
+
+
+@login_required
+def friend_respond_all(request):
+    if request.method == "POST":
+        action = request.POST.get("action")
+        if action in ("accept", "decline"):
+            answered = Friendship.respond_all(request.user, "accepted" if action == "accept" else "declined")
+            messages.success(request, f"{'Accepted' if action == 'accept' else 'Declined'} {answered} friend request{'s' if answered != 1 else ''}.")
+
+    return redirect("core:friend_requests")
+
+
 @login_required
 def friend_accept(request, request_id):
     friendship = get_object_or_404(
@@ -359,17 +448,18 @@ def friend_accept(request, request_id):
     )
 
     if request.method == "POST":
-        friendship.status = "accepted"
-        friendship.save()
-
-        # Create notification for sender
-        Notification.objects.create(
-            user=friendship.sender,
-            notification_type="request_update",
-            message=f"{request.user.username} accepted your friend request.",
-            related_user=request.user,
-            related_friendship=friendship
-        )
+        with transaction.atomic():
+            friendship.status = "accepted"
+            friendship.save()
+
+            # Queue notification for sender
+            NotificationOutbox.enqueue(
+                friendship.sender,
+                "request_update",
+                f"{request.user.username} accepted your friend request.",
+                related_user=request.user,
+                related_friendship=friendship
+            )
 
         messages.success(request, "Friend request accepted!")
         return redirect("core:friends_list")
@@ -384,17 +474,18 @@ def friend_decline(request, request_id):
     )
 
     if request.method == "POST":
-        friendship.status = "declined"
-        friendship.save()
-
-        # Create notification for sender
-        Notification.objects.create(
-            user=friendship.sender,
-            notification_type="request_update",
-            message=f"{request.user.username} declined your friend request.",
-            related_user=request.user,
-            related_friendship=friendship
-        )
+        with transaction.atomic():
+            friendship.status = "declined"
+            friendship.save()
+
+            # Queue notification for sender
+            NotificationOutbox.enqueue(
+                friendship.sender,
+                "request_update",
+                f"{request.user.username} declined your friend request.",
+                related_user=request.user,
+                related_friendship=friendship
+            )
 
         messages.success(request, "Friend request declined.")
         return redirect("core:friend_requests")
@@ -407,13 +498,7 @@ def book_request(request, book_id):
     book = get_object_or_404(Book, id=book_id)
 
     # Check if user is friends with book owner
-    if not Friendship.objects.filter(
-        (
-            Q(sender=request.user, receiver=book.owner)
-            | Q(sender=book.owner, receiver=request.user)
-        ),
-        status="accepted",
-    ).exists():
+    if not are_friends(request.user, book.owner_id):
         messages.error(
             request, "You must be friends with the book owner to request books."
         )
@@ -432,20 +517,21 @@ def book_request(request, book_id):
                 messages.error(request, "Return date must be in the future.")
                 return redirect("core:book_request", book_id=book_id)
 
-            # Create book request
-            book_request = BookRequest.objects.create(
-                book=book, borrower=request.user, return_date=return_date
-            )
+            with transaction.atomic():
+                # Create book request
+                book_request = BookRequest.objects.create(
+                    book=book, borrower=request.user, return_date=return_date
+                )
 
-            # Create notification for book owner
-            Notification.objects.create(
-                user=book.owner,
-                notification_type="book_request",
-                message=f"{request.user.username} has requested to borrow '{book.title}'.",
-                related_user=request.user,
-                related_book=book,
-                related_book_request=book_request
-            )
+                # Queue notification for book owner
+                NotificationOutbox.enqueue(
+                    book.owner,
+                    "book_request",
+                    f"{request.user.username} has requested to borrow '{book.title}'.",
+                    related_user=request.user,
+                    related_book=book,
+                    related_book_request=book_request
+                )
 
             messages.success(request, "Book request sent successfully!")
             return redirect("core:library", username=book.owner.username)
@@ -503,22 +589,23 @@ def book_request_accept(request, request_id):
     )
 
     if request.method == "POST":
-        book_request.status = "accepted"
-        book_request.save()
-
-        # Update book availability
-        book_request.book.available = False
-        book_request.book.save()
-
-        # Create notification for borrower
-        Notification.objects.create(
-            user=book_request.borrower,
-            notification_type="request_update",
-            message=f'Your request to borrow "{book_request.book.title}" has been accepted.',
-            related_user=request.user,
-            related_book=book_request.book,
-            related_book_request=book_request
-        )
+        with transaction.atomic():
+            book_request.status = "accepted"
+            book_request.save()
+
+            # Update book availability
+            book_request.book.available = False
+            book_request.book.save()
+
+            # Queue notification for borrower
+            NotificationOutbox.enqueue(
+                book_request.borrower,
+                "request_update",
+                f'Your request to borrow "{book_request.book.title}" has been accepted.',
+                related_user=request.user,
+                related_book=book_request.book,
+                related_book_request=book_request
+            )
 
         messages.success(request, "Book request accepted!")
         return redirect("core:book_requests")
@@ -533,18 +620,19 @@ def book_request_decline(request, request_id):
     )
 
     if request.method == "POST":
-        book_request.status = "declined"
-        book_request.save()
-
-        # Create notification for borrower
-        Notification.objects.create(
-            user=book_request.borrower,
-            notification_type="request_update",
-            message=f'Your request to borrow "{book_request.book.title}" has been declined.',
-            related_user=request.user,
-            related_book=book_request.book,
-            related_book_request=book_request
-        )
+        with transaction.atomic():
+            book_request.status = "declined"
+            book_request.save()
+
+            # Queue notification for borrower
+            NotificationOutbox.enqueue(
+                book_request.borrower,
+                "request_update",
+                f'Your request to borrow "{book_request.book.title}" has been declined.',
+                related_user=request.user,
+                related_book=book_request.book,
+                related_book_request=book_request
+            )
 
         messages.success(request, "Book request declined.")
         return redirect(request.META.get('HTTP_REFERER', 'core:dashboard'))
@@ -562,23 +650,24 @@ def book_return(request, request_id):
         return redirect("core:book_requests")
 
     if request.method == "POST":
-        book_request.status = "returned"
-        book_request.returned_at = timezone.now()
-        book_request.save()
-
-        # Update book availability
-        book_request.book.available = True
-        book_request.book.save()
-
-        # Create notification for borrower
-        Notification.objects.create(
-            user=book_request.borrower,
-            notification_type="request_update",
-            message=f'{request.user.username} has confirmed the return of "{book_request.book.title}".',
-            related_user=request.user,
-            related_book=book_request.book,
-            related_book_request=book_request
-        )
+        with transaction.atomic():
+            book_request.status = "returned"
+            book_request.returned_at = timezone.now()
+            book_request.save()
+
+            # Update book availability
+            book_request.book.available = True
+            book_request.book.save()
+
+            # Queue notification for borrower
+            NotificationOutbox.enqueue(
+                book_request.borrower,
+                "request_update",
+                f'{request.user.username} has confirmed the return of "{book_request.book.title}".',
+                related_user=request.user,
+                related_book=book_request.book,
+                related_book_request=book_request
+            )
 
         messages.success(request, "Book marked as returned successfully!")
         return redirect("core:book_requests")
@@ -591,28 +680,39 @@ def notification_redirect(request, notification_id):
     notification = get_object_or_404(Notification, id=notification_id, user=request.user)
     
     # Mark the notification as read
-    if not notification.read:
-        notification.read = True
-        notification.save()
+    notification.mark_read()
     
     # Get the URL to redirect to
-    redirect_url = notification.get_notification_url()
+    redirect_url = notification.target_url or notification.get_notification_url()
     return redirect(redirect_url)
 
 
+NOTIFICATIONS_PAGE_SIZE = 20
+
+
 @login_required
 def notifications_view(request):
-    notifications = Notification.get_user_notifications(request.user)
-    unread_count = notifications.filter(read=False).count()
-
     # Mark all as read
     if request.method == "POST":
-        notifications.filter(read=False).update(read=True)
+        Notification.mark_all_read(request.user)
         return redirect("core:notifications")
 
+    after = None
+    if request.GET.get("after"):
+        after = Notification.decode_cursor(request.GET["after"])
+        if after is None:
+            return HttpResponseBadRequest("Invalid cursor.")
+
+    notifications, has_more = Notification.get_page(
+        request.user, after=after, limit=NOTIFICATIONS_PAGE_SIZE
+    )
+    unread_count = NotificationCounter.get_unread(request.user)
+
     context = {
         "notifications": notifications,
         "unread_count": unread_count,
+        "is_first_page": after is None,
+        "next_cursor": Notification.encode_cursor(notifications[-1]) if has_more else None,
     }
     return render(request, "core/notifications/list.html", context)
 
@@ -621,11 +721,53 @@ def notifications_view(request):
 def notifications_api(request):
     """API endpoint for checking new notifications via AJAX"""
     if request.headers.get("x-requested-with") == "XMLHttpRequest":
-        unread_count = Notification.get_user_notifications(request.user).filter(read=False).count()
-        return JsonResponse({"unread_count": unread_count})
+        return JsonResponse({"unread_count": NotificationCounter.get_unread(request.user)})
     return HttpResponseBadRequest()
 
 
+def _counters_etag(request):
+    return get_counters_version(request.user.id)
+
+
+@login_required
+@condition(etag_func=_counters_etag)
+def counters(request):
+    """Every navbar badge counter in one response; unchanged state gets a 304"""
+    response = JsonResponse(get_counters(request.user))
+    response["Cache-Control"] = "private, no-cache"
+    return response
+
+
+@login_required
+async def event_stream(request):
+    """Server-sent events stream pushing messages, notifications and counters"""
+    if not isinstance(request, ASGIRequest):
+        # Streams would tie up a WSGI worker forever; 204 tells EventSource to
+        # stop reconnecting so the page falls back to polling.
+        return HttpResponse(status=204)
+
+    user = await request.auser()
+
+    async def stream():
+        queue = broker.subscribe(user.id)
+        try:
+            yield "retry: 5000\n\n"
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=KEEPALIVE_INTERVAL)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                else:
+                    yield format_event(event)
+        finally:
+            broker.unsubscribe(user.id, queue)
+
+    response = StreamingHttpResponse(stream(), content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"
+    return response
+
+
 @login_required
 def search(request):
     query = request.GET.get("q", "")
@@ -671,48 +813,25 @@ def search(request):
                 UserProfile.objects.get_or_create(user=user)
 
             # Get friendship status for each user
-            friendship_status = {}
-            for user in users:
-                friendship = Friendship.objects.filter(
-                    (Q(sender=request.user, receiver=user) | Q(sender=user, receiver=request.user))
-                ).first()
-                if friendship:
-                    friendship_status[user.id] = friendship.status
-                else:
-                    friendship_status[user.id] = None
+            friendship_status = {
+                user.id: request.user_state.friendship_status(user) for user in users
+            }
 
             context['friendship_status'] = friendship_status
             context['users'] = users
 
         if search_type in ["all", "books"]:
-            # Get friend IDs
-            friend_ids = Friendship.objects.filter(
-                (Q(sender=request.user) | Q(receiver=request.user)), status="accepted"
-            ).values_list("sender", "receiver")
-
-            friend_ids = set(
-                [id[0] for id in friend_ids] + [id[1] for id in friend_ids]
-            ) - {request.user.id}
-
             # Get books from friends
             books = Book.objects.filter(
                 Q(title__icontains=query)
                 | Q(author__icontains=query)
                 | Q(genre__icontains=query),
-                owner_id__in=friend_ids,
+                owner_id__in=request.user_state.friend_ids,
                 available=True,
             ).select_related("owner")
 
-            # Get book request status for each book
-            book_request_status = {}
-            for book in books:
-                if BookRequest.has_pending_request(book, request.user):
-                    book_request_status[book.id] = 'pending'
-                else:
-                    book_request_status[book.id] = None
-
             context['books'] = books
-            context['book_request_status'] = book_request_status
+            context['book_request_status'] = request.user_state.book_request_status(books)
 
 
 
@@ -725,29 +844,24 @@ def book_like(request, book_id):
     book = get_object_or_404(Book, id=book_id)
     
     # Check friendship
-    if not Friendship.objects.filter(
-        (Q(sender=request.user, receiver=book.owner) |
-         Q(sender=book.owner, receiver=request.user)),
-        status="accepted"
-    ).exists():
+    if not are_friends(request.user, book.owner_id):
         messages.error(request, "You must be friends to rate books")
         return redirect("core:dashboard")
 
-    # Create or update rating
-    BookRating.objects.update_or_create(
-        user=request.user,
-        book=book,
-        defaults={'rating': 'like'}
-    )
-    
-    # Create notification
-    Notification.objects.create(
-        user=book.owner,
-        notification_type="book_rating",
-        message=f"{request.user.username} liked your book '{book.title}'",
-        related_user=request.user,
-        related_book=book
-    )
+    with transaction.atomic():
+        # Create or update rating along with the book's counters
+        changed = BookRating.rate(request.user, book, 'like')
+        
+        # Queue notification, replacing the unread one left by an earlier click
+        if changed:
+            NotificationOutbox.enqueue(
+                book.owner,
+                "book_rating",
+                f"{request.user.username} liked your book '{book.title}'",
+                coalesce=True,
+                related_user=request.user,
+                related_book=book
+            )
     
     return redirect(request.META.get('HTTP_REFERER', 'core:dashboard'))
 
@@ -756,37 +870,32 @@ def book_dislike(request, book_id):
     book = get_object_or_404(Book, id=book_id)
     
     # Check friendship
-    if not Friendship.objects.filter(
-        (Q(sender=request.user, receiver=book.owner) |
-         Q(sender=book.owner, receiver=request.user)),
-        status="accepted"
-    ).exists():
+    if not are_friends(request.user, book.owner_id):
         messages.error(request, "You must be friends to rate books")
         return redirect("core:dashboard")
 
-    # Create or update rating
-    BookRating.objects.update_or_create(
-        user=request.user,
-        book=book,
-        defaults={'rating': 'dislike'}
-    )
-    
-    # Create notification
-    Notification.objects.create(
-        user=book.owner,
-        notification_type="book_rating",
-        message=f"{request.user.username} disliked your book '{book.title}'",
-        related_user=request.user,
-        related_book=book
-    )
+    with transaction.atomic():
+        # Create or update rating along with the book's counters
+        changed = BookRating.rate(request.user, book, 'dislike')
+        
+        # Queue notification, replacing the unread one left by an earlier click
+        if changed:
+            NotificationOutbox.enqueue(
+                book.owner,
+                "book_rating",
+                f"{request.user.username} disliked your book '{book.title}'",
+                coalesce=True,
+                related_user=request.user,
+                related_book=book
+            )
     
     return redirect(request.META.get('HTTP_REFERER', 'core:dashboard'))
 
 @login_required
 def book_ratings(request, book_id):
     book = get_object_or_404(Book, id=book_id)
-    likes = book.bookrating_set.filter(rating='like')
-    dislikes = book.bookrating_set.filter(rating='dislike')
+    likes = book.bookrating_set.filter(rating='like').select_related('user')
+    dislikes = book.bookrating_set.filter(rating='dislike').select_related('user')
     context = {
         'book': book,
         'likes': likes,
@@ -794,59 +903,41 @@ def book_ratings(request, book_id):
     }
     return render(request, 'core/books/book_ratings.html', context)
 
-def dashboard(request):
-    # Get books from friends
-    friend_ids = Friendship.objects.filter(
-        (Q(sender=request.user) | Q(receiver=request.user)), status="accepted"
-    ).values_list("sender", "receiver")
 
-    friend_ids = set([id for pair in friend_ids for id in pair]) - {request.user.id}
+FEED_PAGE_SIZE = 12
 
-    friend_books = (
-        Book.objects.filter(owner_id__in=friend_ids, available=True)
-        .select_related("owner")
-        .order_by("-created_at")[:12]
-    )
-
-    for book in friend_books:
-        book.has_pending_request = BookRequest.has_pending_request(book, request.user)
-        likes = book.bookrating_set.filter(rating='like').count()
-        dislikes = book.bookrating_set.filter(rating='dislike').count()
-        total_ratings = likes + dislikes
-        
-        if total_ratings > 0:
-            book.average_rating = round((likes / total_ratings) * 5, 1)  # Scale to 5 stars
-        else:
-            book.average_rating = 0
-        
-        book.likes = likes
-        book.dislikes = dislikes
-        book.total_ratings = total_ratings
-
-    # Get pending friend requests
-    friend_requests = Friendship.objects.filter(
-        receiver=request.user, status="pending"
-    ).count()
-
-    # Get pending book requests
-    book_requests = BookRequest.objects.filter(
-        book__owner=request.user, status="pending"
-    ).count()
-
-    # Get book request status for each book
-    book_request_status = {}
-    for book in friend_books:
-        if BookRequest.has_pending_request(book, request.user):
-            book_request_status[book.id] = 'pending'
-        else:
-            book_request_status[book.id] = None
 
+@login_required
+def dashboard(request):
+    after = None
+    if request.GET.get("after"):
+        after = FeedItem.decode_cursor(request.GET["after"])
+        if after is None:
+            return HttpResponseBadRequest("Invalid cursor.")
+
+    # Friends' books come from the user's fanned-out feed, one index range per page
+    items, has_more = FeedItem.get_page(request.user, after=after, limit=FEED_PAGE_SIZE)
+    friend_books = []
+    for item in items:
+        item.book.has_pending_request = item.has_pending_request
+        friend_books.append(item.book)
+
+    # Rating counts and stars come from the book's counter columns, and the
+    # pending flags from the page query's EXISTS, so no query runs per book
     context = {
         "friend_books": friend_books,
-        "friend_requests": friend_requests,
-        "book_requests": book_requests,
-        "book_request_status": book_request_status
+        "next_cursor": FeedItem.encode_cursor(items[-1]) if has_more else None,
+        "book_request_status": {
+            book.id: "pending" if book.has_pending_request else None for book in friend_books
+        }
     }
+    # Infinite scroll fetches the following pages as bare card fragments
+    if request.headers.get("x-requested-with") == "XMLHttpRequest":
+        return render(request, "core/includes/_feed_books.html", context)
+
+    # Both pending counts come from the user state's single counters query
+    context["friend_requests"] = request.user_state.friend_requests
+    context["book_requests"] = request.user_state.book_requests
     return render(request, "core/dashboard.html", context)
 
 
@@ -855,22 +946,23 @@ def friend_remove(request, username):
     friend = get_object_or_404(User, username=username)
 
     if request.method == "POST":
-        # Find and delete the friendship
-        Friendship.objects.filter(
-            (
-                Q(sender=request.user, receiver=friend)
-                | Q(sender=friend, receiver=request.user)
-            ),
-            status="accepted",
-        ).delete()
-
-        # Create notification for the other user
-        Notification.objects.create(
-            user=friend,
-            notification_type="friend_request", # Should be friend_remove or similar
-            message=f"{request.user.username} has removed you from their friends list.",
-            related_user=request.user
-        )
+        with transaction.atomic():
+            # Find and delete the friendship
+            Friendship.objects.filter(
+                (
+                    Q(sender=request.user, receiver=friend)
+                    | Q(sender=friend, receiver=request.user)
+                ),
+                status="accepted",
+            ).delete()
+
+            # Queue notification for the other user
+            NotificationOutbox.enqueue(
+                friend,
+                "friend_request", # Should be friend_remove or similar
+                f"{request.user.username} has removed you from their friends list.",
+                related_user=request.user
+            )
 
         messages.success(request, f"Removed {friend.get_full_name()} from friends.")
 
@@ -888,10 +980,7 @@ def book_detail(request, book_id):
     reviews = book.reviews.all().order_by('-created_at')
     form = BookReviewForm()
 
-    is_friend = Friendship.objects.filter(
-        (Q(sender=request.user, receiver=book.owner) | Q(sender=book.owner, receiver=request.user)),
-        status="accepted",
-    ).exists()
+    is_friend = request.user_state.is_friend(book.owner_id)
 
     # Get borrowing history (only returned requests)
     borrowing_history = BookRequest.objects.filter(
@@ -900,11 +989,7 @@ def book_detail(request, book_id):
     ).order_by('-returned_at').select_related('borrower')
 
     # Get book request status
-    book_request_status = {}
-    if BookRequest.has_pending_request(book, request.user):
-        book_request_status[book.id] = 'pending'
-    else:
-        book_request_status[book.id] = None
+    book_request_status = request.user_state.book_request_status([book])
 
     context = {
         'book': book,
@@ -915,7 +1000,7 @@ def book_detail(request, book_id):
         'borrowing_history': borrowing_history,
         'is_owner': request.user == book.owner, # Add is_owner to context
     }
-    book.has_pending_request = BookRequest.has_pending_request(book, request.user)
+    book.has_pending_request = request.user_state.has_pending_request(book)
     return render(request, 'core/books/book_detail.html', context)
 
 @login_required
@@ -923,29 +1008,28 @@ def submit_review(request, book_id):
     book = get_object_or_404(Book, id=book_id)
 
     # Check if user is friends with book owner
-    if not Friendship.objects.filter(
-        (Q(sender=request.user, receiver=book.owner) | Q(sender=book.owner, receiver=request.user)),
-        status="accepted",
-    ).exists():
+    if not are_friends(request.user, book.owner_id):
         messages.error(request, "You must be friends with the book owner to submit a review.")
         return redirect('core:book_detail', book_id=book_id)
 
     if request.method == 'POST':
         review_text = request.POST.get('review_text', '').strip()
         if review_text:
-            review = BookReview.objects.create(
-                user=request.user,
-                book=book,
-                review_text=review_text
-            )
-
-            # Create notification for book owner
-            Notification.objects.create(
-                user=book.owner,
-                notification_type='book_review',
-                message=f"{request.user.username} reviewed your book '{book.title}'",
-                related_book_review=review
-            )
+            with transaction.atomic():
+                review = BookReview.objects.create(
+                    user=request.user,
+                    book=book,
+                    review_text=review_text
+                )
+                Book.objects.filter(pk=book.pk).update(review_count=F("review_count") + 1)
+
+                # Queue notification for book owner
+                NotificationOutbox.enqueue(
+                    book.owner,
+                    'book_review',
+                    f"{request.user.username} reviewed your book '{book.title}'",
+                    related_book_review=review
+                )
             messages.success(request, "Review submitted successfully!")
         else:
             messages.error(request, "Review text cannot be empty")
@@ -962,6 +1046,8 @@ def delete_review(request, review_id):
         messages.error(request, "You do not have permission to delete this review.")
         return redirect('core:book_detail', book_id=book_id)
 
-    review.delete()
+    with transaction.atomic():
+        if BookReview.objects.filter(pk=review.pk).delete()[0]:
+            Book.objects.filter(pk=book_id).update(review_count=F("review_count") - 1)
     messages.success(request, "Review deleted successfully!")
     return redirect('core:book_detail', book_id=book_id)
@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class MessageChatConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "Message_Chat"
+
+    def ready(self):
+        from . import signals  # noqa: F401
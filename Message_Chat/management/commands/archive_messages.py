@@ -0,0 +1,116 @@
+import statistics
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+from Message_Chat import search
+from Message_Chat.models import ArchivedMessageBlock, Conversation, Message
+
+
+class Command(BaseCommand):
+    help = (
+        'Move messages older than a given age into compressed per-conversation blocks. '
+        'Unread messages and the last message of each conversation stay in the hot table.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than-days', type=int, default=180, help='Minimum message age (default: 180)')
+        parser.add_argument('--block-size', type=int, default=200, help='Messages per archived block (default: 200)')
+        parser.add_argument('--dry-run', action='store_true', help='Only report how many messages would move')
+        parser.add_argument(
+            '--benchmark',
+            action='store_true',
+            help='Report hot table size and history page latency before and after archiving'
+        )
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(days=options['older_than_days'])
+        if options['benchmark']:
+            before = self.measure(cutoff)
+
+        archived = blocks = 0
+        for conversation in Conversation.objects.filter(last_activity__isnull=False).order_by('id').iterator():
+            messages = self.archivable_messages(conversation, cutoff)
+            if options['dry_run']:
+                archived += len(messages)
+                continue
+            for start in range(0, len(messages), options['block_size']):
+                chunk = messages[start:start + options['block_size']]
+                with transaction.atomic():
+                    ArchivedMessageBlock.from_messages(conversation, chunk).save()
+                    Message.objects.filter(id__in=[message.id for message in chunk]).delete()
+                    # Deleting drops the messages from the hot search index; they stay searchable here
+                    search.index_archived(chunk)
+                archived += len(chunk)
+                blocks += 1
+
+        if options['dry_run']:
+            self.stdout.write(f'{archived} messages would be archived.')
+            return
+        self.stdout.write(self.style.SUCCESS(f'Archived {archived} messages into {blocks} blocks.'))
+
+        if options['benchmark']:
+            self.report(before, self.measure(cutoff))
+
+    def archivable_messages(self, conversation, cutoff):
+        """Old messages both participants have read, excluding the conversation's last message"""
+        last_read_ids = dict(conversation.read_cursors.values_list('user_id', 'last_read_id'))
+        messages = []
+        for sender_id, receiver_id in (
+            (conversation.user_a_id, conversation.user_b_id),
+            (conversation.user_b_id, conversation.user_a_id),
+        ):
+            messages.extend(
+                Message.objects.filter(
+                    sender_id=sender_id,
+                    receiver_id=receiver_id,
+                    timestamp__lt=cutoff,
+                    id__lte=last_read_ids.get(receiver_id, 0)
+                ).exclude(id=conversation.last_message_id)
+            )
+        messages.sort(key=lambda message: (message.timestamp, message.id))
+        return messages
+
+    def measure(self, cutoff, samples=50):
+        """Hot table size, and latency of the latest page and of the page before the cutoff"""
+        size = None
+        if connection.vendor == 'sqlite':
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT SUM(pgsize) FROM dbstat WHERE name = %s OR name IN "
+                    "(SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = %s)",
+                    [Message._meta.db_table, Message._meta.db_table]
+                )
+                size = cursor.fetchone()[0]
+
+        pairs = list(
+            Conversation.objects.filter(last_activity__isnull=False)
+            .order_by('-last_activity')
+            .values_list('user_a_id', 'user_b_id')[:samples]
+        )
+        latest, archived = [], []
+        for user_a_id, user_b_id in pairs:
+            started = time.perf_counter()
+            Message.get_history_page(user_a_id, user_b_id)
+            latest.append((time.perf_counter() - started) * 1000)
+
+            started = time.perf_counter()
+            Message.get_history_page(user_a_id, user_b_id, before=(cutoff, 0))
+            archived.append((time.perf_counter() - started) * 1000)
+        return {
+            'rows': Message.objects.count(),
+            'size': size,
+            'latest': statistics.median(latest) if latest else 0,
+            'archived': statistics.median(archived) if archived else 0,
+        }
+
+    def report(self, before, after):
+        self.stdout.write(f"Hot rows: {before['rows']} -> {after['rows']}")
+        if before['size'] is not None:
+            self.stdout.write(
+                f"Hot table + indexes: {before['size'] / 2 ** 20:.1f} MiB -> {after['size'] / 2 ** 20:.1f} MiB"
+            )
+        self.stdout.write(f"Latest page p50: {before['latest']:.2f} ms -> {after['latest']:.2f} ms")
+        self.stdout.write(f"Page before the cutoff p50: {before['archived']:.2f} ms -> {after['archived']:.2f} ms")
@@ -0,0 +1,79 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Max
+from Message_Chat.models import Conversation, Message, ReadCursor
+
+
+class Command(BaseCommand):
+    help = 'Build or rebuild the Conversation summaries from existing Message rows'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='Number of conversations written per query (default: 500)'
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+
+        # One grouped pass over the message table, one row per direction
+        directed = (
+            Message.objects.order_by()
+            .values('sender_id', 'receiver_id')
+            .annotate(last_id=Max('id'), total=Count('id'))
+        )
+        last_read_ids = {
+            (user_a_id, user_b_id, user_id): last_read_id
+            for user_a_id, user_b_id, user_id, last_read_id in ReadCursor.objects.values_list(
+                'conversation__user_a_id', 'conversation__user_b_id', 'user_id', 'last_read_id'
+            )
+        }
+
+        summaries = {}
+        for row in directed.iterator():
+            pair = Conversation.participant_ids(row['sender_id'], row['receiver_id'])
+            summary = summaries.setdefault(pair, {'last_id': 0, 'unread_a': 0, 'unread_b': 0})
+            summary['last_id'] = max(summary['last_id'], row['last_id'])
+
+            last_read_id = last_read_ids.get((*pair, row['receiver_id']), 0)
+            if last_read_id == 0:
+                unread = row['total']
+            elif last_read_id >= row['last_id']:
+                unread = 0
+            else:
+                unread = ReadCursor.unread_count(row['receiver_id'], row['sender_id'], last_read_id)
+
+            if row['receiver_id'] == pair[0]:
+                summary['unread_a'] += unread
+            else:
+                summary['unread_b'] += unread
+
+        pairs = list(summaries.items())
+        for start in range(0, len(pairs), batch_size):
+            batch = pairs[start:start + batch_size]
+            timestamps = dict(
+                Message.objects.filter(id__in=[summary['last_id'] for pair, summary in batch])
+                .values_list('id', 'timestamp')
+            )
+            conversations = [
+                Conversation(
+                    user_a_id=user_a_id,
+                    user_b_id=user_b_id,
+                    last_message_id=summary['last_id'],
+                    last_activity=timestamps[summary['last_id']],
+                    unread_a=summary['unread_a'],
+                    unread_b=summary['unread_b']
+                )
+                for (user_a_id, user_b_id), summary in batch
+            ]
+            with transaction.atomic():
+                Conversation.objects.bulk_create(
+                    conversations,
+                    update_conflicts=True,
+                    unique_fields=['user_a', 'user_b'],
+                    update_fields=['last_message', 'last_activity', 'unread_a', 'unread_b']
+                )
+
+        self.stdout.write(self.style.SUCCESS(f'Backfilled {len(pairs)} conversations.'))
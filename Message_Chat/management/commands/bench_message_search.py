@@ -0,0 +1,108 @@
+import itertools
+import random
+import statistics
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+from Message_Chat import search
+from Message_Chat.models import Message
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmark message search on a synthetic corpus. Everything is written inside '
+        'a transaction that is rolled back, but point it at a scratch database anyway.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=1_000_000, help='Synthetic messages to index')
+        parser.add_argument('--users', type=int, default=2000, help='Synthetic users sending them')
+        parser.add_argument('--queries', type=int, default=200, help='Searches to time')
+        parser.add_argument('--vocabulary', type=int, default=20000, help='Distinct words in the corpus')
+        parser.add_argument('--compare-like', action='store_true', help='Also time a LIKE scan for a few queries')
+
+    def handle(self, *args, **options):
+        if not search.is_available():
+            raise CommandError('Message search needs the SQLite FTS5 index.')
+
+        rng = random.Random(42)
+        words = [f'w{index}' for index in range(options['vocabulary'])]
+        # Zipf-like weights, so a few words are very common and most are rare
+        cum_weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(len(words))))
+
+        try:
+            with transaction.atomic():
+                self.run(rng, words, cum_weights, options)
+                raise Rollback
+        except Rollback:
+            pass
+
+    def run(self, rng, words, cum_weights, options):
+        started = time.perf_counter()
+        User.objects.bulk_create(
+            User(username=f'bench-{index}', password='!') for index in range(options['users'])
+        )
+        user_ids = list(User.objects.filter(username__startswith='bench-').values_list('id', flat=True))
+
+        now = connection.ops.adapt_datetimefield_value(timezone.now())
+        rows = (
+            (
+                ' '.join(rng.choices(words, cum_weights=cum_weights, k=rng.randint(4, 16))),
+                now,
+                *rng.sample(user_ids, 2),
+            )
+            for _ in range(options['messages'])
+        )
+        # Raw inserts: the FTS triggers still fire for every row
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                'INSERT INTO Message_Chat_message (content, timestamp, sender_id, receiver_id) '
+                'VALUES (%s, %s, %s, %s)',
+                rows
+            )
+        self.stdout.write(
+            f"Indexed {options['messages']} messages in {time.perf_counter() - started:.1f}s."
+        )
+
+        users = list(User.objects.filter(id__in=rng.sample(user_ids, min(len(user_ids), 50))))
+        timings = []
+        hits = 0
+        for _ in range(options['queries']):
+            user = rng.choice(users)
+            query = ' '.join(rng.choices(words[:2000], k=rng.randint(1, 2)))
+            started = time.perf_counter()
+            results, next_cursor = search.search_messages(user, query)
+            if next_cursor:
+                search.search_messages(user, query, after=search.decode_cursor(next_cursor))
+            timings.append(((time.perf_counter() - started) * 1000, query))
+            hits += len(results)
+
+        timings.sort()
+        slowest = timings[-1][1]
+        timings = [elapsed for elapsed, query in timings]
+        self.stdout.write(
+            f"FTS5: {len(timings)} searches (first two pages each), {hits} hits on the first pages. "
+            f"p50 {statistics.median(timings):.2f} ms, "
+            f"p95 {timings[int(len(timings) * 0.95) - 1]:.2f} ms, max {timings[-1]:.2f} ms ({slowest!r})."
+        )
+
+        if options['compare_like']:
+            timings = []
+            for _ in range(5):
+                user = rng.choice(users)
+                word = rng.choice(words[:2000])
+                started = time.perf_counter()
+                list(
+                    Message.objects.filter(Q(sender=user) | Q(receiver=user), content__icontains=word)
+                    .order_by('-timestamp')[:20]
+                )
+                timings.append((time.perf_counter() - started) * 1000)
+            self.stdout.write(f"LIKE: p50 {statistics.median(timings):.2f} ms over {len(timings)} searches.")
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from Message_Chat.models import SyncEntry
+
+
+class Command(BaseCommand):
+    help = 'Delete sync journal entries older than the sync cursor retention'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=5000,
+            help='Number of entries deleted per query (default: 5000)'
+        )
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - SyncEntry.RETENTION
+        deleted = 0
+        while True:
+            ids = list(
+                SyncEntry.objects.filter(created_at__lt=cutoff)
+                .order_by('id')
+                .values_list('id', flat=True)[:options['batch_size']]
+            )
+            if not ids:
+                break
+            deleted += SyncEntry.objects.filter(id__in=ids).delete()[0]
+
+        self.stdout.write(self.style.SUCCESS(f'Deleted {deleted} sync entries.'))
@@ -0,0 +1,72 @@
+# Generated by Django 5.1.6 on 2026-10-17 06:23
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("Message_Chat", "0001_initial"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="Conversation",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("last_activity", models.DateTimeField(blank=True, null=True)),
+                ("unread_a", models.PositiveIntegerField(default=0)),
+                ("unread_b", models.PositiveIntegerField(default=0)),
+                (
+                    "last_message",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.SET_NULL,
+                        related_name="+",
+                        to="Message_Chat.message",
+                    ),
+                ),
+                (
+                    "user_a",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="conversations_as_a",
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+                (
+                    "user_b",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="conversations_as_b",
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        fields=["user_a", "-last_activity"],
+                        name="conversation_a_activity_idx",
+                    ),
+                    models.Index(
+                        fields=["user_b", "-last_activity"],
+                        name="conversation_b_activity_idx",
+                    ),
+                ],
+                "unique_together": {("user_a", "user_b")},
+            },
+        ),
+    ]
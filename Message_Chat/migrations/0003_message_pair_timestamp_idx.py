@@ -0,0 +1,22 @@
+# Generated by Django 5.1.6 on 2026-10-17 06:24
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("Message_Chat", "0002_conversation"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="message",
+            index=models.Index(
+                fields=["sender", "receiver", "timestamp"],
+                name="message_pair_timestamp_idx",
+            ),
+        ),
+    ]
@@ -0,0 +1,90 @@
+# Generated by Django 5.1.6 on 2026-10-17 06:30
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Max
+
+
+def create_read_cursors(apps, schema_editor):
+    """Turn the per-row is_read flags into one cursor per reader and conversation"""
+    Message = apps.get_model("Message_Chat", "Message")
+    Conversation = apps.get_model("Message_Chat", "Conversation")
+    ReadCursor = apps.get_model("Message_Chat", "ReadCursor")
+
+    read_upto = (
+        Message.objects.filter(is_read=True)
+        .order_by()
+        .values("sender_id", "receiver_id")
+        .annotate(last_read_id=Max("id"))
+    )
+    for row in read_upto.iterator():
+        user_a_id, user_b_id = sorted((row["sender_id"], row["receiver_id"]))
+        conversation, created = Conversation.objects.get_or_create(
+            user_a_id=user_a_id, user_b_id=user_b_id
+        )
+        ReadCursor.objects.update_or_create(
+            conversation=conversation,
+            user_id=row["receiver_id"],
+            defaults={"last_read_id": row["last_read_id"]},
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("Message_Chat", "0003_message_pair_timestamp_idx"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ReadCursor",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("last_read_id", models.PositiveBigIntegerField(default=0)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name="readcursor",
+            name="conversation",
+            field=models.ForeignKey(
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="read_cursors",
+                to="Message_Chat.conversation",
+            ),
+        ),
+        migrations.AddField(
+            model_name="readcursor",
+            name="user",
+            field=models.ForeignKey(
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="read_cursors",
+                to=settings.AUTH_USER_MODEL,
+            ),
+        ),
+        migrations.AlterUniqueTogether(
+            name="readcursor",
+            unique_together={("conversation", "user")},
+        ),
+        migrations.AddIndex(
+            model_name="message",
+            index=models.Index(
+                fields=["sender", "receiver", "id"], name="message_pair_id_idx"
+            ),
+        ),
+        migrations.RunPython(create_read_cursors, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name="message",
+            name="is_read",
+        ),
+    ]
@@ -0,0 +1,71 @@
+from django.db import migrations
+
+# FTS5 is specific to SQLite; other backends keep working without message search
+FORWARD_SQL = [
+    """
+    CREATE VIEW Message_Chat_message_fts_source AS
+    SELECT id, content, 'u' || sender_id || ' u' || receiver_id AS participants
+    FROM Message_Chat_message
+    """,
+    """
+    CREATE VIRTUAL TABLE Message_Chat_message_fts USING fts5(
+        content,
+        participants,
+        content='Message_Chat_message_fts_source',
+        content_rowid='id',
+        prefix='3',
+        tokenize='unicode61 remove_diacritics 2'
+    )
+    """,
+    """
+    CREATE TRIGGER Message_Chat_message_fts_insert AFTER INSERT ON Message_Chat_message BEGIN
+        INSERT INTO Message_Chat_message_fts (rowid, content, participants)
+        VALUES (new.id, new.content, 'u' || new.sender_id || ' u' || new.receiver_id);
+    END
+    """,
+    """
+    CREATE TRIGGER Message_Chat_message_fts_delete AFTER DELETE ON Message_Chat_message BEGIN
+        INSERT INTO Message_Chat_message_fts (Message_Chat_message_fts, rowid, content, participants)
+        VALUES ('delete', old.id, old.content, 'u' || old.sender_id || ' u' || old.receiver_id);
+    END
+    """,
+    """
+    CREATE TRIGGER Message_Chat_message_fts_update
+    AFTER UPDATE OF content, sender_id, receiver_id ON Message_Chat_message BEGIN
+        INSERT INTO Message_Chat_message_fts (Message_Chat_message_fts, rowid, content, participants)
+        VALUES ('delete', old.id, old.content, 'u' || old.sender_id || ' u' || old.receiver_id);
+        INSERT INTO Message_Chat_message_fts (rowid, content, participants)
+        VALUES (new.id, new.content, 'u' || new.sender_id || ' u' || new.receiver_id);
+    END
+    """,
+    "INSERT INTO Message_Chat_message_fts (Message_Chat_message_fts) VALUES ('rebuild')",
+]
+
+REVERSE_SQL = [
+    "DROP TRIGGER IF EXISTS Message_Chat_message_fts_update",
+    "DROP TRIGGER IF EXISTS Message_Chat_message_fts_delete",
+    "DROP TRIGGER IF EXISTS Message_Chat_message_fts_insert",
+    "DROP TABLE IF EXISTS Message_Chat_message_fts",
+    "DROP VIEW IF EXISTS Message_Chat_message_fts_source",
+]
+
+
+def run_sql(statements):
+    def run(apps, schema_editor):
+        if schema_editor.connection.vendor != "sqlite":
+            return
+        for statement in statements:
+            schema_editor.execute(statement)
+
+    return run
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("Message_Chat", "0004_readcursor"),
+    ]
+
+    operations = [
+        migrations.RunPython(run_sql(FORWARD_SQL), run_sql(REVERSE_SQL)),
+    ]
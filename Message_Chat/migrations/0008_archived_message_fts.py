@@ -0,0 +1,78 @@
+import json
+import zlib
+
+from django.db import migrations
+
+# FTS5 is specific to SQLite; other backends keep working without message search
+FORWARD_SQL = [
+    """
+    CREATE VIRTUAL TABLE Message_Chat_archived_fts USING fts5(
+        content,
+        participants,
+        sender_id UNINDEXED,
+        receiver_id UNINDEXED,
+        timestamp UNINDEXED,
+        prefix='3',
+        tokenize='unicode61 remove_diacritics 2'
+    )
+    """,
+]
+
+REVERSE_SQL = [
+    "DROP TABLE IF EXISTS Message_Chat_archived_fts",
+]
+
+INSERT_SQL = (
+    "INSERT INTO Message_Chat_archived_fts "
+    "(rowid, content, participants, sender_id, receiver_id, timestamp) "
+    "VALUES (%s, %s, %s, %s, %s, %s)"
+)
+
+
+def run_sql(statements):
+    def run(apps, schema_editor):
+        if schema_editor.connection.vendor != "sqlite":
+            return
+        for statement in statements:
+            schema_editor.execute(statement)
+
+    return run
+
+
+def index_archived_blocks(apps, schema_editor):
+    """Index messages archived before archived blocks were searchable"""
+    if schema_editor.connection.vendor != "sqlite":
+        return
+    ArchivedMessageBlock = apps.get_model("Message_Chat", "ArchivedMessageBlock")
+    with schema_editor.connection.cursor() as cursor:
+        for data in ArchivedMessageBlock.objects.values_list(
+            "data", flat=True
+        ).iterator():
+            cursor.executemany(
+                INSERT_SQL,
+                [
+                    (
+                        message_id,
+                        content,
+                        f"u{sender_id} u{receiver_id}",
+                        sender_id,
+                        receiver_id,
+                        micros,
+                    )
+                    for message_id, sender_id, receiver_id, micros, content in json.loads(
+                        zlib.decompress(data)
+                    )
+                ],
+            )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("Message_Chat", "0007_archivedmessageblock"),
+    ]
+
+    operations = [
+        migrations.RunPython(run_sql(FORWARD_SQL), run_sql(REVERSE_SQL)),
+        migrations.RunPython(index_archived_blocks, migrations.RunPython.noop),
+    ]
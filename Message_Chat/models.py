@@ -1,80 +1,497 @@
-from django.db import models
+import json
+import zlib
+from datetime import datetime, timedelta, timezone as dt_timezone
+from django.db import models, transaction
 from django.contrib.auth.models import User
-from django.db.models import Q, Max
+from django.utils.formats import date_format
+from django.utils.timezone import localtime
+from django.core.signing import TimestampSigner
+from django.db.models import Q, F, Sum, Max, Case, When, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from Core.counters import counters_changed
+from Core.friends import friend_ids
 from Core.models import Notification
 
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+
+def _epoch_micros(timestamp):
+    return (timestamp - EPOCH) // timedelta(microseconds=1)
+
+
+def _from_epoch_micros(micros):
+    return EPOCH + timedelta(microseconds=micros)
+
+
+class Conversation(models.Model):
+    """Denormalized summary of the messages exchanged between two users.
+
+    The pair is stored ordered by user id (``user_a_id < user_b_id``) so each
+    conversation has exactly one row regardless of who sent the first message.
+    """
+    user_a = models.ForeignKey(User, on_delete=models.CASCADE, related_name='conversations_as_a')
+    user_b = models.ForeignKey(User, on_delete=models.CASCADE, related_name='conversations_as_b')
+    last_message = models.ForeignKey('Message', on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    last_activity = models.DateTimeField(null=True, blank=True)
+    unread_a = models.PositiveIntegerField(default=0)
+    unread_b = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ['user_a', 'user_b']
+        indexes = [
+            models.Index(fields=['user_a', '-last_activity'], name='conversation_a_activity_idx'),
+            models.Index(fields=['user_b', '-last_activity'], name='conversation_b_activity_idx'),
+        ]
+
+    def __str__(self):
+        return f'Conversation between {self.user_a} and {self.user_b}'
+
+    @staticmethod
+    def participant_ids(user, other_user):
+        """Return the (user_a_id, user_b_id) pair for two users in storage order"""
+        user_id = getattr(user, 'pk', user)
+        other_id = getattr(other_user, 'pk', other_user)
+        return (user_id, other_id) if user_id < other_id else (other_id, user_id)
+
+    @staticmethod
+    def for_users(user, other_user):
+        """Get or create the conversation between two users"""
+        user_a_id, user_b_id = Conversation.participant_ids(user, other_user)
+        conversation, created = Conversation.objects.get_or_create(
+            user_a_id=user_a_id,
+            user_b_id=user_b_id
+        )
+        return conversation
+
+    @staticmethod
+    def get_between(user, other_user):
+        """Get the conversation between two users, or None if they never exchanged messages"""
+        user_a_id, user_b_id = Conversation.participant_ids(user, other_user)
+        return Conversation.objects.filter(user_a_id=user_a_id, user_b_id=user_b_id).first()
+
+    @staticmethod
+    def get_user_conversations(user):
+        """Get a user's conversations, most recently active first"""
+        return (
+            Conversation.objects.filter(Q(user_a=user) | Q(user_b=user))
+            .exclude(last_activity__isnull=True)
+            .select_related('user_a', 'user_b', 'last_message')
+            .order_by('-last_activity')
+        )
+
+    @staticmethod
+    def get_inbox(user, search_query=''):
+        """Get the user's friends annotated with their conversation summary.
+
+        Each friend carries ``last_message_id``, ``last_activity`` and
+        ``unread_count``; friends without messages sort by their join date.
+        """
+        friends = User.objects.filter(pk__in=friend_ids(user))
+        if search_query:
+            friends = friends.filter(username__icontains=search_query)
+
+        conversation = Conversation.objects.filter(
+            Q(user_a=user, user_b=OuterRef('pk')) | Q(user_a=OuterRef('pk'), user_b=user)
+        )
+        unread = Case(When(user_a=user, then='unread_a'), default='unread_b')
+        return (
+            friends.select_related('userprofile')
+            .annotate(
+                last_message_id=Subquery(conversation.values('last_message')[:1]),
+                last_activity=Subquery(conversation.values('last_activity')[:1]),
+                unread_count=Coalesce(Subquery(conversation.annotate(unread=unread).values('unread')[:1]), 0),
+            )
+            .order_by(Coalesce('last_activity', 'date_joined').desc(), 'pk')
+        )
+
+    @staticmethod
+    def get_unread_total(user):
+        """Sum the unread counters of every conversation the user takes part in"""
+        total = Conversation.objects.filter(Q(user_a=user) | Q(user_b=user)).aggregate(
+            total=Sum(Case(When(user_a=user, then='unread_a'), default='unread_b'))
+        )['total']
+        return total or 0
+
+    def other_user(self, user):
+        return self.user_b if self.user_a_id == user.pk else self.user_a
+
+    def unread_for(self, user):
+        return self.unread_a if self.user_a_id == user.pk else self.unread_b
+
+    @staticmethod
+    def record_message(message):
+        """Update the conversation summary for a newly saved message"""
+        conversation = Conversation.for_users(message.sender_id, message.receiver_id)
+        unread_field = 'unread_a' if message.receiver_id == conversation.user_a_id else 'unread_b'
+        Conversation.objects.filter(pk=conversation.pk).update(
+            last_message=message,
+            last_activity=message.timestamp,
+            **{unread_field: F(unread_field) + 1}
+        )
+        return conversation
+
+    @staticmethod
+    def set_unread(user, other_user, count):
+        """Overwrite the user's unread counter for the conversation with other_user"""
+        user_a_id, user_b_id = Conversation.participant_ids(user, other_user)
+        unread_field = 'unread_a' if getattr(user, 'pk', user) == user_a_id else 'unread_b'
+        Conversation.objects.filter(user_a_id=user_a_id, user_b_id=user_b_id).update(**{unread_field: count})
+
 class Message(models.Model):
     sender = models.ForeignKey(User, on_delete=models.CASCADE, related_name='sent_messages')
     receiver = models.ForeignKey(User, on_delete=models.CASCADE, related_name='received_messages')
     content = models.TextField()
     timestamp = models.DateTimeField(auto_now_add=True)
-    is_read = models.BooleanField(default=False)
 
     class Meta:
         ordering = ['timestamp']
+        indexes = [
+            models.Index(fields=['sender', 'receiver', 'timestamp'], name='message_pair_timestamp_idx'),
+            models.Index(fields=['sender', 'receiver', 'id'], name='message_pair_id_idx'),
+        ]
 
     def __str__(self):
         return f'Message from {self.sender} to {self.receiver} at {self.timestamp}'
 
     def save(self, *args, **kwargs):
         is_new = self.pk is None
-        super().save(*args, **kwargs)
-        
-        if is_new:
-            # Create notification for new message
-            Notification.objects.create(
-                user=self.receiver,
-                notification_type='new_message',
-                message=f'New message from {self.sender.username}',
-                related_user=self.sender,
-                related_message=self
-            )
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+
+            if is_new:
+                # Keep the conversation summary in step with the message
+                Conversation.record_message(self)
+                SyncEntry.record_message(self)
+
+                # One unread notification per conversation, bumped for every message
+                Notification.notify_new_message(self)
+                counters_changed(self.receiver_id)
+
+    def serialize(self, user):
+        """JSON-ready representation of the message as seen by `user`"""
+        return {
+            'id': self.id,
+            'content': self.content,
+            'timestamp': self.timestamp.isoformat(),
+            'time': date_format(localtime(self.timestamp), 'g:i A'),
+            'is_mine': self.sender_id == user.pk,
+            'is_read': getattr(self, 'is_read', False),
+        }
 
     @staticmethod
     def get_conversations(user):
         """Get all conversations for a user with the last message and unread count"""
-        # Get all users that the current user has chatted with
-        conversations = (
-            Message.objects.filter(Q(sender=user) | Q(receiver=user))
-            .values('sender', 'receiver')
-            .annotate(last_message_time=Max('timestamp'))
-            .order_by('-last_message_time')
-        )
-        
-        conversation_data = []
-        for conv in conversations:
-            other_user = User.objects.get(
-                id=(conv['receiver'] if conv['sender'] == user.id else conv['sender'])
-            )
-            
-            # Get the last message
-            last_message = Message.objects.filter(
-                Q(sender=user, receiver=other_user) | 
-                Q(sender=other_user, receiver=user)
-            ).latest('timestamp')
-            
-            # Count unread messages
-            unread_count = Message.objects.filter(
-                sender=other_user,
-                receiver=user,
-                is_read=False
-            ).count()
-            
-            conversation_data.append({
-                'user': other_user,
-                'last_message': last_message,
-                'unread_count': unread_count
-            })
-            
-        return conversation_data
+        return [
+            {
+                'user': conversation.other_user(user),
+                'last_message': conversation.last_message,
+                'unread_count': conversation.unread_for(user)
+            }
+            for conversation in Conversation.get_user_conversations(user)
+        ]
+
+    @staticmethod
+    def encode_cursor(message):
+        """Build the opaque keyset cursor pointing just before a message"""
+        return f'{_epoch_micros(message.timestamp)}-{message.id}'
+
+    @staticmethod
+    def decode_cursor(cursor):
+        """Parse a cursor from encode_cursor into (timestamp, id), or None if malformed"""
+        try:
+            micros, message_id = cursor.split('-')
+            timestamp = _from_epoch_micros(int(micros))
+            return timestamp, int(message_id)
+        except (AttributeError, ValueError, OverflowError, OSError):
+            return None
+
+    @staticmethod
+    def get_history_page(user, other_user, before=None, limit=50):
+        """Get up to `limit` messages between two users older than the `before` cursor.
+
+        Each direction is read with its own (sender, receiver, timestamp) index range
+        capped at limit + 1 rows, so the cost depends on the page size rather than
+        on how long the conversation is. Returns (messages oldest first, has_more).
+        """
+        page = []
+        for sender, receiver in ((user, other_user), (other_user, user)):
+            queryset = Message.objects.filter(sender=sender, receiver=receiver)
+            if before:
+                timestamp, message_id = before
+                queryset = queryset.filter(timestamp__lte=timestamp).exclude(
+                    timestamp=timestamp, id__gte=message_id
+                )
+            page.extend(queryset.order_by('-timestamp', '-id')[:limit + 1])
+
+        page.sort(key=lambda message: (message.timestamp, message.id), reverse=True)
+
+        # Older history may have been moved to archived blocks
+        page.extend(ArchivedMessageBlock.get_messages_before(
+            user,
+            other_user,
+            before=before,
+            limit=limit + 1,
+            newer_than=page[limit].timestamp if len(page) > limit else None
+        ))
+        page.sort(key=lambda message: (message.timestamp, message.id), reverse=True)
+        has_more = len(page) > limit
+        page = page[:limit]
+        page.reverse()
+        ReadCursor.annotate_read_state(page, user, other_user)
+        return page, has_more
 
     @staticmethod
     def get_unread_count(user):
         """Get total unread messages count for a user"""
-        return Message.objects.filter(receiver=user, is_read=False).count()
+        return Conversation.get_unread_total(user)
 
     def mark_as_read(self):
-        """Mark the message as read"""
-        if not self.is_read:
-            self.is_read = True
-            self.save()
+        """Mark the message, and everything before it in the conversation, as read"""
+        conversation = Conversation.for_users(self.sender_id, self.receiver_id)
+        if ReadCursor.advance(self.receiver_id, conversation, self.id):
+            unread_count = ReadCursor.unread_count(self.receiver_id, self.sender_id, self.id)
+            Conversation.set_unread(self.receiver_id, self.sender_id, unread_count)
+            SyncEntry.record_read(self.receiver_id, self.sender_id, self.id)
+            if not unread_count:
+                Notification.mark_messages_read(self.receiver_id, self.sender_id)
+            counters_changed(self.receiver_id)
+
+
+class ArchivedMessageBlock(models.Model):
+    """A batch of old messages of one conversation, moved out of the hot message table.
+
+    The messages are stored as zlib-compressed JSON and read back by
+    ``Message.get_history_page`` once a conversation's hot rows run out.
+    """
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='archived_blocks')
+    first_id = models.PositiveBigIntegerField()
+    last_id = models.PositiveBigIntegerField()
+    first_timestamp = models.DateTimeField()
+    last_timestamp = models.DateTimeField()
+    message_count = models.PositiveIntegerField()
+    data = models.BinaryField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['conversation', '-last_timestamp'], name='archivedblock_activity_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.message_count} archived messages of {self.conversation_id}'
+
+    @staticmethod
+    def from_messages(conversation, messages):
+        """Build an unsaved block from messages sorted by (timestamp, id)"""
+        rows = [
+            [message.id, message.sender_id, message.receiver_id, _epoch_micros(message.timestamp), message.content]
+            for message in messages
+        ]
+        return ArchivedMessageBlock(
+            conversation=conversation,
+            first_id=messages[0].id,
+            last_id=messages[-1].id,
+            first_timestamp=messages[0].timestamp,
+            last_timestamp=messages[-1].timestamp,
+            message_count=len(messages),
+            data=zlib.compress(json.dumps(rows, separators=(',', ':')).encode(), 9)
+        )
+
+    def get_rows(self):
+        """Decompress the block into [id, sender_id, receiver_id, epoch micros, content] rows"""
+        return json.loads(zlib.decompress(self.data))
+
+    @staticmethod
+    def rows_to_messages(rows):
+        return [
+            Message(
+                id=message_id,
+                sender_id=sender_id,
+                receiver_id=receiver_id,
+                timestamp=_from_epoch_micros(micros),
+                content=content
+            )
+            for message_id, sender_id, receiver_id, micros, content in rows
+        ]
+
+    @staticmethod
+    def get_messages_before(user, other_user, before=None, limit=50, newer_than=None):
+        """Get up to `limit` archived messages before the cursor, newest first.
+
+        Blocks ending before `newer_than` (a timestamp) are skipped, so callers
+        whose page is already full from the hot table pay for a single empty
+        index lookup.
+        """
+        user_a_id, user_b_id = Conversation.participant_ids(user, other_user)
+        blocks = ArchivedMessageBlock.objects.filter(
+            conversation__user_a_id=user_a_id,
+            conversation__user_b_id=user_b_id
+        ).order_by('-last_timestamp', '-last_id')
+        if before:
+            blocks = blocks.filter(first_timestamp__lte=before[0])
+        if newer_than:
+            blocks = blocks.filter(last_timestamp__gte=newer_than)
+
+        # Compare raw (micros, id) keys and only build Message objects for the page
+        before_key = (_epoch_micros(before[0]), before[1]) if before else None
+        found = []
+        for block in blocks.iterator(chunk_size=4):
+            # Blocks may overlap in time, stop once no later block can beat the page
+            if len(found) >= limit and _epoch_micros(block.last_timestamp) < found[limit - 1][3]:
+                break
+            found.extend(
+                row for row in block.get_rows()
+                if before_key is None or (row[3], row[0]) < before_key
+            )
+            found.sort(key=lambda row: (row[3], row[0]), reverse=True)
+            del found[limit:]
+        return ArchivedMessageBlock.rows_to_messages(found)
+
+
+class ReadCursor(models.Model):
+    """The last message a user has read in a conversation.
+
+    Every message the user received in the conversation with an id up to
+    ``last_read_id`` counts as read, so marking a conversation read is a single
+    row upsert instead of an UPDATE of every unread message.
+    """
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='read_cursors')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='read_cursors')
+    last_read_id = models.PositiveBigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ['conversation', 'user']
+
+    def __str__(self):
+        return f'{self.user} read up to message {self.last_read_id}'
+
+    @staticmethod
+    def mark_read(user, conversation, last_read_id):
+        """Upsert the user's cursor for the conversation to last_read_id"""
+        ReadCursor.objects.bulk_create(
+            [ReadCursor(conversation=conversation, user_id=getattr(user, 'pk', user), last_read_id=last_read_id)],
+            update_conflicts=True,
+            unique_fields=['conversation', 'user'],
+            update_fields=['last_read_id', 'updated_at']
+        )
+
+    @staticmethod
+    def advance(user, conversation, last_read_id):
+        """Move the cursor forward to last_read_id; returns False if it was already there"""
+        user_id = getattr(user, 'pk', user)
+        if ReadCursor.objects.filter(
+            conversation=conversation, user_id=user_id, last_read_id__gte=last_read_id
+        ).exists():
+            return False
+        ReadCursor.mark_read(user_id, conversation, last_read_id)
+        return True
+
+    @staticmethod
+    def get_last_read_ids(user, other_user):
+        """Map user id to last read message id for both participants of a conversation"""
+        user_a_id, user_b_id = Conversation.participant_ids(user, other_user)
+        return dict(
+            ReadCursor.objects.filter(
+                conversation__user_a_id=user_a_id,
+                conversation__user_b_id=user_b_id
+            ).values_list('user_id', 'last_read_id')
+        )
+
+    @staticmethod
+    def unread_count(user, other_user, last_read_id=None):
+        """Count messages from other_user after the user's cursor with one index range scan"""
+        user_id = getattr(user, 'pk', user)
+        if last_read_id is None:
+            last_read_id = ReadCursor.get_last_read_ids(user, other_user).get(user_id, 0)
+        return Message.objects.filter(
+            sender_id=getattr(other_user, 'pk', other_user),
+            receiver_id=user_id,
+            id__gt=last_read_id
+        ).count()
+
+    @staticmethod
+    def annotate_read_state(messages, user, other_user):
+        """Set `is_read` on each message from its receiver's cursor"""
+        if not messages:
+            return messages
+        last_read_ids = ReadCursor.get_last_read_ids(user, other_user)
+        for message in messages:
+            message.is_read = message.id <= last_read_ids.get(message.receiver_id, 0)
+        return messages
+
+
+class SyncEntry(models.Model):
+    """Append-only journal of chat changes, replayed by clients through the sync endpoint.
+
+    Ids only grow, so everything a user has not seen yet is one range scan of the
+    ``(user, id)`` index past the id encoded in the client's cursor.
+    """
+    KIND_CHOICES = [
+        ('message', 'New message'),
+        ('read', 'Read by the other user'),
+        ('self_read', 'Read on another device'),
+    ]
+
+    # Cursors older than this are rejected and entries older than this are pruned
+    RETENTION = timedelta(days=7)
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    other_user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    message = models.ForeignKey(Message, on_delete=models.CASCADE, related_name='+')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'id'], name='syncentry_user_id_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.kind} for {self.user_id} with {self.other_user_id}'
+
+    @staticmethod
+    def record_message(message):
+        SyncEntry.objects.bulk_create([
+            SyncEntry(user_id=message.receiver_id, kind='message', other_user_id=message.sender_id, message=message),
+            SyncEntry(user_id=message.sender_id, kind='message', other_user_id=message.receiver_id, message=message),
+        ])
+
+    @staticmethod
+    def record_read(user, other_user, last_read_id):
+        """Journal that `user` read the conversation with `other_user` up to last_read_id"""
+        user_id = getattr(user, 'pk', user)
+        other_id = getattr(other_user, 'pk', other_user)
+        SyncEntry.objects.bulk_create([
+            SyncEntry(user_id=other_id, kind='read', other_user_id=user_id, message_id=last_read_id),
+            SyncEntry(user_id=user_id, kind='self_read', other_user_id=other_id, message_id=last_read_id),
+        ])
+
+    @staticmethod
+    def _signer(user):
+        return TimestampSigner(salt=f'message-sync:{getattr(user, "pk", user)}')
+
+    @staticmethod
+    def encode_cursor(user, entry_id):
+        return SyncEntry._signer(user).sign(str(entry_id))
+
+    @staticmethod
+    def decode_cursor(user, cursor):
+        """Return the entry id of a cursor; raises BadSignature, or SignatureExpired once too old"""
+        return int(SyncEntry._signer(user).unsign(cursor, max_age=SyncEntry.RETENTION))
+
+    @staticmethod
+    def current_cursor(user):
+        """Cursor pointing past every change recorded for the user so far"""
+        last_id = SyncEntry.objects.filter(user=user).aggregate(last_id=Max('id'))['last_id']
+        return SyncEntry.encode_cursor(user, last_id or 0)
+
+    @staticmethod
+    def get_changes(user, after_id, limit=200):
+        """Return (entries, has_more) for the user's changes recorded after after_id"""
+        entries = list(
+            SyncEntry.objects.filter(user=user, id__gt=after_id)
+            .select_related('other_user', 'message')
+            .order_by('id')[:limit + 1]
+        )
+        return entries[:limit], len(entries) > limit
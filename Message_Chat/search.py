@@ -0,0 +1,173 @@
+"""
+Full-text search over chat messages backed by an SQLite FTS5 index.
+
+``Message_Chat_message_fts`` is an external-content FTS5 table over the
+``Message_Chat_message_fts_source`` view, which adds a ``participants`` column
+holding one ``u<id>`` token per participant. Restricting a search to the user's
+own conversations is then another term of the MATCH expression, resolved from
+the same inverted index as the text itself. Triggers created by the migration
+keep the index in step with inserts, updates and deletes.
+
+Messages moved into ``ArchivedMessageBlock`` rows leave the hot table, so the
+triggers drop them from that index. ``Message_Chat_archived_fts`` keeps them
+searchable: it stores its own copy of each archived message, is filled by the
+archive_messages command and emptied as blocks are deleted, and is searched
+together with the hot index in one ranked query.
+"""
+import re
+
+from django.db import connection
+from django.utils.html import escape
+
+from django.contrib.auth.models import User
+
+from .models import Message, _epoch_micros, _from_epoch_micros
+
+# Control characters cannot appear in tokens, so they are safe highlight markers
+HIGHLIGHT_START = '\x02'
+HIGHLIGHT_END = '\x03'
+
+# bm25 weights: only the message text counts towards relevance, not the participants.
+# Archived hits carry their message; hot hits are loaded from the Message table.
+SEARCH_SQL = (
+    "SELECT message_id, highlighted, score, sender_id, receiver_id, timestamp, content FROM ("
+    "SELECT rowid AS message_id, highlight(Message_Chat_message_fts, 0, %s, %s) AS highlighted, "
+    "rank AS score, NULL AS sender_id, NULL AS receiver_id, NULL AS timestamp, NULL AS content "
+    "FROM Message_Chat_message_fts "
+    "WHERE Message_Chat_message_fts MATCH %s AND rank MATCH 'bm25(1.0, 0.0)' "
+    "UNION ALL "
+    "SELECT rowid, highlight(Message_Chat_archived_fts, 0, %s, %s), "
+    "rank, sender_id, receiver_id, timestamp, content "
+    "FROM Message_Chat_archived_fts "
+    "WHERE Message_Chat_archived_fts MATCH %s AND rank MATCH 'bm25(1.0, 0.0)'"
+    ") {keyset} "
+    "ORDER BY score, message_id LIMIT %s"
+)
+KEYSET_SQL = "WHERE score > %s OR (score = %s AND message_id > %s)"
+
+ARCHIVE_INSERT_SQL = (
+    "INSERT INTO Message_Chat_archived_fts "
+    "(rowid, content, participants, sender_id, receiver_id, timestamp) "
+    "VALUES (%s, %s, %s, %s, %s, %s)"
+)
+ARCHIVE_DELETE_SQL = "DELETE FROM Message_Chat_archived_fts WHERE rowid = %s"
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+# Matches the smallest prefix index declared on the FTS5 table
+MIN_PREFIX_LENGTH = 3
+
+
+def is_available():
+    return connection.vendor == 'sqlite'
+
+
+def index_archived(messages):
+    """Keep messages being archived searchable once they leave the hot table"""
+    if not is_available() or not messages:
+        return
+    with connection.cursor() as cursor:
+        cursor.executemany(ARCHIVE_INSERT_SQL, [
+            (
+                message.id,
+                message.content,
+                f'u{message.sender_id} u{message.receiver_id}',
+                message.sender_id,
+                message.receiver_id,
+                _epoch_micros(message.timestamp),
+            )
+            for message in messages
+        ])
+
+
+def unindex_archived(message_ids):
+    """Drop archived messages from the search index"""
+    if not is_available() or not message_ids:
+        return
+    with connection.cursor() as cursor:
+        cursor.executemany(ARCHIVE_DELETE_SQL, [(message_id,) for message_id in message_ids])
+
+
+def build_match(user_id, query):
+    """Turn free text into an FTS5 expression limited to the user's conversations.
+
+    Every word is quoted so FTS5 operators typed by the user are taken literally,
+    and the last word matches as a prefix to support search-as-you-type. Shorter
+    words are matched exactly: their prefixes expand to too many index terms.
+    """
+    terms = TOKEN_RE.findall(query)
+    if not terms:
+        return None
+    quoted = [f'"{term}"' for term in terms]
+    if len(terms[-1]) >= MIN_PREFIX_LENGTH:
+        quoted[-1] += '*'
+    return f'participants : "u{user_id}" AND content : ({" ".join(quoted)})'
+
+
+def encode_cursor(rank, message_id):
+    return f'{rank!r}:{message_id}'
+
+
+def decode_cursor(cursor):
+    try:
+        rank, message_id = cursor.rsplit(':', 1)
+        return float(rank), int(message_id)
+    except (AttributeError, ValueError):
+        return None
+
+
+def _highlight_html(text):
+    return (
+        escape(text)
+        .replace(HIGHLIGHT_START, '<mark>')
+        .replace(HIGHLIGHT_END, '</mark>')
+    )
+
+
+def search_messages(user, query, after=None, limit=20):
+    """Rank the user's messages matching `query`, best first.
+
+    Returns (hits, next_cursor) where each hit pairs a Message with its content
+    highlighted as HTML; `after` is a cursor previously returned as next_cursor.
+    """
+    match = build_match(user.pk, query)
+    if match is None:
+        return [], None
+
+    params = [HIGHLIGHT_START, HIGHLIGHT_END, match] * 2
+    keyset = ''
+    if after is not None:
+        rank, message_id = after
+        keyset = KEYSET_SQL
+        params += [rank, rank, message_id]
+    params.append(limit + 1)
+
+    with connection.cursor() as cursor:
+        cursor.execute(SEARCH_SQL.format(keyset=keyset), params)
+        rows = cursor.fetchall()
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    messages = Message.objects.select_related('sender', 'receiver').in_bulk(
+        [row[0] for row in rows if row[3] is None]
+    )
+    users = User.objects.in_bulk(
+        {user_id for row in rows if row[3] is not None for user_id in (row[3], row[4])}
+    )
+    for message_id, _, _, sender_id, receiver_id, timestamp, content in rows:
+        if sender_id is not None and sender_id in users and receiver_id in users:
+            messages[message_id] = Message(
+                id=message_id,
+                sender=users[sender_id],
+                receiver=users[receiver_id],
+                content=content,
+                timestamp=_from_epoch_micros(timestamp),
+            )
+
+    hits = [
+        {'message': messages[row[0]], 'highlighted': _highlight_html(row[1]), 'rank': row[2]}
+        for row in rows
+        if row[0] in messages
+    ]
+    next_cursor = encode_cursor(rows[-1][2], rows[-1][0]) if has_more else None
+    return hits, next_cursor
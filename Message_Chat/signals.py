@@ -0,0 +1,26 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from Core.events import publish_on_commit
+from . import search
+from .models import ArchivedMessageBlock, Message
+
+
+@receiver(post_save, sender=Message)
+def push_new_message(sender, instance, created, **kwargs):
+    """Push a new message to the open streams of both participants"""
+    if not created:
+        return
+    publish_on_commit(instance.receiver_id, 'message', {
+        **instance.serialize(instance.receiver),
+        'with_user': instance.sender.username,
+    })
+    publish_on_commit(instance.sender_id, 'message', {
+        **instance.serialize(instance.sender),
+        'with_user': instance.receiver.username,
+    })
+
+
+@receiver(post_delete, sender=ArchivedMessageBlock)
+def unindex_archived_block(sender, instance, **kwargs):
+    """Remove a deleted block's messages from the search index"""
+    search.unindex_archived([row[0] for row in instance.get_rows()])
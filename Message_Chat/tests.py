@@ -1,3 +1,488 @@
-from django.test import TestCase
+from datetime import timedelta
+from io import StringIO
+from unittest.mock import patch
+from django.db import connection
+from django.test import TestCase, Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from Core.events import broker
+from Core.models import Friendship, Notification
+from .models import ArchivedMessageBlock, Message, Conversation, ReadCursor, SyncEntry
 
 # Create your tests here.
+
+class BaseChatTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = Client()
+        self.user = User.objects.create_user(
+            username='testuser',
+            email='test@example.com',
+            password='testpass123'
+        )
+        self.friend = User.objects.create_user(
+            username='frienduser',
+            email='friend@example.com',
+            password='testpass123'
+        )
+        Friendship.objects.create(sender=self.user, receiver=self.friend, status='accepted')
+
+
+class ConversationTests(BaseChatTestCase):
+    def test_message_save_updates_conversation(self):
+        first = Message.objects.create(sender=self.user, receiver=self.friend, content='Hi')
+        second = Message.objects.create(sender=self.user, receiver=self.friend, content='Still there?')
+
+        conversation = Conversation.objects.get()
+        self.assertEqual(conversation.last_message, second)
+        self.assertEqual(conversation.last_activity, second.timestamp)
+        self.assertEqual(conversation.unread_for(self.friend), 2)
+        self.assertEqual(conversation.unread_for(self.user), 0)
+        self.assertEqual(Message.get_unread_count(self.friend), 2)
+
+    def test_get_conversations_query_count_is_constant(self):
+        for index in range(5):
+            other = User.objects.create_user(username=f'other{index}', password='testpass123')
+            Message.objects.create(sender=other, receiver=self.user, content='Hello')
+
+        with self.assertNumQueries(1):
+            conversations = Message.get_conversations(self.user)
+        self.assertEqual(len(conversations), 5)
+        self.assertEqual(conversations[0]['user'].username, 'other4')
+        self.assertEqual(conversations[0]['unread_count'], 1)
+
+    def test_chat_view_resets_unread_counter(self):
+        Message.objects.create(sender=self.friend, receiver=self.user, content='Hi')
+        self.client.login(username='testuser', password='testpass123')
+        response = self.client.get(reverse('message_chat:chat_detail', kwargs={'username': 'frienduser'}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Message.get_unread_count(self.user), 0)
+
+    def test_mark_as_read_decrements_counter(self):
+        message = Message.objects.create(sender=self.friend, receiver=self.user, content='Hi')
+        Message.objects.create(sender=self.friend, receiver=self.user, content='Hello?')
+        message.mark_as_read()
+        self.assertEqual(Message.get_unread_count(self.user), 1)
+
+    def test_backfill_conversations(self):
+        Message.objects.create(sender=self.friend, receiver=self.user, content='Hi')
+        last = Message.objects.create(sender=self.user, receiver=self.friend, content='Hey')
+        Conversation.objects.all().delete()
+
+        call_command('backfill_conversations', stdout=StringIO())
+
+        conversation = Conversation.objects.get()
+        self.assertEqual(conversation.last_message, last)
+        self.assertEqual(conversation.unread_for(self.user), 1)
+        self.assertEqual(conversation.unread_for(self.friend), 1)
+
+
+class MessageNotificationTests(BaseChatTestCase):
+    def unread_notifications(self):
+        return Notification.objects.filter(user=self.friend, notification_type='new_message', read=False)
+
+    def test_messages_are_coalesced_into_one_notification(self):
+        for index in range(3):
+            latest = Message.objects.create(sender=self.user, receiver=self.friend, content=f'Line {index}')
+
+        notification = self.unread_notifications().get()
+        self.assertEqual(notification.count, 3)
+        self.assertEqual(notification.related_message, latest)
+        self.assertEqual(notification.message, '3 new messages from testuser')
+
+    def test_opening_chat_marks_notification_read(self):
+        Message.objects.create(sender=self.user, receiver=self.friend, content='Hi')
+        self.client.login(username='frienduser', password='testpass123')
+        self.client.get(reverse('message_chat:chat_detail', kwargs={'username': 'testuser'}))
+        self.assertFalse(self.unread_notifications().exists())
+
+        Message.objects.create(sender=self.user, receiver=self.friend, content='Again')
+        self.assertEqual(self.unread_notifications().get().count, 1)
+        self.assertEqual(Notification.objects.filter(notification_type='new_message').count(), 2)
+
+    def test_mark_as_read_clears_notification(self):
+        Message.objects.create(sender=self.user, receiver=self.friend, content='One')
+        latest = Message.objects.create(sender=self.user, receiver=self.friend, content='Two')
+        latest.mark_as_read()
+        self.assertFalse(self.unread_notifications().exists())
+
+
+class ChatListTests(BaseChatTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client.login(username='testuser', password='testpass123')
+
+    def add_friends(self, count):
+        for index in range(count):
+            friend = User.objects.create_user(username=f'reader{User.objects.count()}', password='testpass123')
+            Friendship.objects.create(sender=friend, receiver=self.user, status='accepted')
+            Message.objects.create(sender=friend, receiver=self.user, content=f'Hello {index}')
+
+    def chat_list_queries(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(reverse('message_chat:chat_list'))
+        self.assertEqual(response.status_code, 200)
+        return len(context.captured_queries)
+
+    def test_query_count_is_constant(self):
+        self.add_friends(3)
+        queries = self.chat_list_queries()
+        self.add_friends(10)
+        self.assertEqual(self.chat_list_queries(), queries)
+
+    def test_conversations_ordered_by_last_activity(self):
+        self.add_friends(2)
+        Message.objects.create(sender=self.friend, receiver=self.user, content='Latest')
+        Message.objects.create(sender=self.friend, receiver=self.user, content='Really latest')
+
+        conversations = self.client.get(reverse('message_chat:chat_list')).context['conversations']
+        self.assertEqual(
+            [conv['friend'].username for conv in conversations],
+            ['frienduser', 'reader3', 'reader2']
+        )
+        self.assertEqual(conversations[0]['last_message'].content, 'Really latest')
+        self.assertEqual(conversations[0]['unread_count'], 2)
+
+    def test_search_filters_friends_in_sql(self):
+        self.add_friends(2)
+        response = self.client.get(reverse('message_chat:chat_list'), {'q': 'FRIEND'})
+        self.assertEqual([conv['friend'].username for conv in response.context['conversations']], ['frienduser'])
+
+    def test_friends_without_messages_are_listed(self):
+        conversations = self.client.get(reverse('message_chat:chat_list')).context['conversations']
+        self.assertEqual(conversations[0]['friend'], self.friend)
+        self.assertIsNone(conversations[0]['last_message'])
+        self.assertEqual(conversations[0]['unread_count'], 0)
+
+    def test_pagination(self):
+        self.add_friends(3)
+        with patch('Message_Chat.views.CHAT_LIST_PAGE_SIZE', 2):
+            first = self.client.get(reverse('message_chat:chat_list')).context
+            second = self.client.get(reverse('message_chat:chat_list'), {'page': 2}).context
+        self.assertEqual(len(first['conversations']), 2)
+        self.assertEqual(len(second['conversations']), 2)
+        self.assertFalse(second['page_obj'].has_next())
+
+
+class ChatHistoryTests(BaseChatTestCase):
+    def setUp(self):
+        super().setUp()
+        for index in range(7):
+            sender, receiver = (self.user, self.friend) if index % 2 else (self.friend, self.user)
+            Message.objects.create(sender=sender, receiver=receiver, content=f'message {index}')
+        self.client.login(username='testuser', password='testpass123')
+
+    def test_history_page_returns_latest_messages_oldest_first(self):
+        page, has_more = Message.get_history_page(self.user, self.friend, limit=3)
+        self.assertTrue(has_more)
+        self.assertEqual([message.content for message in page], ['message 4', 'message 5', 'message 6'])
+
+    def test_history_pages_chain_through_cursor(self):
+        page, has_more = Message.get_history_page(self.user, self.friend, limit=3)
+        seen = [message.content for message in page]
+        while has_more:
+            before = Message.decode_cursor(Message.encode_cursor(page[0]))
+            page, has_more = Message.get_history_page(self.user, self.friend, before=before, limit=3)
+            seen = [message.content for message in page] + seen
+        self.assertEqual(seen, [f'message {index}' for index in range(7)])
+
+    def test_chat_view_renders_latest_page_only(self):
+        with patch('Message_Chat.views.CHAT_PAGE_SIZE', 2):
+            response = self.client.get(reverse('message_chat:chat_detail', kwargs={'username': 'frienduser'}))
+        self.assertEqual(len(response.context['chat_messages']), 2)
+        self.assertTrue(response.context['has_older'])
+        self.assertNotContains(response, 'message 4')
+
+    def test_chat_history_endpoint(self):
+        latest = Message.objects.latest('id')
+        response = self.client.get(
+            reverse('message_chat:chat_history', kwargs={'username': 'frienduser'}),
+            {'before': Message.encode_cursor(latest)}
+        )
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(len(data['messages']), 6)
+        self.assertFalse(data['has_more'])
+        self.assertEqual(data['messages'][-1]['content'], 'message 5')
+        self.assertTrue(data['messages'][-1]['is_mine'])
+
+    def test_chat_history_rejects_bad_cursor(self):
+        response = self.client.get(
+            reverse('message_chat:chat_history', kwargs={'username': 'frienduser'}),
+            {'before': 'not-a-cursor'}
+        )
+        self.assertEqual(response.status_code, 400)
+
+    def test_chat_history_requires_friendship(self):
+        stranger = User.objects.create_user(username='stranger', password='testpass123')
+        response = self.client.get(reverse('message_chat:chat_history', kwargs={'username': stranger.username}))
+        self.assertEqual(response.status_code, 403)
+
+
+class RealtimeMessageTests(BaseChatTestCase):
+    def test_new_message_is_pushed_to_both_participants(self):
+        with patch.object(broker, 'has_subscribers', return_value=True), \
+                patch.object(broker, 'publish') as publish, \
+                self.captureOnCommitCallbacks(execute=True):
+            Message.objects.create(sender=self.user, receiver=self.friend, content='Hi')
+
+        message_events = {
+            call.args[0]: call.args[2] for call in publish.call_args_list if call.args[1] == 'message'
+        }
+        self.assertFalse(message_events[self.friend.id]['is_mine'])
+        self.assertEqual(message_events[self.friend.id]['with_user'], 'testuser')
+        self.assertTrue(message_events[self.user.id]['is_mine'])
+        self.assertEqual(message_events[self.user.id]['with_user'], 'frienduser')
+
+
+class ReadCursorTests(BaseChatTestCase):
+    def test_opening_chat_advances_cursor(self):
+        Message.objects.create(sender=self.friend, receiver=self.user, content='Hi')
+        latest = Message.objects.create(sender=self.friend, receiver=self.user, content='Hello?')
+        self.client.login(username='testuser', password='testpass123')
+        self.client.get(reverse('message_chat:chat_detail', kwargs={'username': 'frienduser'}))
+
+        cursor = ReadCursor.objects.get(user=self.user)
+        self.assertEqual(cursor.last_read_id, latest.id)
+        self.assertEqual(ReadCursor.unread_count(self.user, self.friend), 0)
+        self.assertEqual(Message.get_unread_count(self.user), 0)
+
+    def test_mark_read_is_single_upsert(self):
+        message = Message.objects.create(sender=self.friend, receiver=self.user, content='Hi')
+        conversation = Conversation.get_between(self.user, self.friend)
+        with self.assertNumQueries(1):
+            ReadCursor.mark_read(self.user, conversation, message.id)
+        with self.assertNumQueries(1):
+            ReadCursor.mark_read(self.user, conversation, message.id)
+        self.assertEqual(ReadCursor.objects.count(), 1)
+
+    def test_sent_messages_show_read_state(self):
+        read = Message.objects.create(sender=self.user, receiver=self.friend, content='Seen')
+        Message.objects.create(sender=self.user, receiver=self.friend, content='Not seen')
+        ReadCursor.mark_read(self.friend, Conversation.get_between(self.user, self.friend), read.id)
+
+        page, has_more = Message.get_history_page(self.user, self.friend)
+        self.assertEqual([message.is_read for message in page], [True, False])
+
+    def test_unread_count_after_cursor(self):
+        first = Message.objects.create(sender=self.friend, receiver=self.user, content='One')
+        Message.objects.create(sender=self.friend, receiver=self.user, content='Two')
+        Message.objects.create(sender=self.friend, receiver=self.user, content='Three')
+        ReadCursor.mark_read(self.user, Conversation.get_between(self.user, self.friend), first.id)
+        self.assertEqual(ReadCursor.unread_count(self.user, self.friend), 2)
+
+
+class MessageSearchTests(BaseChatTestCase):
+    def setUp(self):
+        super().setUp()
+        self.stranger = User.objects.create_user(username='stranger', password='testpass123')
+        self.client.login(username='testuser', password='testpass123')
+
+    def search(self, **params):
+        return self.client.get(reverse('message_chat:search_messages'), params).json()
+
+    def test_search_returns_highlighted_hits(self):
+        Message.objects.create(sender=self.friend, receiver=self.user, content='Have you read <Dune> yet?')
+        Message.objects.create(sender=self.user, receiver=self.friend, content='Not yet')
+
+        data = self.search(q='dune')
+        self.assertEqual(len(data['results']), 1)
+        self.assertEqual(data['results'][0]['highlighted'], 'Have you read &lt;<mark>Dune</mark>&gt; yet?')
+        self.assertEqual(data['results'][0]['with_user'], 'frienduser')
+        self.assertFalse(data['has_more'])
+
+    def test_search_is_limited_to_own_conversations(self):
+        Message.objects.create(sender=self.friend, receiver=self.stranger, content='secret book club')
+        Message.objects.create(sender=self.friend, receiver=self.user, content='book club tonight')
+
+        data = self.search(q='book club')
+        self.assertEqual([hit['content'] for hit in data['results']], ['book club tonight'])
+
+    def test_index_follows_updates_and_deletes(self):
+        message = Message.objects.create(sender=self.friend, receiver=self.user, content='paperback')
+        message.content = 'hardcover'
+        message.save()
+        self.assertEqual(self.search(q='paperback')['results'], [])
+        self.assertEqual(len(self.search(q='hardcover')['results']), 1)
+
+        message.delete()
+        self.assertEqual(self.search(q='hardcover')['results'], [])
+
+    def test_search_pages_chain_through_cursor(self):
+        for index in range(5):
+            Message.objects.create(sender=self.friend, receiver=self.user, content=f'novel number {index}')
+
+        with patch('Message_Chat.views.SEARCH_PAGE_SIZE', 2):
+            seen = []
+            data = self.search(q='novel')
+            seen += [hit['id'] for hit in data['results']]
+            while data['has_more']:
+                data = self.search(q='novel', after=data['next_cursor'])
+                seen += [hit['id'] for hit in data['results']]
+        self.assertEqual(sorted(seen), list(Message.objects.values_list('id', flat=True).order_by('id')))
+
+    def test_search_operators_are_taken_literally(self):
+        Message.objects.create(sender=self.friend, receiver=self.user, content='near OR far')
+        self.assertEqual(len(self.search(q='"near OR')['results']), 1)
+
+    def test_search_rejects_bad_cursor(self):
+        response = self.client.get(reverse('message_chat:search_messages'), {'q': 'x', 'after': 'nope'})
+        self.assertEqual(response.status_code, 400)
+
+
+class SyncTests(BaseChatTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client.login(username='testuser', password='testpass123')
+
+    def sync(self, **params):
+        return self.client.get(reverse('message_chat:sync'), params).json()
+
+    def test_first_sync_returns_current_cursor_only(self):
+        Message.objects.create(sender=self.friend, receiver=self.user, content='Old')
+        data = self.sync()
+        self.assertEqual(data['messages'], [])
+        self.assertEqual(self.sync(cursor=data['cursor'])['messages'], [])
+
+    def test_sync_returns_changes_since_cursor(self):
+        cursor = self.sync()['cursor']
+        sent = Message.objects.create(sender=self.user, receiver=self.friend, content='Ping')
+        Message.objects.create(sender=self.friend, receiver=self.user, content='Pong')
+
+        data = self.sync(cursor=cursor)
+        self.assertEqual([message['content'] for message in data['messages']], ['Ping', 'Pong'])
+        self.assertEqual(data['messages'][0]['with_user'], 'frienduser')
+        self.assertEqual(data['conversations'], [{
+            'with_user': 'frienduser',
+            'unread_count': 1,
+            'last_message_id': sent.id + 1,
+            'last_activity': Conversation.get_between(self.user, self.friend).last_activity.isoformat(),
+        }])
+        self.assertEqual(self.sync(cursor=data['cursor'])['messages'], [])
+
+    def test_sync_reports_read_receipts(self):
+        cursor = self.sync()['cursor']
+        message = Message.objects.create(sender=self.user, receiver=self.friend, content='Seen?')
+        message.mark_as_read()
+
+        data = self.sync(cursor=cursor)
+        self.assertEqual(data['reads'], [{'with_user': 'frienduser', 'last_read_id': message.id}])
+
+    def test_sync_marks_open_conversation_read(self):
+        cursor = self.sync()['cursor']
+        Message.objects.create(sender=self.friend, receiver=self.user, content='Hi')
+
+        data = self.sync(cursor=cursor, reading='frienduser')
+        self.assertEqual(data['conversations'][0]['unread_count'], 0)
+        self.assertEqual(Message.get_unread_count(self.user), 0)
+
+    def test_sync_cost_follows_changes(self):
+        for index in range(20):
+            Message.objects.create(sender=self.friend, receiver=self.user, content=f'Old {index}')
+        cursor = self.sync()['cursor']
+        with self.assertNumQueries(0):
+            after_id = SyncEntry.decode_cursor(self.user, cursor)
+        with self.assertNumQueries(1):
+            entries, has_more = SyncEntry.get_changes(self.user, after_id)
+        self.assertEqual(entries, [])
+
+    def test_sync_rejects_bad_and_foreign_cursors(self):
+        response = self.client.get(reverse('message_chat:sync'), {'cursor': 'forged'})
+        self.assertEqual(response.status_code, 400)
+
+        foreign_cursor = SyncEntry.current_cursor(self.friend)
+        response = self.client.get(reverse('message_chat:sync'), {'cursor': foreign_cursor})
+        self.assertEqual(response.status_code, 400)
+
+    def test_expired_cursor_asks_for_reset(self):
+        cursor = self.sync()['cursor']
+        with patch.object(SyncEntry, 'RETENTION', timedelta(seconds=-1)):
+            response = self.client.get(reverse('message_chat:sync'), {'cursor': cursor})
+        self.assertEqual(response.status_code, 410)
+        self.assertTrue(response.json()['reset'])
+
+
+class MessageArchiveTests(BaseChatTestCase):
+    def setUp(self):
+        super().setUp()
+        self.messages = []
+        for index in range(6):
+            sender, receiver = (self.user, self.friend) if index % 2 else (self.friend, self.user)
+            self.messages.append(Message.objects.create(sender=sender, receiver=receiver, content=f'Line {index}'))
+        old = timezone.now() - timedelta(days=400)
+        for index, message in enumerate(self.messages[:4]):
+            Message.objects.filter(pk=message.pk).update(timestamp=old + timedelta(minutes=index))
+        conversation = Conversation.get_between(self.user, self.friend)
+        ReadCursor.mark_read(self.user, conversation, self.messages[-1].id)
+        ReadCursor.mark_read(self.friend, conversation, self.messages[-1].id)
+
+    def archive(self, **options):
+        call_command('archive_messages', older_than_days=180, block_size=3, stdout=StringIO(), **options)
+
+    def test_old_read_messages_move_to_blocks(self):
+        self.archive()
+        self.assertEqual(ArchivedMessageBlock.objects.count(), 2)
+        self.assertEqual(sum(block.message_count for block in ArchivedMessageBlock.objects.all()), 4)
+        self.assertEqual(Message.objects.count(), 2)
+
+    def test_unread_messages_stay_hot(self):
+        conversation = Conversation.get_between(self.user, self.friend)
+        ReadCursor.mark_read(self.user, conversation, 0)
+        self.archive()
+        # Messages sent to the user have not been read by them
+        self.assertEqual(
+            set(Message.objects.values_list('content', flat=True)),
+            {'Line 0', 'Line 2', 'Line 4', 'Line 5'}
+        )
+
+    def test_history_reads_archived_blocks_transparently(self):
+        self.archive()
+        page, has_more = Message.get_history_page(self.user, self.friend, limit=3)
+        contents = [message.content for message in page]
+        while has_more:
+            page, has_more = Message.get_history_page(
+                self.user, self.friend, before=Message.decode_cursor(Message.encode_cursor(page[0])), limit=3
+            )
+            contents = [message.content for message in page] + contents
+        self.assertEqual(contents, [f'Line {index}' for index in range(6)])
+        self.assertTrue(all(message.is_read for message in page))
+
+    def test_dry_run_changes_nothing(self):
+        self.archive(dry_run=True)
+        self.assertEqual(Message.objects.count(), 6)
+        self.assertFalse(ArchivedMessageBlock.objects.exists())
+
+    def search(self, **params):
+        self.client.login(username='testuser', password='testpass123')
+        return self.client.get(reverse('message_chat:search_messages'), params).json()
+
+    def test_archived_messages_stay_searchable(self):
+        self.archive()
+        data = self.search(q='line')
+        self.assertEqual(
+            sorted(hit['content'] for hit in data['results']),
+            [f'Line {index}' for index in range(6)]
+        )
+        hit = next(hit for hit in data['results'] if hit['id'] == self.messages[0].id)
+        self.assertEqual(hit['highlighted'], '<mark>Line</mark> 0')
+        self.assertEqual(hit['with_user'], 'frienduser')
+
+    def test_archived_search_pages_across_both_indexes(self):
+        self.archive()
+        with patch('Message_Chat.views.SEARCH_PAGE_SIZE', 4):
+            data = self.search(q='line')
+            ids = [hit['id'] for hit in data['results']]
+            while data['has_more']:
+                data = self.search(q='line', after=data['next_cursor'])
+                ids += [hit['id'] for hit in data['results']]
+        self.assertEqual(sorted(ids), sorted(message.id for message in self.messages))
+
+    def test_deleting_blocks_removes_them_from_search(self):
+        self.archive()
+        ArchivedMessageBlock.objects.all().delete()
+        data = self.search(q='line')
+        self.assertEqual(sorted(hit['content'] for hit in data['results']), ['Line 4', 'Line 5'])
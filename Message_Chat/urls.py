@@ -6,5 +6,8 @@ app_name = 'message_chat'
 urlpatterns = [
     path('chats/', views.chat_list, name='chat_list'),
     path('chat/<str:username>/', views.chat_view, name='chat_detail'),
+    path('chat/<str:username>/history/', views.chat_history, name='chat_history'),
+    path('sync/', views.sync, name='sync'),
+    path('search/', views.search_messages, name='search_messages'),
     path('unread-count/', views.get_unread_count, name='get_unread_count'),
 ]
\ No newline at end of file
@@ -1,77 +1,78 @@
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
+from django.core.signing import BadSignature, SignatureExpired
 from django.contrib import messages
+from django.core.paginator import Paginator
 from django.db.models import Q
 from django.http import JsonResponse
-from Core.models import Friendship
-from .models import Message
+from Core.counters import counters_changed
+from Core.events import publish_on_commit
+from Core.friends import are_friends
+from Core.models import Notification
+from . import search
+from .models import Message, Conversation, ReadCursor, SyncEntry
 from .forms import MessageForm
 
+CHAT_LIST_PAGE_SIZE = 50
+
+
 @login_required
 def chat_list(request):
     # Handle search query
     search_query = request.GET.get('q', '')
     
-    # Get all friends of the current user
-    friendships = Friendship.objects.filter(
-        (Q(sender=request.user) | Q(receiver=request.user)),
-        status='accepted'
-    )
-    
-    friends = []
-    for friendship in friendships:
-        friend = friendship.receiver if friendship.sender == request.user else friendship.sender
-        if search_query:
-            if search_query.lower() not in friend.username.lower():
-                continue
-        friends.append(friend)
+    # Friends with their conversation summary, filtered and ordered by the database
+    paginator = Paginator(Conversation.get_inbox(request.user, search_query), CHAT_LIST_PAGE_SIZE)
+    page_obj = paginator.get_page(request.GET.get('page'))
     
-    # Get conversation data for each friend
-    conversations = []
-    for friend in friends:
-        messages = Message.objects.filter(
-            Q(sender=request.user, receiver=friend) |
-            Q(sender=friend, receiver=request.user)
-        ).order_by('-timestamp')
-        
-        if messages.exists():
-            last_message = messages.first()
-            unread_count = messages.filter(sender=friend, receiver=request.user, is_read=False).count()
-            conversations.append({
-                'friend': friend,
-                'last_message': last_message,
-                'unread_count': unread_count
-            })
-        else:
-            conversations.append({
-                'friend': friend,
-                'last_message': None,
-                'unread_count': 0
-            })
-    
-    # Sort conversations by last message timestamp
-    conversations.sort(
-        key=lambda x: x['last_message'].timestamp if x['last_message'] else x['friend'].date_joined,
-        reverse=True
+    # Load the last messages shown on this page in one query
+    last_messages = Message.objects.in_bulk(
+        [friend.last_message_id for friend in page_obj if friend.last_message_id]
     )
+    conversations = [
+        {
+            'friend': friend,
+            'last_message': last_messages.get(friend.last_message_id),
+            'unread_count': friend.unread_count
+        }
+        for friend in page_obj
+    ]
     
     context = {
         'conversations': conversations,
+        'page_obj': page_obj,
         'search_query': search_query,
         'total_unread': Message.get_unread_count(request.user)
     }
     return render(request, 'message/chat_list.html', context)
 
+CHAT_PAGE_SIZE = 50
+
+
+def _mark_conversation_read(user, friend):
+    """Move the user's read cursor to the latest message if anything is unread"""
+    conversation = Conversation.get_between(user, friend)
+    if not conversation or not conversation.unread_for(user):
+        return
+    ReadCursor.mark_read(user, conversation, conversation.last_message_id)
+    Conversation.set_unread(
+        user,
+        friend,
+        ReadCursor.unread_count(user, friend, conversation.last_message_id)
+    )
+    SyncEntry.record_read(user, friend, conversation.last_message_id)
+    Notification.mark_messages_read(user, friend)
+    publish_on_commit(friend.id, 'read', {'with_user': user.username})
+    counters_changed(user.id)
+
+
 @login_required
 def chat_view(request, username):
     friend = get_object_or_404(User, username=username)
     
     # Check if they are friends
-    if not Friendship.objects.filter(
-        (Q(sender=request.user, receiver=friend) | Q(sender=friend, receiver=request.user)),
-        status='accepted'
-    ).exists():
+    if not are_friends(request.user, friend):
         messages.error(request, 'You can only chat with your friends.')
         return redirect('core:dashboard')
     
@@ -86,22 +87,143 @@ def chat_view(request, username):
             )
             return redirect('message_chat:chat_detail', username=username)
     
-    # Get conversation messages
-    conversation = Message.objects.filter(
-        (Q(sender=request.user, receiver=friend) | Q(sender=friend, receiver=request.user))
-    ).order_by('timestamp')
+    # Only the latest page is rendered, older messages are loaded on scroll
+    chat_messages, has_older = Message.get_history_page(request.user, friend, limit=CHAT_PAGE_SIZE)
     
-    # Mark messages as read when receiver views them
-    unread_messages = conversation.filter(receiver=request.user, is_read=False)
-    unread_messages.update(is_read=True)
+    # Move the read cursor to the latest message when there is something unread
+    _mark_conversation_read(request.user, friend)
     
     context = {
         'friend': friend,
-        'chat_messages': conversation,
+        'chat_messages': chat_messages,
+        'has_older': has_older,
+        'older_cursor': Message.encode_cursor(chat_messages[0]) if chat_messages else '',
+        'sync_cursor': SyncEntry.current_cursor(request.user),
     }
     
     return render(request, 'message/chat.html', context)
 
+@login_required
+def chat_history(request, username):
+    """AJAX endpoint returning the page of messages before a cursor"""
+    friend = get_object_or_404(User, username=username)
+    if not are_friends(request.user, friend):
+        return JsonResponse({'error': 'You can only chat with your friends.'}, status=403)
+
+    before = None
+    if request.GET.get('before'):
+        before = Message.decode_cursor(request.GET['before'])
+        if before is None:
+            return JsonResponse({'error': 'Invalid cursor.'}, status=400)
+
+    chat_messages, has_more = Message.get_history_page(
+        request.user, friend, before=before, limit=CHAT_PAGE_SIZE
+    )
+    return JsonResponse({
+        'messages': [message.serialize(request.user) for message in chat_messages],
+        'has_more': has_more,
+        'next_cursor': Message.encode_cursor(chat_messages[0]) if chat_messages else None,
+    })
+
+SYNC_PAGE_SIZE = 200
+
+
+@login_required
+def sync(request):
+    """AJAX endpoint returning the user's chat changes since an opaque cursor.
+
+    Passing `reading=<username>` marks that conversation read first, for clients
+    that have it open on screen.
+    """
+    if not request.GET.get('cursor'):
+        # First sync: start from now, the page itself was rendered with the history
+        return JsonResponse({
+            'cursor': SyncEntry.current_cursor(request.user),
+            'has_more': False,
+            'messages': [],
+            'reads': [],
+            'conversations': [],
+        })
+    try:
+        after_id = SyncEntry.decode_cursor(request.user, request.GET['cursor'])
+    except SignatureExpired:
+        # Entries this old may have been pruned, the client has to reload
+        return JsonResponse({'error': 'Cursor expired.', 'reset': True}, status=410)
+    except (BadSignature, ValueError):
+        return JsonResponse({'error': 'Invalid cursor.'}, status=400)
+
+    if request.GET.get('reading'):
+        friend = User.objects.filter(username=request.GET['reading']).first()
+        if friend and are_friends(request.user, friend):
+            _mark_conversation_read(request.user, friend)
+
+    entries, has_more = SyncEntry.get_changes(request.user, after_id, limit=SYNC_PAGE_SIZE)
+    messages_data, reads, other_users = [], [], {}
+    for entry in entries:
+        other_users[entry.other_user_id] = entry.other_user
+        if entry.kind == 'message':
+            messages_data.append({
+                **entry.message.serialize(request.user),
+                'with_user': entry.other_user.username,
+            })
+        elif entry.kind == 'read':
+            reads.append({'with_user': entry.other_user.username, 'last_read_id': entry.message_id})
+
+    conversations = []
+    if other_users:
+        pairs = Q()
+        for other_id in other_users:
+            user_a_id, user_b_id = Conversation.participant_ids(request.user, other_id)
+            pairs |= Q(user_a_id=user_a_id, user_b_id=user_b_id)
+        for conversation in Conversation.objects.filter(pairs):
+            other_id = conversation.user_b_id if conversation.user_a_id == request.user.id else conversation.user_a_id
+            conversations.append({
+                'with_user': other_users[other_id].username,
+                'unread_count': conversation.unread_for(request.user),
+                'last_message_id': conversation.last_message_id,
+                'last_activity': conversation.last_activity.isoformat() if conversation.last_activity else None,
+            })
+
+    return JsonResponse({
+        'cursor': SyncEntry.encode_cursor(request.user, entries[-1].id if entries else after_id),
+        'has_more': has_more,
+        'messages': messages_data,
+        'reads': reads,
+        'conversations': conversations,
+    })
+
+
+SEARCH_PAGE_SIZE = 20
+
+
+@login_required
+def search_messages(request):
+    """AJAX endpoint returning ranked, highlighted messages across all conversations"""
+    if not search.is_available():
+        return JsonResponse({'error': 'Message search is not available.'}, status=501)
+
+    after = None
+    if request.GET.get('after'):
+        after = search.decode_cursor(request.GET['after'])
+        if after is None:
+            return JsonResponse({'error': 'Invalid cursor.'}, status=400)
+
+    hits, next_cursor = search.search_messages(
+        request.user, request.GET.get('q', ''), after=after, limit=SEARCH_PAGE_SIZE
+    )
+    results = []
+    for hit in hits:
+        message = hit['message']
+        result = message.serialize(request.user)
+        result['highlighted'] = hit['highlighted']
+        result['with_user'] = (message.receiver if message.sender_id == request.user.id else message.sender).username
+        results.append(result)
+    return JsonResponse({
+        'results': results,
+        'has_more': next_cursor is not None,
+        'next_cursor': next_cursor,
+    })
+
 @login_required
 def get_unread_count(request):
     """AJAX endpoint to get unread message count"""
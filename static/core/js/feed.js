@@ -0,0 +1,50 @@
+// Infinite scroll for the dashboard feed. The "Load More" block at the end of each
+// page is replaced by the next page, fetched as a fragment, once it scrolls into view.
+(function () {
+    const feed = document.getElementById('feed');
+    if (!feed || !('IntersectionObserver' in window)) {
+        return;
+    }
+
+    let loading = false;
+
+    function loadMore(more) {
+        if (loading) {
+            return;
+        }
+        loading = true;
+        const link = more.querySelector('a');
+        fetch(link.href, {headers: {'X-Requested-With': 'XMLHttpRequest'}})
+            .then(response => response.ok ? response.text() : Promise.reject(response.status))
+            .then(html => {
+                observer.unobserve(more);
+                more.insertAdjacentHTML('beforebegin', html);
+                more.remove();
+                watch();
+            })
+            .catch(() => {
+                // Leave the link in place so the page can still be loaded by hand
+                observer.unobserve(more);
+            })
+            .finally(() => {
+                loading = false;
+            });
+    }
+
+    const observer = new IntersectionObserver(entries => {
+        entries.forEach(entry => {
+            if (entry.isIntersecting) {
+                loadMore(entry.target);
+            }
+        });
+    }, {rootMargin: '400px'});
+
+    function watch() {
+        const more = feed.querySelector('.feed-more');
+        if (more) {
+            observer.observe(more);
+        }
+    }
+
+    watch();
+})();
@@ -1,22 +1,48 @@
-function checkNotifications() {
-    fetch('/notifications/api/', {
-        headers: {
-            'X-Requested-With': 'XMLHttpRequest'
-        }
-    })
-    .then(response => response.json())
-    .then(data => {
-        const badge = document.getElementById('notification-badge');
-        if (data.unread_count > 0) {
-            badge.textContent = data.unread_count;
-            badge.classList.remove('d-none');
-        } else {
-            badge.classList.add('d-none');
-        }
-    });
+// Poll the combined counters endpoint. The ETag of the last response is sent back
+// so unchanged state costs a 304 and no counting on the server.
+let countersEtag = null;
+
+function checkCounters() {
+    // Counters arrive over the realtime stream while it is connected
+    if (typeof BookFriendRealtime !== 'undefined' && BookFriendRealtime.connected) {
+        return;
+    }
+    const headers = {'X-Requested-With': 'XMLHttpRequest'};
+    if (countersEtag) {
+        headers['If-None-Match'] = countersEtag;
+    }
+    fetch('/counters/', {headers: headers, cache: 'no-store'})
+        .then(response => {
+            if (response.status !== 200) {
+                return null;
+            }
+            countersEtag = response.headers.get('ETag');
+            return response.json();
+        })
+        .then(counters => {
+            if (counters) {
+                document.dispatchEvent(new CustomEvent('bookfriend:counters', {detail: counters}));
+            }
+        });
+}
+
+// Update the navbar badges from a counters payload
+function updateBadgeCounters(counters) {
+    const notificationBadge = document.getElementById('notification-badge');
+    if (notificationBadge) {
+        notificationBadge.textContent = counters.unread_notifications;
+        notificationBadge.classList.toggle('d-none', counters.unread_notifications === 0);
+    }
+    const messageBadge = document.querySelector('#message-unread-badge');
+    if (messageBadge) {
+        messageBadge.textContent = counters.unread_messages;
+        messageBadge.style.display = counters.unread_messages > 0 ? 'inline' : 'none';
+    }
 }
 
-// Check notifications every 30 seconds
-setInterval(checkNotifications, 30000);
+document.addEventListener('bookfriend:counters', event => updateBadgeCounters(event.detail));
+
+// Check counters every 30 seconds
+setInterval(checkCounters, 30000);
 // Initial check
-document.addEventListener('DOMContentLoaded', checkNotifications); 
\ No newline at end of file
+document.addEventListener('DOMContentLoaded', checkCounters);
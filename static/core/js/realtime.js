@@ -0,0 +1,27 @@
+// Realtime push over server-sent events. Incoming events are re-dispatched on
+// `document` as `bookfriend:<type>` CustomEvents; pages keep polling only while
+// the stream is not connected.
+const BookFriendRealtime = {
+    connected: false,
+
+    connect(url) {
+        if (!window.EventSource) {
+            return;
+        }
+        const source = new EventSource(url);
+        source.onopen = () => {
+            this.connected = true;
+        };
+        source.onerror = () => {
+            // EventSource reconnects on its own unless the server closed the stream
+            this.connected = source.readyState === EventSource.OPEN;
+        };
+        ['message', 'notification', 'counters', 'read'].forEach(type => {
+            source.addEventListener(type, event => {
+                document.dispatchEvent(new CustomEvent('bookfriend:' + type, {
+                    detail: JSON.parse(event.data)
+                }));
+            });
+        });
+    }
+};